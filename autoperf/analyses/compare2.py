@@ -3,6 +3,7 @@ import subprocess
 
 from .interface import AbstractAnalysis
 from ..utils import config
+from ..utils import loader
 from ..utils.PPK import PPK
 
 
@@ -104,15 +105,15 @@ plot 'compare.{metric}.dat' using 1:xticlabels(3) title columnhead ls 1, \\
 
         events = list(set(aEvents) | set(bEvents))
 
-        aData = {}
-        bData = {}
+        aValues = self.aPPK.getAggVector(metric, PPK.MEAN, PPK.EXCLUSIVE, events)
+        bValues = self.bPPK.getAggVector(metric, PPK.MEAN, PPK.EXCLUSIVE, events)
+
+        aData = dict(zip(events, aValues.tolist()))
+        bData = dict(zip(events, bValues.tolist()))
         absDiff = {}
         relDiff = {}
 
         for event in events:
-            aData[event] = self.aPPK.getAggExcMean(event, metric)
-            bData[event] = self.bPPK.getAggExcMean(event, metric)
-
             absDiff[event] = abs(bData[event] - aData[event])
 
             # FIXME: Avoid devide-by-zero error. Is this the right
@@ -160,14 +161,12 @@ plot 'compare.{metric}.dat' using 1:xticlabels(3) title columnhead ls 1, \\
         self.bName = self.experiment.insname
         self.bDir = os.path.join(os.getcwd(), self.bName)
 
-        self.aPPK = PPK("%s/data.ppk" % self.aDir, self.hotspots)
-        self.bPPK = PPK("%s/data.ppk" % self.bDir, self.hotspots)
-
-        self.aPPK.attachMetricSet(self.experiment.metric_set)
-        self.bPPK.attachMetricSet(self.experiment.metric_set)
-
-        self.aPPK.populateAggData();
-        self.bPPK.populateAggData();
+        self.aPPK, self.bPPK = loader.load(["%s/data.ppk" % self.aDir,
+                                            "%s/data.ppk" % self.bDir],
+                                           self.hotspots,
+                                           metric_set=self.experiment.metric_set,
+                                           aggregate=True,
+                                           lazy=True)
 
         cwd = os.getcwd()
         os.chdir(self.bDir)
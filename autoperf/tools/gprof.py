@@ -1,7 +1,9 @@
 import logging
 import os
+from glob import glob
 
 from .interface import *
+from ..utils import GProf
 
 
 class Tool(AbstractTool):
@@ -19,18 +21,54 @@ class Tool(AbstractTool):
         return dict()
 
     def setup_str(self) -> str:
-        return ""
-
-    def wrap_command(self, exe_cmd, exe_opt):
+        """
+        Returns:
+          string: A string of commands to be executed before running
+                  gprof experiment
+        """
         datadir = self.experiment.datadirs[self.experiment.iteration]
 
-        _execmd = " %s && %s %s gmon.out" % (exe_cmd, 'gprof', exe_cmd)
+        # every process writes its own gmon.out.<pid>
+        gprof_setup = "# gprof environment variables\n"
+        gprof_setup += "export GMON_OUT_PREFIX=%s/gmon.out\n" % os.path.abspath(datadir)
+
+        # ext/gprof-helper.c, to profile all threads rather than the
+        # main one only
+        helper = config.get("%s.helper" % self.longname, None)
+        if helper:
+            gprof_setup += "export LD_PRELOAD=%s${LD_PRELOAD:+:$LD_PRELOAD}\n" % \
+                os.path.expanduser(helper)
+
+        return gprof_setup
 
-        return [_execmd, exe_opt]
+    def wrap_command(self, exe_cmd, exe_opt):
+        # the profiles are read by aggregate(), once all iterations ran
+        return (exe_cmd, exe_opt)
 
     def aggregate(self):
         """
         Aggregate data collected by all iterations of the current
         experiment. We assume that iterations have all been finished.
         """
-        # Not implemented yet
+        execmd = config.get("%s.exe_cmd" % self.experiment.longname)
+        execmd = os.path.expanduser(execmd)
+        gprof = config.get("%s.gprof" % self.longname, "gprof")
+
+        self.logger.info("Aggregating all collected data")
+
+        builders = []
+        for datadir in self.experiment.datadirs:
+            gmons = sorted(glob("%s/gmon.out.*" % datadir)) or glob("%s/gmon.out" % datadir)
+            if not gmons:
+                raise Exception("gprof: no gmon.out files in %s" % datadir)
+
+            # the sum is kept next to the gmon.out files, as `gprof -s` does
+            merged = "%s/gmon.sum" % datadir
+            self.logger.info("gprof: merge %d gmon.out files of %s into %s",
+                             len(gmons), datadir, merged)
+            self.logger.cmd(' '.join(GProf.command(execmd, merged, gprof)))
+            builders.append(GProf.read(execmd, gmons, gprof, merged))
+
+        self.merge_iterations(builders)
+
+        self.logger.newline()
@@ -1,7 +1,11 @@
 import logging
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from .interface import *
+from ..utils import HPCToolkit
+from ..utils.hashing import content_hash
 
 
 class Tool(AbstractTool):
@@ -35,6 +39,58 @@ class Tool(AbstractTool):
 
         return (_execmd, exe_opt)
 
+    def get_hpcstruct(self, execmd):
+        """
+        Recover the program structure of `execmd` with hpcstruct. The
+        result is cached under ~/.cache/autoperf/hpcstruct, keyed by the
+        content hash of the executable, and shared by all instances and
+        experiments.
+
+        Returns:
+          string: path to the hpcstruct file
+
+        Exceptions:
+          Exception if hpcstruct fails, nothing is kept then
+        """
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        hpcstruct = os.path.join(base, "autoperf", "hpcstruct", "%s-%s.hpcstruct"
+                                 % (os.path.basename(execmd), content_hash(execmd)))
+
+        if os.path.isfile(hpcstruct):
+            self.logger.info("HPCToolkit: reuse cached hpcstruct %s", hpcstruct)
+            return hpcstruct
+
+        # fall back to the instance directory if the cache is not writable
+        try:
+            os.makedirs(os.path.dirname(hpcstruct), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(hpcstruct))
+            os.close(fd)
+        except OSError as e:
+            self.logger.debug("Can not write hpcstruct cache: %s", e)
+            hpcstruct = "%s/%s.hpcstruct" % (self.experiment.insname,
+                                             os.path.basename(execmd))
+            tmp = hpcstruct
+
+        cmd = ["hpcstruct",
+               "-o",
+               tmp,
+               execmd]
+        self.logger.info("HPCToolkit: run hpcstruct")
+        self.logger.cmd(' '.join(cmd))
+        status = subprocess.call(cmd)
+
+        if status != 0 or not os.path.isfile(tmp) or os.path.getsize(tmp) == 0:
+            # never keep, let alone cache, a failed run
+            if os.path.isfile(tmp):
+                os.unlink(tmp)
+            raise Exception("hpcstruct failed on `%s` (exit code %d): %s"
+                            % (execmd, status, ' '.join(cmd)))
+
+        if tmp != hpcstruct:
+            os.replace(tmp, hpcstruct)
+
+        return hpcstruct
+
     def aggregate(self):
         """
         Aggregate data collected by all iterations of the current
@@ -42,82 +98,42 @@ class Tool(AbstractTool):
         """
         execmd = config.get("%s.exe_cmd" % self.experiment.longname)
         execmd = os.path.expanduser(execmd)
-        exebin = os.path.basename(execmd)
         appsrc = config.get("%s.appsrc" % self.longname)
+        jobs = config.getint("%s.jobs" % self.longname, os.cpu_count() or 1)
+        if jobs < 1:
+            raise Exception("Invalid %s.jobs `%d`, at least 1 job is needed"
+                            % (self.longname, jobs))
 
         self.logger.info("Aggregating all collected data")
-        hpcstruct = "%s/%s.hpcstruct" % (self.experiment.insname, exebin)
-        cmd = ["hpcstruct",
-               "-o",
-               hpcstruct,
-               execmd]
-        self.logger.info("HPCToolkit: run hpcstruct")
-        self.logger.cmd(' '.join(cmd))
-        subprocess.call(cmd)
-
-        # This could be stupid, but it is the only way I know to
-        # aggregate HPCToolkit collected data:
-        for datadir in self.experiment.datadirs:
-            measurement = "%s/measurement" % datadir
-            database = "%s/database" % datadir
-
-            # 1. convert to ppk (paraprof -f hpc --pack)
-            cmd = ["hpcprof",
-                   "-o",
-                   database,
-                   "-S",
-                   hpcstruct,
-                   "-I",
-                   "%s/'*'" % appsrc,
-                   measurement]
-            self.logger.info("HPCToolkit: run hpcprof")
-            self.logger.cmd(' '.join(cmd))
-            subprocess.call(cmd)
-
-            cmd = ["%s/bin/paraprof" % self.experiment.tauroot,
-                   "-f",
-                   "hpc",
-                   "--pack",
-                   "%s/data.ppk" % datadir,
-                   "%s/experiment.xml" % database]
-            self.logger.info("Pack collected data to TAU .ppk package")
-            self.logger.cmd(' '.join(cmd))
-            process = subprocess.Popen(cmd,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-            out, err = process.communicate()
-
-            # 2. dump as tau profile (paraprof --dump)
-            cwd = os.getcwd()
-            self.logger.cmd("cd %s/profiles", datadir)
-            os.chdir("%s/profiles" % datadir)
-
-            cmd = ["%s/bin/paraprof" % self.experiment.tauroot,
-                   "--dump",
-                   "../data.ppk"]
-            self.logger.info("Unpack .ppk to TAU profiles")
+        hpcstruct = self.get_hpcstruct(execmd)
+
+        # 1. correlate the measurements of every iteration with the
+        #    program structure, a few iterations at a time
+        databases = ["%s/database" % datadir for datadir in self.experiment.datadirs]
+        cmds = []
+        for datadir, database in zip(self.experiment.datadirs, databases):
+            cmds.append(["hpcprof",
+                         "-o",
+                         database,
+                         "-S",
+                         hpcstruct,
+                         "-I",
+                         "%s/'*'" % appsrc,
+                         "%s/measurement" % datadir])
+
+        self.logger.info("HPCToolkit: run hpcprof, %d iterations at a time", jobs)
+        for cmd in cmds:
             self.logger.cmd(' '.join(cmd))
-            process = subprocess.Popen(cmd,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-            out, err = process.communicate()
-
-            self.logger.cmd("cd %s", cwd)
-            os.chdir(cwd)
-
-            # 3. aggregate tau profiles
-            for metric in os.listdir("%s/profiles" % datadir):
-                target = os.path.relpath("%s/profiles/%s" % (datadir, metric),
-                                         "%s/profiles" % self.experiment.insname)
-                link_name = "%s/profiles/%s" % (self.experiment.insname, metric)
-
-                self.logger.cmd("ln -s %s %s", target, link_name)
-
-                # link error will happen if different iterations share
-                # some metrics, in this case we just ignore the error
-                try:
-                    os.symlink(target, link_name)
-                except:
-                    pass
-
-            self.logger.newline()
+        with ThreadPoolExecutor(jobs) as pool:
+            status = list(pool.map(subprocess.call, cmds))
+
+        for datadir, cmd, code in zip(self.experiment.datadirs, cmds, status):
+            if code != 0:
+                raise Exception("hpcprof failed on iteration `%s` (exit code %d): %s"
+                                % (datadir, code, ' '.join(cmd)))
+
+        # 2. read the databases of all iterations and merge them
+        self.logger.info("Read HPCToolkit databases")
+        self.merge_iterations(HPCToolkit.read_all(databases, jobs))
+
+        self.logger.newline()
@@ -1,6 +1,9 @@
+import os
 import subprocess
 
 from ..utils import config
+from ..utils import TAUProfile
+from ..utils import merge
 from ..utils.PPK import PPK
 
 
@@ -9,6 +12,9 @@ class AbstractTool:
     longname = "Abstract"
     experiment = None
 
+    # PPKBuilder of all iterations, see merge_iterations()
+    merged = None
+
     def __init__(self, experiment):
         raise NotImplementedError
 
@@ -48,6 +54,38 @@ class AbstractTool:
         """
         raise NotImplementedError
 
+    def merge_iterations(self, builders=None):
+        """
+        Merge the data of all iterations in memory, see utils.merge.
+        Metrics measured by several iterations are merged as the
+        `shared_metrics` option says.
+
+        Args:
+          builders (list): PPKBuilder of every iteration. By default the
+                           TAU text profiles of the iterations are read
+
+        Returns:
+          bool: False if some iteration has no text profiles, in which
+                case nothing is merged
+        """
+        datadirs = self.experiment.datadirs
+
+        if builders is None:
+            profiles = ["%s/profiles" % d for d in datadirs]
+            if not profiles or not all(TAUProfile.find(p)[1] for p in profiles):
+                return False
+            builders = [TAUProfile.read(p) for p in profiles]
+
+        shared = config.get("%s.shared_metrics" % self.longname, "average")
+        self.logger.info("Merge data of %d iterations, %s shared metrics",
+                         len(builders), "averaging" if shared == "average" else "keeping")
+
+        parts = [(builder.header, builder.columns()) for builder in builders]
+        labels = [os.path.basename(os.path.normpath(d)).lstrip(".") for d in datadirs]
+        self.merged = merge.merge(parts, labels, shared)
+
+        return True
+
     def collect_data(self):
         """
         Collect the profiling data and do some postprocessing if necessary
@@ -56,10 +94,43 @@ class AbstractTool:
           Nothing
         """
         ppkfile = "%s/%s.ppk" % (self.experiment.insname, self.experiment.ppkname)
+        profiles = "%s/profiles" % self.experiment.insname
+
+        # user specified metadata
+        metadata = dict(config.get_section("Metadata.%s" % self.experiment.name))
+
+        # also calculate and attach derived metrics, unless analyses
+        # should compute them on demand
+        metric_set = self.experiment.metric_set
+        persist = self.experiment.config.getboolean(
+            "%s.persist_derived_metrics" % self.experiment.longname, True)
+
+        if self.merged is None and not TAUProfile.find(profiles)[1]:
+            # not in the text format, leave it to paraprof
+            self._pack(ppkfile, profiles)
+            self._postprocess(ppkfile, metadata, metric_set, persist)
+            return
+
+        # read the profiles natively and write the PPK once
+        self.logger.info("Pack collected data to TAU .ppk package")
+        if self.merged is not None:
+            builder = self.merged
+            for name, value in metadata.items():
+                builder.addMetadata(name, value)
+        else:
+            builder = TAUProfile.read(profiles, metadata)
+        if metric_set.dmetrics and persist:
+            ppk = builder.build("", compact=True)
+            ppk.attachMetricSet(metric_set)
+            ppk.dump(ppkfile)
+        else:
+            builder.write(ppkfile)
+
+    def _pack(self, ppkfile, profiles):
         cmd = ["%s/bin/paraprof" % self.experiment.tauroot,
                "--pack",
                ppkfile,
-               "%s/profiles" % self.experiment.insname]
+               profiles]
         self.logger.info("Pack collected data to TAU .ppk package")
         self.logger.cmd(' '.join(cmd))
         process = subprocess.Popen(cmd,
@@ -67,16 +138,15 @@ class AbstractTool:
                                    stderr=subprocess.PIPE)
         out, err = process.communicate()
 
-        # now add user specified metadata
+    def _postprocess(self, ppkfile, metadata, metric_set, persist):
+        """Add metadata and derived metrics to a PPK packed by paraprof"""
         num = 0
-        ppk = PPK(ppkfile, "");
-        for name, value in config.get_section("Metadata.%s" % self.experiment.name):
+        ppk = PPK(ppkfile, "", compact=True)
+        for name, value in metadata.items():
             num += 1
             ppk.addMetadata(name, value)
 
-        # also calculate and attach derived metrics
-        metric_set = self.experiment.metric_set
-        if metric_set.dmetrics:
+        if metric_set.dmetrics and persist:
             num += len(metric_set.dmetrics)
             ppk.attachMetricSet(metric_set)
 
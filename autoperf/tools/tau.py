@@ -140,6 +140,11 @@ class Tool(AbstractTool):
         """
         self.logger.info("Aggregating all collected data")
 
+        if self.merge_iterations():
+            self.logger.newline()
+            return
+
+        # not in the text format, link everything together for paraprof
         for datadir in self.experiment.datadirs:
             metrics = os.listdir("%s/profiles" % datadir)
             for metric in metrics:
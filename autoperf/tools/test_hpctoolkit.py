@@ -0,0 +1,128 @@
+import threading
+import time
+import types
+from unittest import mock
+
+import pytest
+
+from . import hpctoolkit
+from ..utils.hashing import content_hash
+
+
+class Config:
+    def __init__(self, options):
+        self.options = options
+
+    def get(self, spec, default=None):
+        return self.options.get(spec.rpartition(".")[2], default)
+
+    def getint(self, spec, default=None):
+        return int(self.get(spec, default))
+
+
+def make_tool(tmp_path, monkeypatch, iterations=1, **options):
+    exe = tmp_path / "pi"
+    exe.write_bytes(b"\x7fELF pi")
+
+    options.setdefault("exe_cmd", str(exe))
+    options.setdefault("appsrc", str(tmp_path))
+    monkeypatch.setattr(hpctoolkit, "config", Config(options))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    experiment = types.SimpleNamespace(
+        name="pi", longname="Experiments.pi", insname=str(tmp_path / "instance"),
+        datadirs=[str(tmp_path / ("iter-%02d" % i)) for i in range(iterations)])
+    (tmp_path / "instance").mkdir()
+
+    tool = hpctoolkit.Tool(experiment)
+    tool.logger = mock.Mock()
+    return tool, str(exe)
+
+
+def fake_call(status=0):
+    """subprocess.call writing the `-o` output of hpcstruct"""
+    calls = []
+
+    def call(cmd):
+        calls.append(cmd)
+        if cmd[0] == "hpcstruct":
+            with open(cmd[cmd.index("-o") + 1], "w") as f:
+                f.write("<HPCToolkitStructure/>")
+        return status(cmd) if callable(status) else status
+
+    return call, calls
+
+
+def test_hpcstruct_cache(tmp_path, monkeypatch):
+    tool, exe = make_tool(tmp_path, monkeypatch)
+    call, calls = fake_call()
+    monkeypatch.setattr(hpctoolkit.subprocess, "call", call)
+
+    # keyed by the name and the contents of the executable
+    path = tool.get_hpcstruct(exe)
+    assert path == str(tmp_path / "cache" / "autoperf" / "hpcstruct" /
+                       ("pi-%s.hpcstruct" % content_hash(exe)))
+    assert tool.get_hpcstruct(exe) == path
+    assert len(calls) == 1
+
+    # a rebuilt executable is recovered again
+    (tmp_path / "pi").write_bytes(b"\x7fELF pi, rebuilt")
+    assert tool.get_hpcstruct(exe) != path
+    assert len(calls) == 2
+
+
+def test_hpcstruct_failure(tmp_path, monkeypatch):
+    tool, exe = make_tool(tmp_path, monkeypatch)
+    call, calls = fake_call(1)
+    monkeypatch.setattr(hpctoolkit.subprocess, "call", call)
+
+    with pytest.raises(Exception, match="hpcstruct failed"):
+        tool.get_hpcstruct(exe)
+
+    # nothing is left behind to be reused
+    assert not list((tmp_path / "cache" / "autoperf" / "hpcstruct").iterdir())
+    assert not list((tmp_path / "instance").iterdir())
+
+    call, calls = fake_call()
+    monkeypatch.setattr(hpctoolkit.subprocess, "call", call)
+    tool.get_hpcstruct(exe)
+    assert len(calls) == 1
+
+
+def test_aggregate(tmp_path, monkeypatch):
+    tool, exe = make_tool(tmp_path, monkeypatch, iterations=5, jobs="2")
+    monkeypatch.setattr(hpctoolkit.HPCToolkit, "read_all",
+                        lambda databases, processes: [databases, processes])
+    monkeypatch.setattr(tool, "merge_iterations", lambda builders: builders)
+
+    lock = threading.Lock()
+    running = [0, 0]  # now, at most
+
+    def hpcprof(cmd):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return 2 if cmd[-1].endswith("iter-03/measurement") else 0
+
+    call, calls = fake_call(hpcprof)
+    monkeypatch.setattr(hpctoolkit.subprocess, "call", call)
+
+    with pytest.raises(Exception, match="iteration `.*iter-03` \\(exit code 2\\)"):
+        tool.aggregate()
+
+    # every iteration ran, no more than `jobs` at a time
+    assert [c[0] for c in calls].count("hpcprof") == 5
+    assert running[1] == 2
+
+
+def test_aggregate_jobs(tmp_path, monkeypatch):
+    tool, exe = make_tool(tmp_path, monkeypatch, jobs="0")
+    call, calls = fake_call()
+    monkeypatch.setattr(hpctoolkit.subprocess, "call", call)
+
+    with pytest.raises(Exception, match="jobs"):
+        tool.aggregate()
+    assert calls == []
@@ -0,0 +1,266 @@
+"""
+gprof support.
+
+A program built with `-pg` writes its profile to `gmon.out`, or to
+`gmon.out.<pid>` for every process when GMON_OUT_PREFIX is set (with
+ext/gprof-helper.c preloaded, threads are counted as well). A gmon file
+is made of tagged records in the byte order and pointer size of the
+machine that wrote it:
+
+  header     -- "gmon", version, 12 spare bytes
+  histogram  -- tag 0, lowpc, highpc, number of bins, sampling rate,
+                dimension (15 bytes) and its abbreviation, then 16 bit
+                sample counts
+  call arc   -- tag 1, from pc, self pc, 32 bit count
+  basic blocks -- tag 2, ignored
+
+merge() sums any number of gmon files at once, instead of folding them
+in one `gprof -s` run at a time. Position independent executables are
+loaded at another address by every process, so the addresses of every
+file are moved by the distance between its histogram and the one of the
+first file before they are summed. read() runs gprof once over the sum
+and turns it into a PPK with one event per function. The flat profile
+gives the self time, the primary lines of the call graph the inclusive
+time, the calls and the calls to children. Call arcs are not turned into
+events of their own, they would be aggregated into their callee a second
+time.
+
+TIME is in microseconds, as in TAU profiles.
+"""
+
+import logging
+import os
+import re
+import struct
+import subprocess
+import tempfile
+
+import numpy as np
+
+from .PPK import PPKBuilder
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"gmon"
+VERSION = 1
+
+TAG_TIME_HIST = 0
+TAG_CG_ARC = 1
+TAG_BB_COUNT = 2
+
+_PTR = struct.calcsize("@P")
+_ARC = struct.Struct("@PPI")
+
+_FLAT_RE = re.compile(r"^\s*([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+"
+                      r"(?:(\d+)\s+([\d.]+)\s+([\d.]+)\s+)?(\S.*?)\s*$")
+_PRIMARY_RE = re.compile(r"^\[(\d+)\]\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+"
+                         r"(?:(\d+)(?:\+(\d+))?\s+)?(\S.*?)\s+\[\d+\]$")
+_ARC_RE = re.compile(r"^\s+(?:([\d.]+)\s+([\d.]+)\s+)?(\d+)(?:[/+](\d+))?\s+(\S.*?)\s+\[\d+\]$")
+_CYCLE_RE = re.compile(r"\s*<cycle \d+>$")
+
+
+def read_gmon(filename):
+    """
+    Returns:
+      map: "hist" -> (lowpc, highpc, rate, dimension, abbreviation) ->
+           int64 sample counts, "arcs" -> (from pc, self pc) -> count
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    if data[:4] != MAGIC:
+        raise Exception("`%s` is not a gmon file" % filename)
+
+    hist = dict()
+    arcs = dict()
+
+    pos = 20
+    while pos < len(data):
+        tag = data[pos]
+        pos += 1
+
+        if tag == TAG_TIME_HIST:
+            lowpc, highpc = struct.unpack_from("@PP", data, pos)
+            pos += 2 * _PTR
+            bins, rate = struct.unpack_from("@II", data, pos)
+            pos += 8
+            dimension, abbreviation = data[pos:pos + 15], data[pos + 15:pos + 16]
+            pos += 16
+
+            key = (lowpc, highpc, rate, dimension, abbreviation)
+            counts = np.frombuffer(data, dtype=np.uint16, count=bins, offset=pos)
+            pos += 2 * bins
+
+            if key in hist:
+                hist[key] += counts
+            else:
+                hist[key] = counts.astype(np.int64)
+        elif tag == TAG_CG_ARC:
+            frompc, selfpc, count = _ARC.unpack_from(data, pos)
+            pos += _ARC.size
+            arcs[(frompc, selfpc)] = arcs.get((frompc, selfpc), 0) + count
+        elif tag == TAG_BB_COUNT:
+            ncounts = struct.unpack_from("@I", data, pos)[0]
+            pos += 4 + ncounts * 2 * _PTR
+        else:
+            raise Exception("Unknown record %d in gmon file `%s`" % (tag, filename))
+
+    return {"hist": hist, "arcs": arcs}
+
+
+def merge(filenames, output):
+    """
+    Sum the gmon files `filenames` into `output`. Sample counts are held
+    in 64 bits while summing and saturate when written back, as 16 bit
+    bins. The addresses of every file are relocated to the load address
+    of the first one, see the module docstring.
+
+    Returns:
+      int: number of files merged
+    """
+    hist = dict()
+    arcs = dict()
+    base = None  # lowest histogram address of the first file
+    for filename in filenames:
+        gmon = read_gmon(filename)
+
+        delta = 0
+        if gmon["hist"]:
+            lowpc = min(key[0] for key in gmon["hist"])
+            if base is None:
+                base = lowpc
+            delta = base - lowpc
+            if delta:
+                logger.debug("Relocate `%s` by %#x", filename, delta)
+
+        for (lowpc, highpc, rate, dimension, abbreviation), counts in gmon["hist"].items():
+            key = (lowpc + delta, highpc + delta, rate, dimension, abbreviation)
+            if key in hist:
+                if len(hist[key]) != len(counts):
+                    raise Exception("`%s` comes from another executable" % filename)
+                hist[key] += counts
+            elif any(k[0] == key[0] for k in hist):
+                raise Exception("`%s` comes from another executable" % filename)
+            else:
+                hist[key] = counts
+        for (frompc, selfpc), count in gmon["arcs"].items():
+            key = (frompc + delta, selfpc + delta)
+            arcs[key] = arcs.get(key, 0) + count
+
+    with open(output, "wb") as f:
+        f.write(MAGIC + struct.pack("@I", VERSION) + b"\0" * 12)
+
+        for (lowpc, highpc, rate, dimension, abbreviation), counts in hist.items():
+            if counts.max(initial=0) > 0xffff:
+                logger.warning("Some samples of `%s` overflow 16 bit bins and saturate", output)
+            f.write(bytes([TAG_TIME_HIST]))
+            f.write(struct.pack("@PP", lowpc, highpc))
+            f.write(struct.pack("@II", len(counts), rate))
+            f.write(dimension + abbreviation)
+            f.write(np.minimum(counts, 0xffff).astype(np.uint16).tobytes())
+
+        for (frompc, selfpc), count in arcs.items():
+            f.write(bytes([TAG_CG_ARC]))
+            f.write(_ARC.pack(frompc, selfpc, min(count, 0xffffffff)))
+
+    return len(filenames)
+
+
+def _name(name):
+    return _CYCLE_RE.sub("", name)
+
+
+def parse(text):
+    """
+    Parse the brief flat profile and call graph gprof prints, see
+    `gprof -b -p -q`.
+
+    Returns:
+      PPKBuilder: a single thread, one TIME metric
+    """
+    flat, graph = text, ""
+    if "Call graph" in text:
+        flat, graph = text.split("Call graph", 1)
+
+    # function -> [calls, subroutine calls, self, inclusive] in seconds
+    functions = dict()
+
+    for line in flat.splitlines():
+        m = _FLAT_RE.match(line)
+        if m is None or line.lstrip().startswith("%"):
+            continue
+        selfTime = float(m.group(3))
+        calls = int(m.group(4)) if m.group(4) is not None else 0
+        functions[_name(m.group(7))] = [calls, 0, selfTime, selfTime]
+
+    for block in graph.split("-----"):
+        caller = None
+        for line in block.splitlines():
+            m = _PRIMARY_RE.match(line)
+            if m is not None:
+                caller = _name(m.group(7))
+                if caller.startswith("<cycle"):
+                    caller = None
+                    continue
+
+                function = functions.setdefault(caller, [0, 0, 0.0, 0.0])
+                function[0] = max(function[0], sum(int(c) for c in m.groups()[4:6] if c))
+                function[2] = float(m.group(3))
+                function[3] = float(m.group(3)) + float(m.group(4))
+                continue
+
+            m = _ARC_RE.match(line)
+            if m is None or caller is None:
+                continue
+
+            # children of the primary line
+            functions[caller][1] += int(m.group(3))
+
+    builder = PPKBuilder(["TIME"])
+
+    ids = []
+    values = []
+    for name, (calls, subr, selfTime, inclusive) in functions.items():
+        ids.append(builder.addEvent(name))
+        values.append((calls, subr, selfTime, inclusive))
+
+    values = np.reshape(np.array(values, dtype=np.float64), (-1, 4))
+    builder.addThread(0, 0, 0, ids, values[:, 0], values[:, 1],
+                      values[:, 2:3] * 1e6, values[:, 3:4] * 1e6)
+
+    return builder
+
+
+def command(executable, merged, gprof="gprof"):
+    """
+    Returns:
+      list: the gprof command read() runs over the merged gmon file
+    """
+    return [gprof, "-b", "-p", "-q", executable, merged]
+
+
+def read(executable, filenames, gprof="gprof", output=None):
+    """
+    Merge the gmon files `filenames` of `executable` and read the result
+    with gprof.
+
+    Args:
+      output (string): Where to keep the merged gmon file, by default it
+                       goes to a temporary file
+
+    Returns:
+      PPKBuilder: see parse()
+    """
+    merged = output
+    if output is None:
+        fd, merged = tempfile.mkstemp(suffix=".gmon")
+        os.close(fd)
+    try:
+        merge(filenames, merged)
+        text = subprocess.check_output(command(executable, merged, gprof),
+                                       universal_newlines=True)
+    finally:
+        if output is None:
+            os.unlink(merged)
+
+    return parse(text)
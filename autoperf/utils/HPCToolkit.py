@@ -0,0 +1,318 @@
+"""
+Reader of hpcprof databases.
+
+A database directory holds `experiment.xml`, which has the metric,
+file and procedure tables followed by the calling context tree (CCT),
+and, when hpcprof wrote one, a metric database: one `*.metric-db` file
+per thread with a big-endian [CCT nodes, metrics] matrix of doubles.
+
+The CCT is parsed with iterparse() and every element is dropped once
+its end tag is seen, so only the procedure frames (PF/Pr elements)
+currently open are held in memory. Frames become the events of either
+the flat profile or the call paths, named the way TAU names them:
+
+  compute [{pi.c} {1}]                          -- the flat profile
+  main [{pi.c} {10}] => compute [{pi.c} {1}]   -- the call path
+
+Never both, since both are aggregated by the name of the procedure.
+
+The values of a thread come from its metric-db file; its hpcrun rank and
+thread ids become the node and a dense thread index, in the order of the
+thread ids of the rank. Without a metric database, the summary values in
+experiment.xml become a single thread.
+Databases written by hpcprof from 2022 on use a different layout and are
+not supported.
+"""
+
+import glob
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .PPK import PPKBuilder
+
+logger = logging.getLogger(__name__)
+
+FRAMES = ("PF", "Pr")
+
+# magic, version and endianness; numNodes and numMetrics follow
+METRICDB_MAGIC = b"HPCPROF-metricdb"
+METRICDB_PREFIX = 22
+
+_FLAVOR_RE = re.compile(r"\s*\((I|E)\)$")
+_THREAD_RE = re.compile(r"-(\d+)-(\d+)-[0-9a-fA-F]+-\d+-\d+\.metric-db$")
+
+
+def _metric_name(name):
+    """
+    Returns:
+      (string, string): the metric `name` stands for and its flavor, "I"
+                        or "E"; None for summaries other than the sum
+    """
+    m = _FLAVOR_RE.search(name)
+    flavor = m.group(1) if m is not None else "I"
+    base = name[:m.start()] if m is not None else name
+
+    # summary metrics of hpcprof-mpi: "PAPI_TOT_CYC:Sum (I)"
+    base, sep, statistic = base.rpartition(":")
+    if not sep:
+        base = statistic
+    elif statistic != "Sum":
+        return None, flavor
+
+    # per-event metrics of hpcprof: "PAPI_TOT_CYC.[0,0] (I)"
+    base = re.sub(r"\.\[[^\]]*\]$", "", base)
+
+    return base.strip(), flavor
+
+
+class _Parser:
+    def __init__(self, callpath=False):
+        self.callpath = callpath
+        self.metrics = []  # metric names
+        self.summary = dict()  # MetricTable id -> (metric index, flavor)
+        self.metricDBs = []  # (metric index, flavor, db-id)
+        self.dbGlob = "*.metric-db"
+        self.dbHeader = None
+        self.files = dict()
+        self.procedures = dict()
+
+        self.events = dict()  # name -> event id
+        self.eventNames = []
+        self.eventGroups = []
+
+        # per frame
+        self.nodes = []  # CCT node id
+        self.frameEvents = []  # event id
+        self.recursive = []  # an enclosing frame is the same procedure
+
+        # summary values: frame, metric index, flavor, value
+        self.values = []
+
+    def _metric(self, name):
+        if name not in self.metrics:
+            self.metrics.append(name)
+        return self.metrics.index(name)
+
+    def _event(self, name, group):
+        if name not in self.events:
+            self.events[name] = len(self.eventNames)
+            self.eventNames.append(name)
+            self.eventGroups.append(group)
+        return self.events[name]
+
+    def parse(self, filename):
+        stack = []  # open elements: (element, frame or None)
+        frames = []  # open frames: (name, call path)
+
+        for action, elem in ET.iterparse(filename, events=("start", "end")):
+            tag = elem.tag
+
+            if action == "start":
+                frame = None
+                if tag in FRAMES:
+                    frame = self._addFrame(elem, frames)
+                elif tag == "M" and stack and stack[-1][1] is not None:
+                    metric = self.summary.get(elem.get("n"))
+                    if metric is not None:
+                        self.values.append((stack[-1][1], metric[0], metric[1],
+                                            float(elem.get("v"))))
+                stack.append((elem, frame))
+                continue
+
+            if tag == "Metric":
+                self._addMetric(elem)
+            elif tag == "MetricDB":
+                self._addMetricDB(elem)
+            elif tag == "File":
+                self.files[elem.get("i")] = elem.get("n")
+            elif tag == "Procedure":
+                self.procedures[elem.get("i")] = elem.get("n")
+
+            if stack.pop()[1] is not None:
+                frames.pop()
+
+            # drop what has been read, the CCT is never kept around
+            elem.clear()
+            if stack and len(stack[-1][0]) and stack[-1][0][-1] is elem:
+                del stack[-1][0][-1]
+
+    def _addMetric(self, elem):
+        name, flavor = _metric_name(elem.get("n", ""))
+        if name is not None and elem.get("t", "inclusive") in ("inclusive", "exclusive"):
+            self.summary[elem.get("i")] = (self._metric(name), flavor)
+
+    def _addMetricDB(self, elem):
+        name, flavor = _metric_name(elem.get("n", ""))
+        if name is None:
+            return
+
+        self.metricDBs.append((self._metric(name), flavor, int(elem.get("db-id"))))
+        self.dbGlob = elem.get("db-glob", self.dbGlob)
+        if elem.get("db-header-sz") is not None:
+            self.dbHeader = int(elem.get("db-header-sz"))
+
+    def _addFrame(self, elem, frames):
+        procedure = self.procedures.get(elem.get("n"), elem.get("n"))
+        filename = self.files.get(elem.get("f"), elem.get("f", "~unknown-file~"))
+        name = "%s [{%s} {%s}]" % (procedure, filename, elem.get("l", "0"))
+
+        path = "%s => %s" % (frames[-1][1], name) if frames else name
+
+        frame = len(self.nodes)
+        self.nodes.append(int(elem.get("i")))
+        self.recursive.append(any(n == name for n, p in frames))
+        if self.callpath and frames:
+            self.frameEvents.append(self._event(path, "TAU_CALLPATH"))
+        else:
+            self.frameEvents.append(self._event(name, "TAU_DEFAULT"))
+
+        frames.append((name, path))
+
+        return frame
+
+
+def _threads(database, parser):
+    """
+    Returns:
+      list: ((node, context, thread), path) of every metric-db file,
+            sorted by thread. Threads are numbered densely per node, the
+            aggregated data has room for as many threads as the largest
+            node has
+    """
+    paths = sorted(glob.glob(os.path.join(database, parser.dbGlob)))
+
+    ids = []
+    for i, path in enumerate(paths):
+        m = _THREAD_RE.search(path)
+        ids.append(((int(m.group(1)), int(m.group(2))) if m is not None else (i, 0), path))
+    ids.sort()
+
+    threads = []
+    for i, ((rank, thread), path) in enumerate(ids):
+        index = threads[-1][0][2] + 1 if i and ids[i - 1][0][0] == rank else 0
+        threads.append(((rank, 0, index), path))
+
+    return threads
+
+
+def _metricdb(path, parser):
+    """[CCT node id, metric-db column] values of a thread, memory mapped"""
+    with open(path, "rb") as f:
+        prefix = f.read(METRICDB_PREFIX + 8)
+    if not prefix.startswith(METRICDB_MAGIC):
+        raise Exception("`%s` is not a HPCToolkit metric database" % path)
+
+    numNodes, numMetrics = np.frombuffer(prefix[METRICDB_PREFIX:], dtype=">u4").tolist()
+    header = parser.dbHeader if parser.dbHeader is not None else METRICDB_PREFIX + 8
+
+    rows = (os.path.getsize(path) - header) // (8 * numMetrics) if numMetrics else 0
+    if rows == 0:
+        return np.zeros((0, numMetrics)), 1
+
+    values = np.memmap(path, dtype=">f8", mode="r", offset=header, shape=(rows, numMetrics))
+
+    # node ids start at 1, unless every node up to numNodes is there
+    return values, numNodes - rows
+
+
+def read(database, callpath=False):
+    """
+    Read the hpcprof database in directory `database`.
+
+    Args:
+      callpath (bool): One event per call path instead of the flat
+                       profile. The exclusive values of a procedure still
+                       sum up to its flat profile, its inclusive values
+                       count recursive calls once per call path
+
+    Returns:
+      PPKBuilder: one thread per metric-db file, or a single thread with
+                  the summary values if there is none
+    """
+    parser = _Parser(callpath)
+    parser.parse(os.path.join(database, "experiment.xml"))
+
+    nodes = np.array(parser.nodes, dtype=np.intp)
+    events = np.array(parser.frameEvents, dtype=np.intp)
+    # the flat profile counts recursive calls once
+    counted = np.ones(len(nodes), dtype=bool) if callpath else \
+        ~np.array(parser.recursive, dtype=bool)
+    numEvents = len(parser.eventNames)
+    numMetrics = len(parser.metrics)
+
+    builder = PPKBuilder(parser.metrics)
+    ids = [builder.addEvent(name, (group,))
+           for name, group in zip(parser.eventNames, parser.eventGroups)]
+
+    def addThread(thread, exclusive, inclusive):
+        """Sum [frames, metrics] values into the events of the frames"""
+        exc = np.zeros((numEvents, numMetrics))
+        inc = np.zeros((numEvents, numMetrics))
+
+        np.add.at(exc, events, exclusive)
+        np.add.at(inc, events[counted], inclusive[counted])
+
+        # sampling, most events are never seen by a thread
+        rows = np.flatnonzero(exc.any(axis=1) | inc.any(axis=1))
+        builder.addThread(*thread, np.asarray(ids, dtype=np.intp)[rows],
+                          np.ones(len(rows)), np.zeros(len(rows)),
+                          exc[rows], inc[rows])
+
+    threads = _threads(database, parser) if parser.metricDBs else []
+    if not threads:
+        exclusive = np.zeros((len(nodes), numMetrics))
+        inclusive = np.zeros((len(nodes), numMetrics))
+        for frame, metric, flavor, value in parser.values:
+            (exclusive if flavor == "E" else inclusive)[frame, metric] = value
+        addThread((0, 0, 0), exclusive, inclusive)
+        return builder
+
+    for thread, path in threads:
+        values, first = _metricdb(path, parser)
+        inside = (nodes >= first) & (nodes - first < len(values))
+        if len(values):
+            rows = values[np.where(inside, nodes - first, 0)]
+        else:
+            # a header without values, the thread has seen nothing
+            rows = np.zeros((len(nodes), values.shape[1]))
+
+        exclusive = np.zeros((len(nodes), numMetrics))
+        inclusive = np.zeros((len(nodes), numMetrics))
+        for metric, flavor, column in parser.metricDBs:
+            (exclusive if flavor == "E" else inclusive)[:, metric] = \
+                np.where(inside, rows[:, column], 0.0)
+        addThread(thread, exclusive, inclusive)
+
+    return builder
+
+
+def read_all(databases, processes=None, callpath=False):
+    """
+    Read several hpcprof databases concurrently.
+
+    Args:
+      databases (list): database directories
+      processes (int):  Size of the process pool, defaults to the number
+                        of CPUs. With 1, everything runs in this process
+      callpath (bool):  See read()
+
+    Returns:
+      list: the PPKBuilder of every database, in order
+    """
+    databases = list(databases)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(databases)))
+
+    if processes == 1:
+        return [read(d, callpath) for d in databases]
+
+    logger.info("Reading %d HPCToolkit databases with %d processes", len(databases), processes)
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(read, databases, [callpath] * len(databases)))
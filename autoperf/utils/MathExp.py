@@ -1,6 +1,9 @@
 import math
+import re
 import sys
 
+import numpy as np
+
 
 class _Error(Exception):
     """Base class for exceptions in this module"""
@@ -15,6 +18,22 @@ class UnresolvedSymbolError(_Error):
         return "Unresolved symbol: `%s`" % self.symbol
 
 
+def _over_threads(func):
+    """
+    Array flavor of a thread-axis reduction: reduce axis 0, keeping it, so
+    the result broadcasts against the per-thread values. A 0-d value is a
+    single thread.
+    """
+    def reduce(a, *args):
+        a = np.asarray(a, dtype=np.float64)
+        if a.ndim == 0:
+            return func(a[None], *args, axis=0).reshape(())
+
+        return func(a, *args, axis=0, keepdims=True)
+
+    return reduce
+
+
 class MathExp:
     # token types
     OP = 0
@@ -31,6 +50,9 @@ class MathExp:
 
     delimiter = "(),=+-*/%^ \t"
 
+    # a delimiter, or a run of anything else; see gen_tokens()
+    token_re = re.compile(r"[(),=+\-*/%^]|[^(),=+\-*/%^\s][^(),=+\-*/%^ \t]*")
+
     operators = {
         # (precedence, associativity, argc, op)
         '=': (0, RL, 2, lambda a, b: b),
@@ -60,6 +82,49 @@ class MathExp:
         'tan': (1, lambda a: math.tan(a)),
     }
 
+    # reductions over the thread axis, e.g. thread_max(TIME) /
+    # thread_mean(TIME) for load imbalance. A scalar is a single thread;
+    # arrays are [threads, ...], see PPK.attachMetricSet()
+    reductions = {
+        # (argc, scalar op, array op)
+        'thread_sum': (1, lambda a: a, _over_threads(np.sum)),
+        'thread_mean': (1, lambda a: a, _over_threads(np.mean)),
+        'thread_max': (1, lambda a: a, _over_threads(np.max)),
+        'thread_min': (1, lambda a: a, _over_threads(np.min)),
+        'thread_std': (1, lambda a: 0.0, _over_threads(np.std)),
+        'thread_percentile': (2, lambda a, q: a, _over_threads(np.percentile)),
+    }
+
+    functions.update((name, (argc, op)) for name, (argc, op, array_op) in reductions.items())
+
+    # the same, element-wise over numpy arrays (and scalars)
+    array_operators = dict(operators, **{
+        '^': (3, RL, 2, lambda a, b: np.power(a, b)),
+    })
+
+    array_functions = {
+        'abs': (1, np.abs),
+        'min': (2, np.minimum),
+        'max': (2, np.maximum),
+        'pow': (2, np.power),
+        'exp': (1, np.exp),
+        'log': (2, lambda a, b: np.log(a) / np.log(b)),
+        'log10': (1, np.log10),
+        'sqrt': (1, np.sqrt),
+        'acos': (1, np.arccos),
+        'asin': (1, np.arcsin),
+        'atan': (1, np.arctan),
+        'cos': (1, np.cos),
+        'sin': (1, np.sin),
+        'tan': (1, np.tan),
+    }
+
+    array_functions.update((name, (argc, array_op))
+                           for name, (argc, op, array_op) in reductions.items())
+
+    # (source, array) -> compiled function, see compile()
+    compiled = {}
+
     def __init__(self, exp):
         """
         Parse infix notation mathematical expressions to reverse
@@ -70,6 +135,10 @@ class MathExp:
 
         # infix notation math exp
         self.exp = exp.strip()
+        self.source = self.exp
+
+        # array -> compiled function taking a symtab, see call()
+        self.callables = {}
 
         # operator stack
         self.opstack = []
@@ -80,6 +149,9 @@ class MathExp:
         # variable symbol table
         self.variables = set()
 
+        # whether the expression reduces over the thread axis
+        self.reduces = False
+
         # while there are tokens to be read, read a token
         for token in self.gen_tokens():
             # if the token is a number, then add it to the output
@@ -96,6 +168,8 @@ class MathExp:
             # if the token is a function, then push it onto the stack
             elif token[0] == MathExp.FUNC:
                 self.opstack.append(token)
+                if token[1] in self.reductions:
+                    self.reduces = True
 
             # if the token is a function argument separator (e.g. a
             # comma)
@@ -232,13 +306,22 @@ class MathExp:
 
     def gen_tokens(self):
         """
-        Generator. Generate all tokens in the methematical expression
+        Generator. Generate all tokens in the methematical expression,
+        the same ones as repeated get_token() calls, in a single pass
         """
-        while len(self.exp) > 0:
-            yield self.get_token()
+        exp = self.exp
+        self.exp = ''
+
+        for m in self.token_re.finditer(exp):
+            token = m.group()
+            yield (self.get_type(token), token)
 
-    def resolve_symbol(self, symtab, token):
+    def resolve_symbol(self, symtab, token, array=False):
         if token[0] == MathExp.NUM:
+            # intermediate results may be whole arrays
+            if array and not isinstance(token[1], str):
+                return token[1]
+
             return float(token[1])
         elif token[0] == MathExp.VAR:
             if token[1] in symtab.keys():
@@ -248,10 +331,12 @@ class MathExp:
         else:
             raise Exception("Fatal error: bug encountered")
 
-    def apply_operator(self, symtab, stack, op):
+    def apply_operator(self, symtab, stack, op, array=False):
+        operators = MathExp.array_operators if array else MathExp.operators
+
         argv = []
-        argc = MathExp.operators[op][2]
-        oper = MathExp.operators[op][3]
+        argc = operators[op][2]
+        oper = operators[op][3]
 
         # sanity check
         if len(stack) < argc:
@@ -270,16 +355,19 @@ class MathExp:
                 argv[0] = argv[0][1]
         else:
             # normal case
-            argv[0] = self.resolve_symbol(symtab, argv[0])
+            argv[0] = self.resolve_symbol(symtab, argv[0], array)
 
         # now resolve remaining argv[1:]
         for i in range(1, argc):
-            argv[i] = self.resolve_symbol(symtab, argv[i])
+            argv[i] = self.resolve_symbol(symtab, argv[i], array)
 
         # FIXME: avoid divide-by-zero exception. Should we do it here?
         # Or should we even do it?
-        if op == '/' and argv[1] == 0:
-            argv[1] = 1
+        if op == '/':
+            if array:
+                argv[1] = np.where(argv[1] == 0, 1, argv[1])
+            elif argv[1] == 0:
+                argv[1] = 1
 
         # apply the operation and update the stack
         stack.append((MathExp.NUM, oper(*argv)))
@@ -288,10 +376,12 @@ class MathExp:
         if op == '=':
             symtab[argv[0]] = argv[1]
 
-    def apply_function(self, symtab, stack, f):
+    def apply_function(self, symtab, stack, f, array=False):
+        functions = MathExp.array_functions if array else MathExp.functions
+
         argv = []
-        argc = MathExp.functions[f][0]
-        func = MathExp.functions[f][1]
+        argc = functions[f][0]
+        func = functions[f][1]
 
         # sanity check
         if len(stack) < argc:
@@ -299,15 +389,20 @@ class MathExp:
 
         # get typed arguments
         for i in range(argc):
-            argv.insert(0, self.resolve_symbol(symtab, stack.pop()))
+            argv.insert(0, self.resolve_symbol(symtab, stack.pop(), array))
 
         stack.append((MathExp.NUM, func(*argv)))
 
-    def eval(self, symtab={}):
+    def eval(self, symtab={}, array=False):
         """
         Eval the RPN expression.
 
         See http://en.wikipedia.org/wiki/Reverse_Polish_notation
+
+        Args:
+          symtab (map): variable name -> value
+          array (bool): Values are numpy arrays, evaluate the expression
+                        element-wise over all of them at once
         """
         eval_stack = []
 
@@ -319,16 +414,229 @@ class MathExp:
                 eval_stack.append(token)
 
             elif token[0] == MathExp.OP:
-                self.apply_operator(symtab, eval_stack, token[1])
+                self.apply_operator(symtab, eval_stack, token[1], array)
 
             elif token[0] == MathExp.FUNC:
-                self.apply_function(symtab, eval_stack, token[1])
+                self.apply_function(symtab, eval_stack, token[1], array)
 
         if len(eval_stack) == 1:
-            return self.resolve_symbol(symtab, eval_stack[0])
+            return self.resolve_symbol(symtab, eval_stack[0], array)
         else:
             raise Exception('Syntax error')
 
+    def build_tree(self):
+        """
+        Turn the RPN into an expression tree of tuples:
+
+          ("num", value), ("var", name), ("op", op, a, b),
+          ("func", f, [args]) and ("assign", name, value)
+        """
+        stack = []
+
+        for token in self.rpn:
+            if token[0] == MathExp.NUM:
+                stack.append(("num", float(token[1])))
+
+            elif token[0] == MathExp.VAR:
+                stack.append(("var", token[1]))
+
+            elif token[0] == MathExp.OP:
+                if len(stack) < 2:
+                    raise Exception("Syntax error")
+
+                b = stack.pop()
+                a = stack.pop()
+                if token[1] == '=':
+                    if a[0] != "var":
+                        raise Exception("Syntax error")
+                    stack.append(("assign", a[1], b))
+                else:
+                    stack.append(("op", token[1], a, b))
+
+            elif token[0] == MathExp.FUNC:
+                argc = MathExp.functions[token[1]][0]
+                if len(stack) < argc:
+                    raise Exception("Syntax error")
+
+                args = stack[len(stack) - argc:]
+                del stack[len(stack) - argc:]
+                stack.append(("func", token[1], args))
+
+        if len(stack) != 1:
+            raise Exception('Syntax error')
+
+        return stack[0]
+
+    def _generate(self, node, locals, argnames, stmts, array):
+        """
+        Python source of the expression tree `node`. Operands are emitted
+        left to right, which is the order eval() resolves them in, so a
+        variable read after an assignment sees the assigned value.
+
+        Args:
+          locals (map):   variable name -> local name in the generated code
+          argnames (map): variables read before they are assigned -> local
+                          name, these become arguments
+          stmts (list):   receives the statements of the assignments, which
+                          run before the expression
+          array (bool):   generate code for numpy arrays
+        """
+        kind = node[0]
+
+        if kind == "num":
+            return repr(node[1])
+
+        if kind == "var":
+            if node[1] not in locals:
+                locals[node[1]] = argnames[node[1]] = "_v%d" % len(locals)
+            return locals[node[1]]
+
+        if kind == "assign":
+            value = self._generate(node[2], locals, argnames, stmts, array)
+            # a fresh local, reads before the assignment keep the old one
+            local = "_a%d" % len(stmts)
+            stmts.append("%s = %s" % (local, value))
+            stmts.append("_set(_out, %r, %s)" % (node[1], local))
+            locals[node[1]] = local
+            return local
+
+        operands = node[2:] if kind == "op" else node[2]
+        args = [self._generate(arg, locals, argnames, stmts, array) for arg in operands]
+        return MathExp.generate_operation(kind, node[1], args)
+
+    @staticmethod
+    def generate_operation(kind, name, args):
+        """
+        Python source of an "op" or "func" node of the expression tree,
+        see build_tree(). This is the code generator of MathExp.compile()
+        and of MetricSet.compile(), run it in a code_namespace().
+
+        Args:
+          kind (string): "op" or "func"
+          name (string): the operator or function
+          args (list):   Python source of the operands, left to right
+        """
+        if kind == "op":
+            a, b = args
+            if name == '/':
+                # FIXME: see apply_operator() on divide-by-zero
+                return "_div(%s, %s)" % (a, b)
+            if name == '^':
+                return "_pow(%s, %s)" % (a, b)
+            return "(%s %s %s)" % (a, name, b)
+
+        return "_%s(%s)" % (name, ", ".join(args))
+
+    @staticmethod
+    def code_namespace(array):
+        """
+        Returns:
+          map: the globals generated code runs with, the helpers and
+               functions generate_operation() refers to
+        """
+        namespace = {"_set": _set}
+        if array:
+            namespace["_div"] = lambda a, b: a / np.where(b == 0, 1, b)
+            namespace["_pow"] = np.power
+            functions = MathExp.array_functions
+        else:
+            namespace["_div"] = lambda a, b: a / (b if b != 0 else 1)
+            namespace["_pow"] = pow
+            functions = MathExp.functions
+        for name, (argc, func) in functions.items():
+            namespace["_" + name] = func
+
+        return namespace
+
+    def compile(self, array=False):
+        """
+        Compile the expression into a Python function. Compiled functions
+        are cached by expression.
+
+        Args:
+          array (bool): Compile for numpy arrays, see eval()
+
+        Returns:
+          function: takes the values of the variables in `argnames` order
+                    (sorted by name) as positional arguments, and an
+                    optional map `_out` which receives the values of
+                    `=` assignments. Its `argnames` attribute lists the
+                    variables, its `symtab` attribute is the same
+                    function taking a symtab, like eval()
+        """
+        key = (self.source, array)
+        if key in MathExp.compiled:
+            return MathExp.compiled[key]
+
+        tree = self.build_tree()
+
+        # variables that are never read before they are assigned need
+        # no argument, but they must not shadow the ones that do
+        locals = dict()
+        arguments = dict()
+        stmts = []
+        body = self._generate(tree, locals, arguments, stmts, array)
+        argnames = sorted(arguments)
+
+        # scalar results come out as floats, as in resolve_symbol()
+        if not array and tree[0] != "var":
+            body = "float(%s)" % body
+
+        # plain statements, the generated code has to run on Python 3.6
+        params = [arguments[name] for name in argnames] + ["_out=None"]
+        code = "def _compiled(%s):\n" % ", ".join(params)
+        for stmt in stmts:
+            code += "    %s\n" % stmt
+        code += "    return %s\n" % body
+
+        # the symtab flavor looks the arguments up itself, which saves
+        # packing them into a tuple on every call
+        code += "\ndef _symtab(_out):\n"
+        for name in argnames:
+            code += "    %s = _out[%r]\n" % (arguments[name], name)
+        for stmt in stmts:
+            code += "    %s\n" % stmt
+        code += "    return %s\n" % body
+
+        namespace = MathExp.code_namespace(array)
+        exec(compile(code, "<MathExp %s>" % self.source, "exec"), namespace)
+
+        rv = namespace["_compiled"]
+        rv.argnames = tuple(argnames)
+        rv.symtab = namespace["_symtab"]
+        rv.code = code
+
+        MathExp.compiled[key] = rv
+        return rv
+
+    def call(self, symtab={}, array=False):
+        """
+        Same as eval(), through the compiled function
+        """
+        try:
+            func = self.callables[array]
+        except KeyError:
+            func = self.callables[array] = self.compile(array).symtab
+
+        try:
+            return func(symtab)
+        except KeyError as e:
+            raise UnresolvedSymbolError(e.args[0])
+
+    def __getstate__(self):
+        # compiled functions do not pickle, they are rebuilt on demand
+        state = dict(self.__dict__)
+        state["callables"] = {}
+        return state
+
+
+def _set(out, name, value):
+    """Assignment helper of compiled expressions"""
+    if out is not None:
+        out[name] = value
+
+    return value
+
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
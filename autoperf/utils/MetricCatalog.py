@@ -0,0 +1,172 @@
+"""
+Catalogue of derived metric specs.
+
+A spec is a file named after its metric, holding one expression per line
+(see MathExp); empty lines and lines starting with '#' are ignored. The
+first spec directory that has the file wins.
+
+The catalogue scans all spec directories once and parses every spec. The
+parsed expressions are kept for the life of the process and pickled to
+an on-disk cache, where each spec is keyed by the size and mtime of its
+file, so only new or modified specs are parsed again.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+
+from .MathExp import MathExp
+
+# bump this whenever the cache layout or MathExp changes
+FORMAT = 1
+
+logger = logging.getLogger(__name__)
+
+
+class MetricCatalog:
+    # tuple of spec dirs -> catalogue, see get()
+    catalogs = {}
+
+    @classmethod
+    def get(cls, spec_dirs):
+        """The catalogue of `spec_dirs`, shared by the whole process"""
+        key = tuple(spec_dirs)
+        if key not in cls.catalogs:
+            cls.catalogs[key] = cls(spec_dirs)
+
+        return cls.catalogs[key]
+
+    def __init__(self, spec_dirs, cache=None):
+        """
+        Args:
+          spec_dirs (list): directories to search for specs, in order
+          cache (string):   path of the on-disk cache, see cache_path()
+        """
+        self.spec_dirs = list(spec_dirs)
+        self.cache = cache if cache is not None else self.cache_path(self.spec_dirs)
+
+        # metric name -> path of its spec
+        self.paths = dict()
+
+        # path -> (size, mtime, list of expressions or the parse error)
+        self.specs = dict()
+
+        self.scan()
+
+    @staticmethod
+    def cache_path(spec_dirs):
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        digest = hashlib.sha1("\0".join(spec_dirs).encode("utf-8")).hexdigest()
+
+        return os.path.join(base, "autoperf", "specs-%s.pickle" % digest)
+
+    def scan(self):
+        """(Re)scan the spec directories, parse what is not cached"""
+        cached = self._load()
+        cached.update(self.specs)
+
+        self.paths = dict()
+        self.specs = dict()
+        dirty = False
+
+        for spec_dir in self.spec_dirs:
+            try:
+                entries = list(os.scandir(spec_dir))
+            except OSError:
+                continue
+
+            for entry in entries:
+                # python files and caches of the bundled spec package
+                if entry.name in self.paths or entry.name.startswith(("_", ".")):
+                    continue
+
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+
+                self.paths[entry.name] = entry.path
+
+                spec = cached.get(entry.path)
+                if spec is None or spec[:2] != (st.st_size, st.st_mtime_ns):
+                    spec = (st.st_size, st.st_mtime_ns, self._parse(entry.path))
+                    dirty = True
+
+                self.specs[entry.path] = spec
+
+        if dirty or set(cached) != set(self.specs):
+            self._save()
+
+    @staticmethod
+    def _parse(path):
+        """
+        Returns:
+          list: the MathExp of every line, or the Exception parsing failed
+                with
+        """
+        try:
+            exps = []
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+
+                    # ignore empty line
+                    if len(line) == 0:
+                        continue
+
+                    # ignore comments
+                    if line[0] == '#':
+                        continue
+
+                    exps.append(MathExp(line))
+        except Exception as e:
+            return e
+
+        return exps
+
+    def __contains__(self, metric):
+        return metric in self.paths
+
+    def expressions(self, metric):
+        """
+        Returns:
+          list: MathExp of every line of the spec of `metric`. The objects
+                are shared, do not modify them
+        """
+        # the spec may have been written since the last scan
+        if metric not in self.paths:
+            self.scan()
+
+        if metric not in self.paths:
+            raise Exception("Can not find spec for metric `%s`" % metric)
+
+        exps = self.specs[self.paths[metric]][2]
+        if isinstance(exps, Exception):
+            raise Exception("Invalid spec for metric `%s`: %s" % (metric, exps))
+
+        return exps
+
+    def _load(self):
+        try:
+            with open(self.cache, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            return {}
+
+        if not isinstance(data, dict) or data.get("format") != FORMAT:
+            return {}
+
+        return data["specs"]
+
+    def _save(self):
+        tmp = "%s.%d.tmp" % (self.cache, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache), exist_ok=True)
+            with open(tmp, "wb") as f:
+                pickle.dump({"format": FORMAT, "specs": self.specs}, f)
+            os.replace(tmp, self.cache)
+        except (OSError, pickle.PicklingError) as e:
+            logger.debug("Can not write metric spec cache %s: %s", self.cache, e)
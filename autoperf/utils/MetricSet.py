@@ -1,7 +1,9 @@
+import numbers
 import os
 import os.path
 
-from .MathExp import MathExp
+from .MathExp import MathExp, UnresolvedSymbolError
+from .MetricCatalog import MetricCatalog
 
 
 class MetricSet:
@@ -10,12 +12,20 @@ class MetricSet:
         self.interval = {}  # map : nmetric name => sampling interval (for hpctoolkit)
         self.dmetrics = []  # list: name of derived metric
         self.rpns = {}  # map : dmetric name => list of MathExp
+        self.meta = set()  # set : META_* symbols the expressions refer to
+        self.reduced = set()  # set : dmetrics reducing over the thread axis
+
+        # map: (symbols, metadata, array) => compiled metric set, see compile()
+        self.plans = {}
 
         this_dir, this_file = os.path.split(__file__)
 
         # list of string: directories used for derived metric spec
         self.spec_dirs = spec_dirs + [this_dir + "/metric_spec"]
 
+        # parsed specs of all spec dirs
+        self.catalog = MetricCatalog.get(self.spec_dirs)
+
     def is_derived(self, metric):
         natives = ['TIME']
 
@@ -28,30 +38,7 @@ class MetricSet:
         return True
 
     def get_metric_spec(self, metric):
-        for spec_dir in self.spec_dirs:
-            spec_file = spec_dir + "/" + metric
-
-            if not os.path.isfile(spec_file):
-                continue
-
-            contents = []
-            with open(spec_file, "r") as f:
-                for line in f:
-                    line = line.strip()
-
-                    # ignore empty line
-                    if len(line) == 0:
-                        continue
-
-                    # ignore comments
-                    if line[0] == '#':
-                        continue
-
-                    contents.append(line)
-
-            return contents
-
-        raise Exception("Can not find spec for metric `%s`" % metric)
+        return [exp.source for exp in self.catalog.expressions(metric)]
 
     def add_derived_metric(self, metric, interval):
         if metric in self.dmetrics:
@@ -61,15 +48,20 @@ class MetricSet:
             return
 
         exps = []
+        self.plans = {}
 
-        for spec in self.get_metric_spec(metric):
-            exp = MathExp(spec)
+        for exp in self.catalog.expressions(metric):
+            self.meta |= set(v for v in exp.variables if v.startswith("META_"))
 
             variables = [v for v in exp.variables if self.is_derived(v)]
 
             list(map(self.add, variables))
             exps.append(exp)
 
+            # so do the metrics built on top of a reduction
+            if exp.reduces or self.reduced.intersection(variables):
+                self.reduced.add(metric)
+
             metrics = [v for v in exp.variables if not self.is_derived(v)]
 
             self.nmetrics |= set(metrics)
@@ -101,16 +93,259 @@ class MetricSet:
             self.nmetrics.add(metric)
             self.interval[metric] = interval
 
-    def eval(self, symtab):
+    def dependencies(self, metrics):
+        """
+        Returns:
+          set: the non-derived symbols (native metrics and META_*) the
+               derived `metrics` refer to, directly or indirectly
+        """
+        rv = set()
+        seen = set()
+        stack = list(metrics)
+        while stack:
+            metric = stack.pop()
+            if metric in seen:
+                continue
+            seen.add(metric)
+
+            if metric not in self.rpns:
+                rv.add(metric)
+                continue
+
+            for rpn in self.rpns[metric]:
+                stack.extend(rpn.variables)
+
+        return rv
+
+    def eval(self, symtab, array=False, targets=None):
+        """
+        Evaluate all derived metrics.
+
+        Args:
+          symtab (map):   metric name -> value, updated with the results
+          array (bool):   Values are numpy arrays (columns), see MathExp.eval
+          targets (list): Only evaluate these derived metrics, and what
+                          they depend on. The symtab is left untouched
+
+        Returns:
+          map: derived metric name -> value
+        """
+        meta = dict((m, symtab[m]) for m in self.meta if m in symtab)
+
+        return self.compile(symtab.keys(), meta, array, targets)(symtab)
+
+    def eval_reference(self, symtab, array=False):
+        """
+        eval(), one expression at a time. Slow, only used for validation.
+        """
         rv = {}  # map: dmetric name => value
         for metric in self.dmetrics:
             if metric in symtab:
                 val = symtab[metric]
             else:
                 for rpn in self.rpns[metric]:
-                    val = rpn.eval(symtab)
+                    val = rpn.eval(symtab, array)
 
             rv[metric] = val
             symtab[metric] = val
 
         return rv
+
+    def compile(self, symbols, meta={}, array=False, targets=None):
+        """
+        Compile all derived metrics into a single Python function.
+
+        The expressions of all metrics are merged into one DAG:
+        - metadata values and constant subexpressions are folded
+        - identical subexpressions are computed once
+        - the rest is evaluated in topological order
+
+        Args:
+          symbols (iterable): names the symtab will hold
+          meta (map):         META_* values to fold in as constants
+          array (bool):       see MathExp.eval
+          targets (list):     see eval()
+
+        Returns:
+          function: takes a symtab like eval(), with the same results and
+                    side effects
+        """
+        if targets is not None:
+            targets = tuple(targets)
+
+        key = (frozenset(symbols), tuple(sorted(meta.items())), array, targets)
+        if key in self.plans:
+            return self.plans[key]
+
+        dag = _DAG(array)
+
+        # symbol name -> node, as the symtab evolves during eval()
+        env = dict()
+        for name in key[0]:
+            value = meta.get(name)
+            if isinstance(value, numbers.Real) and not isinstance(value, bool):
+                env[name] = dag.num(float(value))
+            else:
+                env[name] = dag.input(name)
+
+        writes = []  # (name, node) stored into the symtab, in order
+        results = []  # (dmetric, node)
+        for metric in self.dmetrics:
+            if metric not in env:
+                try:
+                    for rpn in self.rpns[metric]:
+                        node = dag.add(rpn.build_tree(), env, writes)
+                except UnresolvedSymbolError:
+                    # only fatal if one of the targets needs it
+                    if targets is None or metric in targets:
+                        raise
+                    continue
+
+                env[metric] = node
+                writes.append((metric, node))
+
+            results.append((metric, env[metric]))
+
+        if targets is not None:
+            writes = []
+            results = [(metric, node) for metric, node in results if metric in targets]
+
+        func = dag.compile(writes, results)
+
+        self.plans[key] = func
+        return func
+
+    def __getstate__(self):
+        # compiled plans do not pickle, they are rebuilt on demand
+        state = dict(self.__dict__)
+        state["plans"] = {}
+        return state
+
+
+class _DAG:
+    """
+    Expression DAG of a MetricSet. Nodes are hash-consed, so identical
+    subexpressions map to the same node, and every node is created after
+    its operands, so creation order is a topological order.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.nodes = []  # list of node keys
+        self.ids = dict()  # node key -> position in nodes
+
+        if array:
+            self.operators = MathExp.array_operators
+            self.functions = MathExp.array_functions
+        else:
+            self.operators = MathExp.operators
+            self.functions = MathExp.functions
+
+    def _node(self, key):
+        if key not in self.ids:
+            self.ids[key] = len(self.nodes)
+            self.nodes.append(key)
+
+        return self.ids[key]
+
+    def num(self, value):
+        return self._node(("num", value))
+
+    def input(self, name):
+        return self._node(("in", name))
+
+    def add(self, tree, env, writes):
+        """
+        Add the MathExp expression `tree` (see MathExp.build_tree) and
+        return its node. Variables resolve through `env`, which `=`
+        updates; assignments are recorded in `writes`.
+        """
+        kind = tree[0]
+
+        if kind == "num":
+            return self.num(tree[1])
+
+        if kind == "var":
+            if tree[1] not in env:
+                raise UnresolvedSymbolError(tree[1])
+            return env[tree[1]]
+
+        if kind == "assign":
+            node = self.add(tree[2], env, writes)
+            env[tree[1]] = node
+            writes.append((tree[1], node))
+            return node
+
+        if kind == "op":
+            args = [self.add(tree[2], env, writes), self.add(tree[3], env, writes)]
+            op = self.operators[tree[1]][3]
+        else:
+            args = [self.add(arg, env, writes) for arg in tree[2]]
+            op = self.functions[tree[1]][1]
+
+        # fold constants, with the scalar semantics of MathExp.eval
+        if all(self.nodes[a][0] == "num" for a in args):
+            values = [self.nodes[a][1] for a in args]
+            if tree[1] == '/' and values[1] == 0:
+                values[1] = 1
+            try:
+                return self.num(float(op(*values)))
+            except (ArithmeticError, ValueError):
+                pass
+
+        return self._node((kind, tree[1]) + tuple(args))
+
+    def _expr(self, node):
+        key = self.nodes[node]
+        if key[0] == "num":
+            return repr(key[1])
+
+        return "_n%d" % node
+
+    def compile(self, writes, results):
+        # only emit what the outputs depend on
+        live = set()
+        stack = [node for name, node in writes + results]
+        while stack:
+            node = stack.pop()
+            if node not in live:
+                live.add(node)
+                stack.extend(a for a in self.nodes[node][2:] if isinstance(a, int))
+
+        lines = ["def _metricset(_symtab):"]
+        for node in sorted(live):
+            key = self.nodes[node]
+            if key[0] == "num":
+                continue
+
+            if key[0] == "in":
+                expr = "_symtab[%r]" % key[1]
+            else:
+                # the very code MathExp.compile() generates
+                expr = MathExp.generate_operation(key[0], key[1],
+                                                  [self._expr(a) for a in key[2:]])
+
+            lines.append("    _n%d = %s" % (node, expr))
+
+        # scalar results come out as floats, as in MathExp.resolve_symbol()
+        def result(node):
+            if self.array or self.nodes[node][0] == "in":
+                return self._expr(node)
+            return "float(%s)" % self._expr(node)
+
+        for name, node in writes:
+            lines.append("    _symtab[%r] = %s" % (name, result(node)))
+        lines.append("    return {%s}" % ", ".join("%r: %s" % (name, result(node))
+                                                   for name, node in results))
+
+        namespace = MathExp.code_namespace(self.array)
+        exec(compile("\n".join(lines) + "\n", "<MetricSet>", "exec"), namespace)
+        func = namespace["_metricset"]
+
+        def run(symtab):
+            try:
+                return func(symtab)
+            except KeyError as e:
+                raise UnresolvedSymbolError(e.args[0])
+
+        return run
@@ -0,0 +1,111 @@
+"""
+Bounded-memory running statistics.
+
+OnlineStats keeps, for a growing number of groups, the count, sum, min,
+max, mean and sum of squared deviations of the samples seen so far
+(Welford's algorithm). Samples are added a batch at a time, at most one
+per group, and dropped right away. The slots of a group that never got a
+sample count as zeros; they are merged in at the end with Chan's
+pairwise formula, so the results match SparseCube.reduce().
+"""
+
+import numpy as np
+
+
+class OnlineStats:
+    def __init__(self, shape=()):
+        """
+        Args:
+          shape (tuple): shape of a single sample, e.g. (metrics,)
+        """
+        self.shape = tuple(shape)
+        self.size = 0  # number of groups in use
+
+        self.count = np.zeros(0, dtype=np.int64)
+        self.total = np.zeros((0,) + self.shape)
+        self.high = np.zeros((0,) + self.shape)
+        self.low = np.zeros((0,) + self.shape)
+        self.mean = np.zeros((0,) + self.shape)
+        self.square = np.zeros((0,) + self.shape)  # sum of squared deviations
+
+    def _grow(self, size):
+        if size <= len(self.count):
+            return
+
+        capacity = max(size, 2 * len(self.count), 16)
+        extra = capacity - len(self.count)
+
+        def pad(array, value):
+            return np.concatenate([array, np.full((extra,) + array.shape[1:], value,
+                                                  dtype=array.dtype)])
+
+        self.count = pad(self.count, 0)
+        self.total = pad(self.total, 0.0)
+        self.high = pad(self.high, -np.inf)
+        self.low = pad(self.low, np.inf)
+        self.mean = pad(self.mean, 0.0)
+        self.square = pad(self.square, 0.0)
+
+    def add(self, groups, values):
+        """
+        Add a batch of samples.
+
+        Args:
+          groups (array): group of every sample, no group twice
+          values (array): [samples, ...] values
+        """
+        groups = np.asarray(groups, dtype=np.intp)
+        values = np.asarray(values, dtype=np.float64)
+        if not len(groups):
+            return
+
+        self.size = max(self.size, int(groups.max()) + 1)
+        self._grow(self.size)
+
+        self.count[groups] += 1
+        self.total[groups] += values
+        self.high[groups] = np.maximum(self.high[groups], values)
+        self.low[groups] = np.minimum(self.low[groups], values)
+
+        # Welford
+        count = self.count[groups].reshape((-1,) + (1,) * len(self.shape))
+        delta = values - self.mean[groups]
+        self.mean[groups] += delta / count
+        self.square[groups] += delta * (values - self.mean[groups])
+
+    def result(self, cells, size=None):
+        """
+        Statistics over `cells` slots per group, the slots without a
+        sample being zeros.
+
+        Args:
+          cells (int): number of slots in every group
+          size (int):  number of groups to report, at least the ones used
+
+        Returns:
+          map: "sum", "max", "min", "std" and "mean" -> [groups, ...]
+               float64 array
+        """
+        size = self.size if size is None else size
+        self._grow(size)
+
+        count = self.count[:size].reshape((-1,) + (1,) * len(self.shape))
+        total = self.total[:size].copy()
+        high = self.high[:size]
+        low = self.low[:size]
+
+        # implicit zeros take part in max/min as well
+        missing = count < cells
+        high = np.where(missing, np.maximum(high, 0), high)
+        low = np.where(missing, np.minimum(low, 0), low)
+
+        # Chan: merge the samples (count, mean, square) with the zeros
+        # (cells - count, 0, 0)
+        mean = self.mean[:size]
+        square = self.square[:size] + mean * mean * count * (cells - count) / cells
+
+        return {"sum": total,
+                "max": high,
+                "min": low,
+                "std": np.sqrt(square / cells),
+                "mean": total / cells}
@@ -1,10 +1,15 @@
 import gzip
+import re
 import sys
-from itertools import product
+from collections.abc import Mapping, MutableMapping, Sequence
 from struct import *
 
 import numpy as np
 
+from . import PPKCache
+from . import PPKWriter
+from . import SparseCube
+from .OnlineStats import OnlineStats
 from .metadata import *
 
 
@@ -48,6 +53,76 @@ class InvalidEventError(_Error):
         _Error.__init__(self, "Failed to parse event name `%s`" % name)
 
 
+class _IndexedList(list):
+    """
+    A list of names with a dict index on the side, so `in` and index()
+    take constant time. index() finds the first occurrence, as usual.
+    """
+
+    def __init__(self, iterable=()):
+        list.__init__(self)
+        self.positions = {}  # name -> first position
+        self.extend(iterable)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def index(self, name, *args):
+        if args:
+            return list.index(self, name, *args)
+
+        try:
+            return self.positions[name]
+        except KeyError:
+            raise ValueError("%r is not in list" % (name,))
+
+    def append(self, name):
+        self.positions.setdefault(name, len(self))
+        list.append(self, name)
+
+    def extend(self, names):
+        for name in names:
+            self.append(name)
+
+    def __iadd__(self, names):
+        self.extend(names)
+        return self
+
+    def _reindex(self):
+        self.positions = {}
+        for i, name in enumerate(self):
+            self.positions.setdefault(name, i)
+
+    def __reduce__(self):
+        return (_IndexedList, (list(self),))
+
+
+def _reindexing(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        rv = method(self, *args)
+        self._reindex()
+        return rv
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ("__setitem__", "__delitem__", "insert", "remove", "pop",
+              "clear", "sort", "reverse"):
+    setattr(_IndexedList, _name, _reindexing(_name))
+
+
+# patterns used to take function names apart, see FunctionName
+_ADDRESS_RE = re.compile(r"^0x[0-9a-f]+")
+_TYPE_RE = re.compile(r"^\[(.*?)\]")
+_LOCATION_RE = re.compile(r"\[\{(.*?)\}(.*?)\]$")
+_INSTRU_SIGNATURE_RE = re.compile(r"^(.*?)(\[\{.*?\} .*?\])*$")
+_UNRESOLVED_RE = re.compile(r"^\[.*?\].* UNRESOLVED \[[^\[\]]*?\]$")
+_SIGNATURE_RE = re.compile(r"\]([^\[\]]*?)(\[\{.*?\}.*?\])*$")
+
+
 class FunctionName:
     """
     This represents a full qualified function name in the profile data,
@@ -62,8 +137,22 @@ class FunctionName:
     address looks like '0x12345678'.
 
     This makes the code messy. Be careful.
+
+    FunctionName objects are never modified once built, so use get() to
+    share a single instance per distinct name within the process.
     """
 
+    # name -> FunctionName
+    cache = {}
+
+    @classmethod
+    def get(cls, name):
+        """Parse `name`, or return the instance parsed earlier"""
+        try:
+            return cls.cache[name]
+        except KeyError:
+            return cls.cache.setdefault(name, cls(name))
+
     def __init__(self, name):
         self.fullname = name
 
@@ -85,7 +174,7 @@ class FunctionName:
             return
 
         # unresolved address
-        match = re.match(r"^0x[0-9a-f]+", name)
+        match = _ADDRESS_RE.match(name)
         if match:
             self.type = "SAMPLE"
             self.filename = None
@@ -95,7 +184,7 @@ class FunctionName:
             return
 
         # CALLSITE, UNWIND, CONTEXT, SAMPLE, SUMMARY
-        match = re.search(r"^\[(.*?)\]", name)
+        match = _TYPE_RE.search(name)
         if match:
             self.type = match.group(1)
         else:
@@ -106,7 +195,7 @@ class FunctionName:
         # [{filename} {num}-{num}] for instrumented profile
         # [{filename} {num}] for sampling
         # [{filename}] for SUMMARY
-        match = re.search(r"\[\{(.*?)\}(.*?)\]$", name)
+        match = _LOCATION_RE.search(name)
         if match:
             self.filename = match.group(1)
             self.lineno = match.group(2)
@@ -117,18 +206,18 @@ class FunctionName:
         # get function signature
         if self.type == "INSTRU":
             # <signature> [{filename} {num}-{num}]
-            match = re.search(r"^(.*?)(\[\{.*?\} .*?\])*$", name)
+            match = _INSTRU_SIGNATURE_RE.search(name)
             self.signature = match.group(1).strip()
         else:
             while True:
                 # [...] ... UNRESOLVED [...]
-                match = re.search(r"^\[.*?\].* UNRESOLVED \[[^\[\]]*?\]$", name)
+                match = _UNRESOLVED_RE.search(name)
                 if match:
                     self.signature = 'UNRESOLVED'
                     break
 
                 # ...] <signature> [{filename} ...
-                match = re.search(r"\]([^\[\]]*?)(\[\{.*?\}.*?\])*$", name)
+                match = _SIGNATURE_RE.search(name)
                 if match:
                     self.signature = match.group(1).strip()
                     break
@@ -141,6 +230,43 @@ class FunctionName:
             self.resolved = True
 
 
+class _Hotspots:
+    """
+    All hotspot regexes combined into a single alternation, with the
+    verdict memoized per filename. Use get() to share one instance per
+    list of hotspots.
+    """
+
+    # tuple of hotspot regexes -> _Hotspots
+    cache = {}
+
+    @classmethod
+    def get(cls, hotspots):
+        key = tuple(hotspots)
+        try:
+            return cls.cache[key]
+        except KeyError:
+            return cls.cache.setdefault(key, cls(key))
+
+    def __init__(self, hotspots):
+        if hotspots:
+            self.regex = re.compile("|".join("(?:%s)" % h for h in hotspots))
+        else:
+            self.regex = None
+
+        self.verdicts = {}  # filename -> bool
+
+    def match(self, filename):
+        if self.regex is None:
+            return False
+
+        try:
+            return self.verdicts[filename]
+        except KeyError:
+            return self.verdicts.setdefault(filename,
+                                            self.regex.search(filename) is not None)
+
+
 class Event:
     """
     This represents an event that we attach collected data to. The
@@ -201,7 +327,7 @@ class Event:
         self.groups = []
         self.fullname = fullname
         self.shortname = None
-        self.callstack = [FunctionName(s.strip()) for s in fullname.split("=>")]
+        self.callstack = [FunctionName.get(s.strip()) for s in fullname.split("=>")]
 
         # check whether this is a derived event
         if len(self.callstack) == 1:
@@ -224,6 +350,7 @@ class Event:
         # take it as our short name
         first_resolved = None
         first_hotspot = None
+        spots = _Hotspots.get(hotspots)
         for f in reversed(self.callstack):
             if f.resolved:
                 # find out the first resolved site
@@ -233,10 +360,8 @@ class Event:
                 # find out the first hotspot site, which is not
                 # necessarily the first resolved site
                 if first_hotspot is None and f.filename is not None:
-                    for spot in hotspots:
-                        match = re.search(spot, f.filename)
-                        if match:
-                            first_hotspot = f.signature
+                    if spots.match(f.filename):
+                        first_hotspot = f.signature
 
         # favor the hotspot
         if first_hotspot:
@@ -259,7 +384,7 @@ class Node:
         self.contexts = {}  # contextId -> Context
 
     def addContext(self, contextId):
-        if contextId not in list(self.contexts.keys()):
+        if contextId not in self.contexts:
             self.contexts[contextId] = Context(self.ppk, self.nodeId, contextId)
             self.ppk.contexts.append(self.contexts[contextId])
 
@@ -275,9 +400,12 @@ class Context:
         self.threads = {}  # threadId -> Thread
 
     def addThread(self, threadId):
-        if threadId not in list(self.threads.keys()):
+        if threadId not in self.threads:
             self.threads[threadId] = Thread(self.ppk, self.nodeId, \
                                             self.contextId, threadId)
+            self.threads[threadId].index = len(self.ppk.threads)
+            self.ppk.threadIndex[(self.nodeId, self.contextId, threadId)] = \
+                len(self.ppk.threads)
             self.ppk.threads.append(self.threads[threadId])
 
         return self.threads[threadId]
@@ -289,6 +417,7 @@ class Thread:
         self.nodeId = nodeId
         self.contextId = contextId
         self.threadId = threadId
+        self.index = None  # position in ppk.threads
 
         # raw data
         self.metadata = {}  # thread specific metadata
@@ -321,7 +450,7 @@ class Thread:
         self.userEventProfiles[name] = profile
 
     def getDataPoint(self, event, metric, flavor):
-        if event not in list(self.functionProfiles.keys()):
+        if event not in self.functionProfiles:
             raise NoSuchEventError(event)
 
         profile = self.functionProfiles[event]
@@ -332,6 +461,9 @@ class Thread:
 class Profile:
     """A generic profile data container"""
 
+    __slots__ = ("ppk", "nodeId", "contextId", "threadId", "fullname", "metrics",
+                 "numCalls", "numSubr", "exclusive", "inclusive")
+
     def __init__(self, ppk, nodeId, contextId, threadId, name):
         self.ppk = ppk
         self.nodeId = nodeId
@@ -419,6 +551,8 @@ class FunctionProfile(Profile):
       A => ... => [CONTEXT] B => ... => [UNWIND] C
     """
 
+    __slots__ = ("functionId", "event", "groups", "shortname", "isDerived")
+
     def __init__(self, ppk, nodeId, contextId, threadId, functionId):
         self.functionId = functionId
         self.event = ppk.events[functionId]
@@ -429,6 +563,315 @@ class FunctionProfile(Profile):
         Profile.__init__(self, ppk, nodeId, contextId, threadId, self.event.fullname)
 
 
+class ProfileTable:
+    """
+    Struct-of-arrays storage used by compact PPKs. Every profile is a row;
+    metric values live in two [rows, metrics] arrays of ppk.valueType
+    indexed by the position of the metric in ppk.metrics. Columns of metrics added
+    later (e.g. derived metrics) are allocated on first write; until then
+    rows behave like the dicts of a Profile that lack the metric.
+
+    `function` holds the event id for raw profiles and the aggEvents
+    index for aggregated ones.
+    """
+
+    def __init__(self, ppk):
+        self.ppk = ppk
+
+        self.thread = np.zeros(0, dtype=np.int32)  # index into ppk.threads
+        self.function = np.zeros(0, dtype=np.int32)
+        self.calls = np.zeros(0, dtype=ppk.countType)
+        self.subr = np.zeros(0, dtype=ppk.countType)
+        self.values = [np.zeros((0, len(ppk.metrics)), dtype=ppk.valueType),  # PPK.EXCLUSIVE
+                       np.zeros((0, len(ppk.metrics)), dtype=ppk.valueType)]  # PPK.INCLUSIVE
+
+        self.pending = []  # rows appended since the last finalize()
+
+    def __len__(self):
+        return len(self.thread)
+
+    @property
+    def exclusive(self):
+        return self.values[PPK.EXCLUSIVE]
+
+    @property
+    def inclusive(self):
+        return self.values[PPK.INCLUSIVE]
+
+    def append(self, thread, function, calls, subr, exclusive, inclusive):
+        """Queue rows, they become visible after finalize()"""
+        ppk = self.ppk
+        self.pending.append((np.full(len(function), thread, dtype=np.int32),
+                             np.asarray(function, dtype=np.int32),
+                             _counts(calls, ppk.countType),
+                             _counts(subr, ppk.countType),
+                             np.asarray(exclusive, dtype=ppk.valueType),
+                             np.asarray(inclusive, dtype=ppk.valueType)))
+
+    def finalize(self):
+        if not self.pending:
+            return
+
+        width = len(self.ppk.metrics)
+        columns = list(zip(*self.pending))
+        self.thread = np.concatenate(columns[0])
+        self.function = np.concatenate(columns[1])
+        self.calls = np.concatenate(columns[2])
+        self.subr = np.concatenate(columns[3])
+        self.values = [np.concatenate(columns[4]).reshape(-1, width),
+                       np.concatenate(columns[5]).reshape(-1, width)]
+        self.pending = []
+
+    def adopt(self, thread, function, calls, subr, exclusive, inclusive):
+        """
+        Take over existing columns as they are, e.g. memory-mapped ones.
+        Columns of another precision than the PPK's are converted.
+        """
+        ppk = self.ppk
+        self.thread = thread
+        self.function = function
+        self.calls = _counts(calls, ppk.countType)
+        self.subr = _counts(subr, ppk.countType)
+        self.values = [np.asarray(exclusive, dtype=ppk.valueType),
+                       np.asarray(inclusive, dtype=ppk.valueType)]
+
+    def column(self, metric):
+        if metric not in self.ppk.metrics:
+            raise KeyError(metric)
+
+        return self.ppk.metrics.index(metric)
+
+    def writable(self, flavor):
+        """
+        The value array of `flavor`, widened to all metrics of the PPK
+        and copied if it is read-only (memory-mapped)
+        """
+        array = self.values[flavor]
+        missing = len(self.ppk.metrics) - array.shape[1]
+        if missing > 0:
+            array = np.hstack([array, np.zeros((len(array), missing), dtype=array.dtype)])
+        elif not array.flags.writeable:
+            array = np.array(array)
+
+        self.values[flavor] = array
+        return array
+
+    def padded(self, flavor):
+        """The value array of `flavor` with zero columns for unset metrics"""
+        array = self.values[flavor]
+        missing = len(self.ppk.metrics) - array.shape[1]
+        if missing > 0:
+            array = np.hstack([array, np.zeros((len(array), missing), dtype=array.dtype)])
+
+        return array
+
+    def bounds(self):
+        """
+        Generator. Yield (thread index, begin, end) for every run of
+        contiguous rows owned by the same thread
+        """
+        changes = (np.flatnonzero(np.diff(self.thread)) + 1).tolist()
+        for begin, end in zip([0] + changes, changes + [len(self)]):
+            if begin < end:
+                yield int(self.thread[begin]), begin, end
+
+
+def _counts(values, dtype):
+    """Call or subroutine counts as `dtype`, rounded if that is integral"""
+    values = np.asarray(values)
+    if np.issubdtype(dtype, np.integer) and not np.issubdtype(values.dtype, np.integer):
+        values = np.rint(values)
+
+    return values.astype(dtype, copy=False)
+
+
+class _MetricRow(MutableMapping):
+    """metric name -> value mapping over one row of a ProfileTable"""
+
+    __slots__ = ("table", "flavor", "row")
+
+    def __init__(self, table, flavor, row):
+        self.table = table
+        self.flavor = flavor
+        self.row = row
+
+    def __getitem__(self, metric):
+        col = self.table.column(metric)
+        array = self.table.values[self.flavor]
+        if col >= array.shape[1]:
+            raise KeyError(metric)
+
+        return float(array[self.row, col])
+
+    def __setitem__(self, metric, value):
+        col = self.table.column(metric)
+        self.table.writable(self.flavor)[self.row, col] = value
+
+    def __delitem__(self, metric):
+        raise TypeError("metrics can not be removed from a profile")
+
+    def __iter__(self):
+        return iter(self.table.ppk.metrics[:len(self)])
+
+    def __len__(self):
+        return self.table.values[self.flavor].shape[1]
+
+
+class ProfileView:
+    """
+    Lightweight stand-in for Profile, reading and writing row `row` of
+    a ProfileTable. Views are created on access and own no data.
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def ppk(self):
+        return self.table.ppk
+
+    @property
+    def metrics(self):
+        return self.table.ppk.metrics
+
+    @property
+    def thread(self):
+        return self.table.ppk.threads[self.table.thread[self.row]]
+
+    @property
+    def nodeId(self):
+        return self.thread.nodeId
+
+    @property
+    def contextId(self):
+        return self.thread.contextId
+
+    @property
+    def threadId(self):
+        return self.thread.threadId
+
+    @property
+    def fullname(self):
+        return self.table.ppk.aggEvents[self.table.function[self.row]]
+
+    @property
+    def numCalls(self):
+        return float(self.table.calls[self.row])
+
+    @numCalls.setter
+    def numCalls(self, value):
+        if not self.table.calls.flags.writeable:
+            self.table.calls = np.array(self.table.calls)
+        self.table.calls[self.row] = value
+
+    @property
+    def numSubr(self):
+        return float(self.table.subr[self.row])
+
+    @numSubr.setter
+    def numSubr(self, value):
+        if not self.table.subr.flags.writeable:
+            self.table.subr = np.array(self.table.subr)
+        self.table.subr[self.row] = value
+
+    @property
+    def exclusive(self):
+        return _MetricRow(self.table, PPK.EXCLUSIVE, self.row)
+
+    @property
+    def inclusive(self):
+        return _MetricRow(self.table, PPK.INCLUSIVE, self.row)
+
+    getDataPoint = Profile.getDataPoint
+    updateDerivedMetric = Profile.updateDerivedMetric
+
+
+class FunctionProfileView(ProfileView):
+    """Lightweight stand-in for FunctionProfile, see ProfileView"""
+
+    __slots__ = ()
+
+    @property
+    def functionId(self):
+        return int(self.table.function[self.row])
+
+    @property
+    def event(self):
+        return self.table.ppk.events[self.table.function[self.row]]
+
+    @property
+    def fullname(self):
+        return self.event.fullname
+
+    @property
+    def groups(self):
+        return self.event.groups
+
+    @property
+    def shortname(self):
+        return self.event.shortname
+
+    @property
+    def isDerived(self):
+        return self.event.isDerived
+
+
+class _ProfileRows(Sequence):
+    """ppk.functionProfiles of a compact PPK: views over all table rows"""
+
+    def __init__(self, table, view):
+        self.table = table
+        self.view = view
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.view(self.table, row) for row in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        return self.view(self.table, i)
+
+
+class _ThreadProfiles(Mapping):
+    """
+    thread.functionProfiles / thread.aggProfiles of a compact PPK: name ->
+    view over the rows [begin, end) of a table
+    """
+
+    def __init__(self, table, view, begin, end):
+        self.table = table
+        self.view = view
+        self.begin = begin
+        self.end = end
+        self.index = None  # name -> row, built on first lookup
+
+    def _index(self):
+        if self.index is None:
+            self.index = dict()
+            for row in range(self.begin, self.end):
+                self.index[self.view(self.table, row).fullname] = row
+
+        return self.index
+
+    def __getitem__(self, name):
+        return self.view(self.table, self._index()[name])
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+
 class UserEventProfile:
     def __init__(self, ppk, userEventId, nodeId, contextId, threadId):
         self.ppk = ppk
@@ -446,6 +889,160 @@ class UserEventProfile:
         self.sumSquared = 0
 
 
+class _BufferReader:
+    """
+    Reads the PPK wire format out of the fully decompressed file. Every
+    read returns a zero-copy memoryview into the buffer.
+    """
+
+    def __init__(self, filename):
+        f = gzip.open(filename, 'rb')
+        self.contents = f.read()
+        f.close()
+
+        self.view = memoryview(self.contents)
+        self.pos = 0  # read position pointer
+
+    def read(self, size):
+        rv = self.view[self.pos:self.pos + size]
+        self.pos += size
+
+        return rv
+
+    def skip(self, size):
+        self.pos += size
+
+    def atEnd(self):
+        return self.pos >= len(self.contents)
+
+    def close(self):
+        self.view = None
+        self.contents = None
+
+
+class _StreamReader:
+    """
+    Reads the PPK wire format while decompressing the file in chunks of
+    `bufsize` bytes, so the decompressed contents never have to be in
+    memory at once. Only a single read larger than `bufsize` grows the
+    window beyond that.
+    """
+
+    def __init__(self, filename, bufsize):
+        self.filename = filename
+        self.file = gzip.open(filename, 'rb')
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+        self.start = 0  # read position inside the buffer
+        self.pos = 0  # read position in the decompressed stream
+
+    def _fill(self, size):
+        """Make sure at least `size` unread bytes are buffered"""
+        missing = size - (len(self.buffer) - self.start)
+        if missing <= 0:
+            return True
+
+        # drop what has been consumed before growing the window
+        del self.buffer[:self.start]
+        self.start = 0
+
+        while missing > 0:
+            chunk = self.file.read(max(missing, self.bufsize))
+            if not chunk:
+                return False
+            self.buffer += chunk
+            missing -= len(chunk)
+
+        return True
+
+    def read(self, size):
+        if not self._fill(size):
+            raise InvalidPPKError(self.filename)
+
+        rv = bytes(self.buffer[self.start:self.start + size])
+        self.start += size
+        self.pos += size
+
+        return rv
+
+    def skip(self, size):
+        while size > 0:
+            step = min(size, self.bufsize)
+            self.read(step)
+            size -= step
+
+    def atEnd(self):
+        return not self._fill(1)
+
+    def close(self):
+        self.file.close()
+        self.buffer = None
+
+
+class _SeekableReader:
+    """
+    Reads the PPK wire format straight from the gzip stream, with random
+    access by offset into the decompressed contents. Seeking backwards
+    restarts decompression, so visit offsets in increasing order when
+    possible.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = gzip.open(filename, 'rb')
+
+    def read(self, size):
+        rv = self.file.read(size)
+        if len(rv) != size:
+            raise InvalidPPKError(self.filename)
+
+        return rv
+
+    def skip(self, size):
+        self.file.seek(size, 1)
+
+    def seek(self, pos):
+        self.file.seek(pos)
+
+    def tell(self):
+        return self.file.tell()
+
+    def atEnd(self):
+        return self.file.read(1) == b''
+
+    def close(self):
+        self.file.close()
+
+
+class _LazyThreads(Sequence):
+    """
+    ppk.threads of a lazy PPK. Threads are materialized, together with
+    their metadata and profiles, the first time they are accessed.
+    """
+
+    def __init__(self, ppk, ids):
+        self.ppk = ppk
+        self.ids = ids  # list of (nodeId, contextId, threadId)
+        self.loaded = [None] * len(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        if self.loaded[i] is None:
+            self.loaded[i] = self.ppk._materializeThread(i)
+
+        return self.loaded[i]
+
+
 class PPK:
     """
     PPK file parser which mimic the implementation in
@@ -464,42 +1061,334 @@ class PPK:
     EXCLUSIVE = 0
     INCLUSIVE = 1
 
-    def __init__(self, filename, hotspots):
-        self.pos = 0  # r/w position pointer
+    # default chunk size of the streaming reader
+    BUFSIZE = 4 << 20
+
+    # populateAggData() keeps sparser cubes as SparseCube
+    SPARSE_DENSITY = 0.25
+
+    # precision -> (dtype of metric values, dtype of call counts)
+    PRECISIONS = {
+        "double": (np.float64, np.float64),
+        "single": (np.float32, np.int64),
+    }
+
+    def __init__(self, filename, hotspots, decoder="bulk", stream=False,
+                 bufsize=BUFSIZE, cache=False, compact=False, lazy=False,
+                 precision="double", online=False, metricSet=None):
+        """
+        Args:
+          filename (string): Path to the .ppk file
+          hotspots (list):   Regexes of source files we are interested in
+          decoder (string):  "bulk" decodes every thread block as a single
+                             numpy view; "reference" decodes value by
+                             value and is kept for validation only
+          stream (bool):     Decompress the file in chunks of `bufsize`
+                             bytes instead of reading it all at once
+          bufsize (int):     Chunk size of the streaming reader
+          cache (bool):      Load from / save to the columnar sidecar
+                             cache, see PPKCache
+          compact (bool):    Keep all profiles in a ProfileTable and hand
+                             out views instead of one object per profile
+          lazy (bool):       Only parse the header and the metric, group,
+                             event and user event tables up front; threads
+                             are read when first accessed. The offsets of
+                             all thread blocks are persisted next to the
+                             PPK, see PPKCache.load_index(). Can not be
+                             combined with `cache` or `compact`
+          precision (string): "double", or "single" to store metric values
+                             as float32 and call counts as exact int64.
+                             Covers the aggregated cubes and, in compact
+                             mode, the raw profiles. Statistics are always
+                             accumulated in float64
+          online (bool):     Fold every thread block into running
+                             statistics as it is decoded and drop its
+                             profiles. Only the SUM, MAX, MIN, STD and MEAN
+                             aggregated arrays are populated, with memory
+                             bounded per event, see _foldThread(). User
+                             event profiles are skipped; every thread
+                             still gets its Thread object, with its ids
+                             and metadata. Threads
+                             outside the node/context/thread bounding box,
+                             which populateAggData() leaves out, are
+                             included. Can not be combined with `cache`,
+                             `compact` or `lazy`
+          metricSet (object): With `online`, the MetricSet whose derived
+                             metrics are evaluated on every thread before
+                             it is folded in; thread-axis reductions are
+                             not supported
+        """
+        if lazy and (cache or compact):
+            raise Exception("Lazy PPK loading can not be combined with cache or compact")
+
+        if online and (cache or compact or lazy):
+            raise Exception("Online PPK statistics can not be combined with cache, compact or lazy")
+
+        self._setup(filename, hotspots, decoder, compact, lazy, precision)
+
+        if online:
+            self._setupOnline(metricSet)
+
+        if cache:
+            cached = PPKCache.load(filename)
+            if cached is not None:
+                self._loadColumns(*cached)
+                self._finalizeCompact()
+                return
+
+        if lazy:
+            self.reader = _SeekableReader(filename)
+            try:
+                self._parseLazy()
+            except Exception:
+                self.reader.close()
+                raise
+            return
+
+        if stream:
+            self.reader = _StreamReader(filename, bufsize)
+        else:
+            self.reader = _BufferReader(filename)
+
+        try:
+            self._parse()
+        finally:
+            self.reader.close()
+            self.reader = None
+
+        self._finalizeCompact()
+
+        if cache:
+            PPKCache.save(filename, *self._saveColumns())
+
+    @classmethod
+    def fromColumns(cls, header, columns, hotspots, compact=False, precision="double"):
+        """
+        Create a PPK out of tables and columns laid out like the ones of
+        PPKCache, see also PPKBuilder. Rows of each thread must be
+        contiguous and in thread order.
+        """
+        columns = dict((name, np.asarray(columns[name], dtype=dtype))
+                       for name, dtype in PPKCache.COLUMNS.items())
+        columns["fp_exclusive"] = np.reshape(columns["fp_exclusive"], (-1, len(header["metrics"])))
+        columns["fp_inclusive"] = np.reshape(columns["fp_inclusive"], (-1, len(header["metrics"])))
+        columns["ue_values"] = np.reshape(columns["ue_values"], (-1, 4))
+
+        ppk = cls.__new__(cls)
+        ppk._setup(None, hotspots, "bulk", compact, False, precision)
+        ppk._loadColumns(header, columns)
+        ppk._finalizeCompact()
+
+        return ppk
+
+    def _setup(self, filename, hotspots, decoder, compact, lazy, precision="double"):
+        if precision not in PPK.PRECISIONS:
+            raise Exception("Unknown precision `%s`" % precision)
+
         self.filename = filename
         self.hotspots = hotspots
+        self.decoder = decoder
+        self.compact = compact
+        self.lazy = lazy
+        self.precision = precision
+        self.valueType, self.countType = PPK.PRECISIONS[precision]
 
         self.metadata = {}  # map of metadata name->value
-        self.metrics = []  # list of metric names
-        self.groups = []  # list of group names
+        self.metrics = _IndexedList()  # list of metric names
+        self.groups = _IndexedList()  # list of group names
         self.events = []  # list of Event
+        self.eventIndex = {}  # event fullname -> position in events
         self.userEvents = []  # list of user event name
 
         self.nodes = {}  # nodeId -> Node
         self.contexts = []  # list of all Context
         self.threads = []  # list of all Thread
+        self.threadIndex = {}  # (nodeId, contextId, threadId) -> position in threads
 
         # raw data
         self.rawArray = None
         self.functionProfiles = []  # list of all FunctionProfile
         self.userEventProfiles = []  # list of all UserEventProfile
 
+        # compact storage of raw and aggregated profiles
+        self.table = None
+        self.aggTable = None
+        if compact:
+            self.table = ProfileTable(self)
+            self.functionProfiles = _ProfileRows(self.table, FunctionProfileView)
+
         # aggregated data
         self.aggExcArray = {}  # exclusive data
         self.aggIncArray = {}  # inclusive data
+        self.sparse = False  # whether the PPK.AGG cubes are SparseCube
 
-        self.aggEvents = []  # list of all function shortname after aggregation
+        # running statistics of online PPKs, see _foldThread()
+        self.online = None
 
-        f = gzip.open(filename, 'rb')
-        self.contents = f.read()
-        f.close()
+        self.aggEvents = _IndexedList()  # list of all function shortname after aggregation
+
+        # derived metrics evaluated on first access, see attachMetricSet()
+        self.lazyMetricSet = None
+        self.lazyMetrics = _IndexedList()  # names of the pending derived metrics
+        self.writeback = False
+        self.derived = {}  # memoized derived values, see _derivedColumn()
+        self.metaSym = {}  # system metadata resolved so far, see _getMetaSym()
+        self.recordedMeta = None  # system metadata found in the PPK
+
+    def _parse(self):
+        self._parseHeader()
+
+        if self.version >= 2:
+            # process thread metadata
+            numThreads = self._readInt()
+            for i in range(numThreads):
+                self._readThreadMetadata()
+
+        self._parseTables()
+
+        # the metrics are known now, fail before any thread is folded in
+        if self.online is not None and self.online["metricSet"] is not None:
+            if not self.online["metricSet"].nmetrics <= set(self.metrics):
+                raise Exception("MetricSet is bigger than PPK metrics")
+
+        # process thread data
+        numThreads = self._readInt()
+        for i in range(numThreads):
+            self._readThreadBlock()
+
+        if not self.reader.atEnd():
+            raise InvalidPPKError(self.filename)
+
+        if self.online is not None:
+            self._finalizeOnline()
+
+    def _parseLazy(self):
+        """
+        Parse the header and tables, and locate every thread block,
+        either from the persisted index or by skipping through the file
+        """
+        self._parseHeader()
+
+        index = PPKCache.load_index(self.filename)
+        if index is None:
+            index = self._scanThreads()
+            PPKCache.save_index(self.filename, index)
+        else:
+            self.reader.seek(int(index["tables"]))
+            self._parseTables()
+
+        # same thread order as the eager parser
+        self.metaOffsets = dict()  # (nodeId, contextId, threadId) -> offset
+        self.blockOffsets = dict()
+        for ids3, offset in zip(index["meta_ids"].tolist(), index["meta_offsets"].tolist()):
+            self.metaOffsets.setdefault(tuple(ids3), offset)
+        for ids3, offset in zip(index["block_ids"].tolist(), index["block_offsets"].tolist()):
+            self.blockOffsets.setdefault(tuple(ids3), offset)
+        for ids3 in index["meta_ids"].tolist() + index["block_ids"].tolist():
+            self.threadIndex.setdefault(tuple(ids3), len(self.threadIndex))
+
+        self.threads = _LazyThreads(self, list(self.threadIndex))
+
+    def _scanThreads(self):
+        """
+        Walk over the thread metadata and the thread blocks without
+        decoding them, and parse the tables in between.
+
+        Returns:
+          map: the thread offset index
+        """
+        def ids():
+            return [self._readInt() for i in range(3)]
+
+        metaIds = []
+        metaOffsets = []
+        if self.version >= 2:
+            numThreads = self._readInt()
+            for i in range(numThreads):
+                metaOffsets.append(self.reader.tell())
+                metaIds.append(ids())
+
+                numMetadata = self._readInt()
+                for j in range(numMetadata * 2):
+                    self._skipBytes(self._readUnsignedShort())
+
+        tables = self.reader.tell()
+        self._parseTables()
+
+        recordSize = self._functionProfileDtype().itemsize
+        blockIds = []
+        blockOffsets = []
+        numThreads = self._readInt()
+        for i in range(numThreads):
+            blockOffsets.append(self.reader.tell())
+            blockIds.append(ids())
 
+            self._skipBytes(self._readInt() * recordSize)
+            # userEventId, numSamples, min, max, mean, sumSquared
+            self._skipBytes(self._readInt() * 40)
+
+        if not self.reader.atEnd():
+            raise InvalidPPKError(self.filename)
+
+        return {"tables": np.array(tables, dtype=np.int64),
+                "meta_ids": np.reshape(np.array(metaIds, dtype=np.int32), (-1, 3)),
+                "meta_offsets": np.array(metaOffsets, dtype=np.int64),
+                "block_ids": np.reshape(np.array(blockIds, dtype=np.int32), (-1, 3)),
+                "block_offsets": np.array(blockOffsets, dtype=np.int64)}
+
+    def _materializeThread(self, i):
+        """Read thread `i` of a lazy PPK, see _LazyThreads"""
+        nodeId, contextId, threadId = self.threads.ids[i]
+
+        thread = Thread(self, nodeId, contextId, threadId)
+        thread.index = i
+        context = self._addNode(nodeId).addContext(contextId)
+        context.threads[threadId] = thread
+
+        key = (nodeId, contextId, threadId)
+        if key in self.metaOffsets:
+            self.reader.seek(self.metaOffsets[key])
+            self._readThreadMetadata(thread)
+
+        if key in self.blockOffsets:
+            self.reader.seek(self.blockOffsets[key])
+            self._readThreadBlock(thread)
+
+        return thread
+
+    def _materializeAll(self):
+        """
+        Read all remaining threads of a lazy PPK in file order, and put
+        the profiles back into thread order
+        """
+        if not self.lazy:
+            return
+
+        threads = self.threads
+        pending = [i for i in range(len(threads)) if threads.loaded[i] is None]
+        pending.sort(key=lambda i: self.blockOffsets.get(threads.ids[i], -1))
+        for i in pending:
+            threads[i]
+
+        def owner(p):
+            return self.threadIndex[(p.nodeId, p.contextId, p.threadId)]
+
+        self.functionProfiles.sort(key=owner)
+        self.userEventProfiles.sort(key=owner)
+
+        self.threads = list(threads.loaded)
+        self.lazy = False
+        self.reader.close()
+        self.reader = None
+
+    def _parseHeader(self):
+        """Parse everything up to the thread metadata"""
         cookie1 = self._readChar()
         cookie2 = self._readChar()
         cookie3 = self._readChar()
 
         if not (cookie1 == 'P' and cookie2 == 'P' and cookie3 == 'K'):
-            raise InvalidPPKError(filename)
+            raise InvalidPPKError(self.filename)
 
         self.version = self._readInt()
         self.compatible = self._readInt()
@@ -521,25 +1410,27 @@ class PPK:
                 name = self._readUTF()
                 value = self._readUTF()
                 self.metadata[name] = value
-
-            # process thread metadata
-            numThreads = self._readInt()
-            for i in range(numThreads):
-                nodeId = self._readInt()
-                contextId = self._readInt()
-                threadId = self._readInt()
-
-                thread = self._addThread(nodeId, contextId, threadId)
-
-                numMetadata = self._readInt()
-                for j in range(numMetadata):
-                    name = self._readUTF()
-                    value = self._readUTF()
-                    thread.addMetadata(name, value)
         else:
             self.bytesToSkip = self._readInt()
             self._skipBytes(self.bytesToSkip)
 
+    def _readThreadMetadata(self, thread=None):
+        nodeId = self._readInt()
+        contextId = self._readInt()
+        threadId = self._readInt()
+
+        if thread is None:
+            thread = self._addThread(nodeId, contextId, threadId)
+
+        numMetadata = self._readInt()
+        for j in range(numMetadata):
+            name = self._readUTF()
+            value = self._readUTF()
+            thread.addMetadata(name, value)
+
+    def _parseTables(self):
+        """Parse the metric, group, event and user event tables"""
+
         # process metrics
         numMetrics = self._readInt()
         for i in range(numMetrics):
@@ -554,227 +1445,473 @@ class PPK:
         numFunctions = self._readInt()
         for i in range(numFunctions):
             functionName = self._readUTF()
-            event = Event(functionName, hotspots)
-
             numThisGroups = self._readInt()
-            for j in range(numThisGroups):
-                event.addGroup(self.groups[self._readInt()])
+            groupIds = [self._readInt() for j in range(numThisGroups)]
 
-            self.events.append(event)
+            self._addEvent(functionName, groupIds)
 
         # process user events
         numUserEvents = self._readInt()
         for i in range(numUserEvents):
             self.userEvents.append(self._readUTF())
 
-        # process thread data
-        numThreads = self._readInt()
-        for i in range(numThreads):
-            nodeId = self._readInt()
-            contextId = self._readInt()
-            threadId = self._readInt()
+    def _readThreadBlock(self, thread=None):
+        nodeId = self._readInt()
+        contextId = self._readInt()
+        threadId = self._readInt()
 
+        if thread is None:
             thread = self._addThread(nodeId, contextId, threadId)
 
-            # get function profiles
-            numFunctionProfiles = self._readInt()
-            for j in range(numFunctionProfiles):
-                functionId = self._readInt()
-                profile = FunctionProfile(self, nodeId, contextId, \
-                                          threadId, functionId)
-                profile.numCalls = self._readDouble()
-                profile.numSubr = self._readDouble()
-
-                for k in range(numMetrics):
-                    profile.exclusive[self.metrics[k]] = self._readDouble()
-                    profile.inclusive[self.metrics[k]] = self._readDouble()
-
-                self.functionProfiles.append(profile)
-                thread.addFunctionProfile(profile.fullname, profile)
-
-            # get user event profiles
-            numUserEventProfiles = self._readInt()
-            for j in range(numUserEventProfiles):
-                userEventId = self._readInt()
-                profile = UserEventProfile(self, userEventId, nodeId, \
-                                           contextId, threadId)
-                profile.numSamples = self._readInt()
-                profile.minValue = self._readDouble()
-                profile.maxValue = self._readDouble()
-                profile.meanValue = self._readDouble()
-                profile.sumSquared = self._readDouble()
-
-                self.userEventProfiles.append(profile)
-                thread.addUserEventProfile(profile.userEventName, profile)
-
-        if self.pos < len(self.contents):
-            raise InvalidPPKError(filename)
+        # get function profiles
+        numFunctionProfiles = self._readInt()
+        if self.decoder == "reference":
+            self._readFunctionProfilesReference(thread, numFunctionProfiles)
+        else:
+            self._readFunctionProfiles(thread, numFunctionProfiles)
 
-    def addMetadata(self, name, value):
-        self.metadata[name] = value
+        if self.online is not None:
+            self._foldThread()
 
-    def dump(self, ppkfile):
-        self.pack_format = ">"
-        self.pack_data = []
+        # get user event profiles, online PPKs do not keep them
+        numUserEventProfiles = self._readInt()
+        if self.online is not None:
+            # userEventId, numSamples, min, max, mean, sumSquared
+            self._skipBytes(numUserEventProfiles * 40)
+            return
 
-        self._writeChar('P')
-        self._writeChar('P')
-        self._writeChar('K')
+        for j in range(numUserEventProfiles):
+            userEventId = self._readInt()
+            numSamples = self._readInt()
+            values = [self._readDouble() for k in range(4)]
 
-        self._writeInt(self.version)
-        self._writeInt(self.compatible)
+            self._addUserEventProfile(thread, userEventId, numSamples, *values)
 
-        if self.version >= 2:
-            self._writeInt(self.pad1)
+    def _addEvent(self, fullname, groupIds):
+        event = Event(fullname, self.hotspots)
+        for groupId in groupIds:
+            event.addGroup(self.groups[groupId])
 
-            self._writeInt(self.bytesToSkip)
-            self._writePad(self.bytesToSkip)
+        self.eventIndex.setdefault(fullname, len(self.events))
+        self.events.append(event)
 
-            # process metadata
-            self._writeInt(len(list(self.metadata.keys())))
-            for name, value in list(self.metadata.items()):
-                self._writeUTF(name)
-                self._writeUTF(value)
+    def _addFunctionProfiles(self, thread, functionIds, numCalls, numSubr,
+                             exclusive, inclusive):
+        """
+        Add function profiles to `thread` out of parallel arrays, one row
+        of metric values per profile
+        """
+        if self.online is not None:
+            self.online["rows"].append((functionIds, exclusive, inclusive))
+            return
 
-            # process thread metadata
-            self._writeInt(len(self.threads))
-            for thread in self.threads:
-                self._writeInt(thread.nodeId)
-                self._writeInt(thread.contextId)
-                self._writeInt(thread.threadId)
-
-                self._writeInt(len(list(thread.metadata.keys())))
-                for name, value in list(thread.metadata.items()):
-                    self._writeUTF(name)
-                    self._writeUTF(value)
+        if self.compact:
+            self.table.append(thread.index, functionIds, numCalls, numSubr,
+                              exclusive, inclusive)
+            return
+
+        # tolist() yields the very same python floats as unpack(">d")
+        functionIds = functionIds.tolist()
+        numCalls = numCalls.tolist()
+        numSubr = numSubr.tolist()
+        exclusive = exclusive.tolist()
+        inclusive = inclusive.tolist()
+
+        for j in range(len(functionIds)):
+            profile = FunctionProfile(self, thread.nodeId, thread.contextId, \
+                                      thread.threadId, functionIds[j])
+            profile.numCalls = numCalls[j]
+            profile.numSubr = numSubr[j]
+            profile.exclusive = dict(zip(self.metrics, exclusive[j]))
+            profile.inclusive = dict(zip(self.metrics, inclusive[j]))
+
+            self.functionProfiles.append(profile)
+            thread.addFunctionProfile(profile.fullname, profile)
+
+    def _addUserEventProfile(self, thread, userEventId, numSamples, minValue,
+                             maxValue, meanValue, sumSquared):
+        profile = UserEventProfile(self, userEventId, thread.nodeId, \
+                                   thread.contextId, thread.threadId)
+        profile.numSamples = numSamples
+        profile.minValue = minValue
+        profile.maxValue = maxValue
+        profile.meanValue = meanValue
+        profile.sumSquared = sumSquared
+
+        self.userEventProfiles.append(profile)
+        thread.addUserEventProfile(profile.userEventName, profile)
+
+    def _setupOnline(self, ms):
+        if ms is not None and ms.reduced:
+            raise Exception("Online PPK statistics can not reduce over the thread axis")
+
+        self.online = {
+            "metricSet": ms,
+            "rows": [],  # profiles of the thread block being read
+            "position": None,  # event id -> aggEvents index, -1 if not seen yet, -2 if derived
+            "stats": None,  # PPK.EXCLUSIVE, PPK.INCLUSIVE OnlineStats
+        }
+
+    def _foldThread(self):
+        """
+        Aggregate the profiles of the thread block just read by shortname,
+        as _finalizeCompact() does, and add them to the running
+        statistics of their (event, metric). The statistics do not grow
+        with the number of threads, only the Thread objects do.
+        """
+        online = self.online
+        rows = online["rows"]
+        online["rows"] = []
+
+        width = len(self.metrics)
+        if rows:
+            functionIds = np.concatenate([np.asarray(r[0], dtype=np.intp) for r in rows])
+            exclusive = np.concatenate([np.reshape(r[1], (-1, width)) for r in rows])
+            inclusive = np.concatenate([np.reshape(r[2], (-1, width)) for r in rows])
         else:
-            self._writeInt(self.bytesToSkip)
-            self._writePad(self.bytesToSkip)
+            functionIds = np.zeros(0, dtype=np.intp)
+            exclusive = inclusive = np.zeros((0, width))
+
+        if online["position"] is None:
+            online["position"] = np.full(len(self.events), -1, dtype=np.intp)
+
+        # aggEvents in order of first appearance, as the object model does;
+        # every event is looked at once, derived ones included
+        position = online["position"]
+        for f in functionIds[position[functionIds] == -1].tolist():
+            event = self.events[f]
+            if position[f] != -1:
+                continue
+            if event.isDerived:
+                position[f] = -2
+                continue
+            if event.shortname not in self.aggEvents:
+                self.aggEvents.append(event.shortname)
+            position[f] = self.aggEvents.index(event.shortname)
+
+        keep = position[functionIds] >= 0
+        events, inverse = np.unique(position[functionIds[keep]], return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        for flavor, values in ((PPK.EXCLUSIVE, exclusive), (PPK.INCLUSIVE, inclusive)):
+            agg = np.zeros((len(events), width))
+            np.add.at(agg, inverse, values[keep])
+            agg = self._onlineDerived(agg)
+
+            if online["stats"] is None:
+                online["stats"] = [OnlineStats(agg.shape[1:]), OnlineStats(agg.shape[1:])]
+            online["stats"][flavor].add(events, agg)
+
+    def _onlineDerived(self, values):
+        """Append the derived metrics of the online MetricSet to `values`"""
+        ms = self.online["metricSet"]
+        if ms is None or not ms.dmetrics:
+            return values
+
+        [derived] = self._evalDerivedMetric(self.metrics, [values], ms,
+                                            self._getMetaSym(ms))
+        return np.hstack([values, derived])
+
+    def _finalizeOnline(self):
+        """Turn the running statistics into the aggregated arrays"""
+        ms = self.online["metricSet"]
+        if ms is not None:
+            self.metrics.extend(ms.dmetrics)
+
+        dimN, dimC, dimT = self._aggDims()
+        cells = max(dimN * dimC * dimT, 1)
+
+        if self.online["stats"] is None:
+            self.online["stats"] = [OnlineStats((len(self.metrics),)),
+                                    OnlineStats((len(self.metrics),))]
+
+        for array, stats in ((self.aggExcArray, self.online["stats"][PPK.EXCLUSIVE]),
+                             (self.aggIncArray, self.online["stats"][PPK.INCLUSIVE])):
+            result = stats.result(cells, len(self.aggEvents))
+            array.update({PPK.SUM: result["sum"],
+                          PPK.MAX: result["max"],
+                          PPK.MIN: result["min"],
+                          PPK.STD: result["std"],
+                          PPK.MEAN: result["mean"]})
+
+    def _finalizeCompact(self):
+        """
+        Aggregate the raw rows of a compact PPK by (thread, shortname)
+        into aggTable and hook the per-thread views up
+        """
+        if not self.compact:
+            return
 
-        # process metrics
-        self._writeInt(len(self.metrics))
-        for metric in self.metrics:
-            self._writeUTF(metric)
+        table = self.table
+        table.finalize()
+
+        # map every event to its shortname, derived events to -1
+        names = dict()
+        shortIds = np.array([-1 if e.isDerived else names.setdefault(e.shortname, len(names))
+                             for e in self.events] + [-1], dtype=np.intp)
+        shortnames = list(names)
+
+        rows = np.flatnonzero(shortIds[table.function] >= 0)
+        short = shortIds[table.function[rows]]
+
+        # aggEvents in order of first appearance, as the object model does
+        seen, first = np.unique(short, return_index=True)
+        order = seen[np.argsort(first, kind="stable")]
+        self.aggEvents = _IndexedList(shortnames[i] for i in order.tolist())
+        position = np.zeros(len(shortnames) + 1, dtype=np.intp)
+        position[order] = np.arange(len(order))
+
+        # one aggregated row per (thread, event), grouped by thread
+        dimE = max(len(order), 1)
+        keys, inverse = np.unique(table.thread[rows].astype(np.intp) * dimE + position[short],
+                                  return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        agg = self.aggTable = ProfileTable(self)
+        calls = np.zeros(len(keys), dtype=self.countType)
+        subr = np.zeros(len(keys), dtype=self.countType)
+        exclusive = np.zeros((len(keys), len(self.metrics)))
+        inclusive = np.zeros((len(keys), len(self.metrics)))
+        np.add.at(calls, inverse, table.calls[rows])
+        np.add.at(subr, inverse, table.subr[rows])
+        np.add.at(exclusive, inverse, table.exclusive[rows])
+        np.add.at(inclusive, inverse, table.inclusive[rows])
+        agg.adopt((keys // dimE).astype(np.int32), (keys % dimE).astype(np.int32),
+                  calls, subr, exclusive, inclusive)
+
+        for index, begin, end in table.bounds():
+            self.threads[index].functionProfiles = \
+                _ThreadProfiles(table, FunctionProfileView, begin, end)
+
+        for index, begin, end in agg.bounds():
+            self.threads[index].aggProfiles = \
+                _ThreadProfiles(agg, ProfileView, begin, end)
+
+    def _saveHeader(self):
+        """The header tables stored by PPKCache, copied"""
+        return {
+            "version": self.version,
+            "compatible": self.compatible,
+            "pad1": getattr(self, "pad1", 0),
+            "bytesToSkip": self.bytesToSkip,
+            "metadata": dict(self.metadata),
+            "metrics": list(self.metrics),
+            "groups": list(self.groups),
+            "events": [[e.fullname, [self.groups.index(g) for g in e.groups]]
+                       for e in self.events],
+            "userEvents": list(self.userEvents),
+            "threads": [[t.nodeId, t.contextId, t.threadId, dict(t.metadata)]
+                        for t in self.threads],
+        }
+
+    def _saveColumns(self):
+        """
+        Flatten the raw data into the header tables and columns stored
+        by PPKCache
+        """
+        header = self._saveHeader()
+
+        def owner(p):
+            return self.threadIndex[(p.nodeId, p.contextId, p.threadId)]
+
+        ups = self.userEventProfiles
+        if self.compact:
+            columns = {
+                "fp_thread": self.table.thread,
+                "fp_function": self.table.function,
+                "fp_calls": self.table.calls,
+                "fp_subr": self.table.subr,
+                "fp_exclusive": self.table.padded(PPK.EXCLUSIVE),
+                "fp_inclusive": self.table.padded(PPK.INCLUSIVE),
+            }
+        else:
+            fps = self.functionProfiles
+            columns = {
+                "fp_thread": [owner(p) for p in fps],
+                "fp_function": [p.functionId for p in fps],
+                "fp_calls": [p.numCalls for p in fps],
+                "fp_subr": [p.numSubr for p in fps],
+                "fp_exclusive": np.reshape([[p.exclusive[m] for m in self.metrics] for p in fps],
+                                           (len(fps), len(self.metrics))),
+                "fp_inclusive": np.reshape([[p.inclusive[m] for m in self.metrics] for p in fps],
+                                           (len(fps), len(self.metrics))),
+            }
+
+        columns.update({
+            "ue_thread": [owner(p) for p in ups],
+            "ue_id": [p.userEventId for p in ups],
+            "ue_samples": [p.numSamples for p in ups],
+            "ue_values": np.reshape([[p.minValue, p.maxValue, p.meanValue, p.sumSquared]
+                                     for p in ups], (len(ups), 4)),
+        })
+
+        return header, columns
+
+    def _loadColumns(self, header, columns):
+        """Rebuild the object model out of the PPKCache tables"""
+        self.version = header["version"]
+        self.compatible = header["compatible"]
+        self.pad1 = header["pad1"]
+        self.bytesToSkip = header["bytesToSkip"]
+        self.metadata = header["metadata"]
+        self.metrics.extend(header["metrics"])
+        self.groups.extend(header["groups"])
+        self.userEvents.extend(header["userEvents"])
+
+        for fullname, groupIds in header["events"]:
+            self._addEvent(fullname, groupIds)
+
+        threads = []
+        for nodeId, contextId, threadId, metadata in header["threads"]:
+            thread = self._addThread(nodeId, contextId, threadId)
+            thread.metadata = metadata
+            threads.append(thread)
+
+        if self.compact:
+            # zero-copy, the memory-mapped columns become the table
+            self.table.adopt(columns["fp_thread"], columns["fp_function"],
+                             columns["fp_calls"], columns["fp_subr"],
+                             columns["fp_exclusive"], columns["fp_inclusive"])
+        else:
+            # rows of each thread are contiguous, in thread block order
+            owners = columns["fp_thread"]
+            bounds = (np.flatnonzero(np.diff(owners)) + 1).tolist()
+            for begin, end in zip([0] + bounds, bounds + [len(owners)]):
+                if begin == end:
+                    continue
+                rows = slice(begin, end)
+                self._addFunctionProfiles(threads[owners[begin]],
+                                          columns["fp_function"][rows],
+                                          columns["fp_calls"][rows],
+                                          columns["fp_subr"][rows],
+                                          columns["fp_exclusive"][rows],
+                                          columns["fp_inclusive"][rows])
+
+        for i, userEventId, numSamples, values in zip(columns["ue_thread"].tolist(),
+                                                      columns["ue_id"].tolist(),
+                                                      columns["ue_samples"].tolist(),
+                                                      columns["ue_values"].tolist()):
+            self._addUserEventProfile(threads[i], userEventId, numSamples, *values)
 
-        # process groups
-        self._writeInt(len(self.groups))
-        for group in self.groups:
-            self._writeUTF(group)
+    def addMetadata(self, name, value):
+        self.metadata[name] = value
 
-        # process functions
-        self._writeInt(len(self.events))
-        for event in self.events:
-            self._writeUTF(event.fullname)
+    def dump(self, ppkfile):
+        """
+        Write the data set, including added metadata and derived metrics,
+        to `ppkfile`. The file is streamed out thread by thread, see
+        PPKWriter: compact PPKs straight out of their columns, the object
+        model one Thread at a time.
+        """
+        self._materializeAll()
 
-            self._writeInt(len(event.groups))
-            for group in event.groups:
-                self._writeInt(self.groups.index(group))
+        if self.compact:
+            PPKWriter.write(ppkfile, *self._saveColumns())
+            return
 
-        # process user events
-        self._writeInt(len(self.userEvents))
-        for event in self.userEvents:
-            self._writeUTF(event)
+        header = self._saveHeader()
+        with PPKWriter.PPKWriter(ppkfile) as writer:
+            writer.writeHeader(header["version"], header["compatible"],
+                               header["pad1"], header["bytesToSkip"],
+                               header["metadata"], header["threads"])
+            writer.writeTables(header["metrics"], header["groups"],
+                               header["events"], header["userEvents"])
 
-        # process thread data
-        fpBegin = 0;
-        upBegin = 0;
-        self._writeInt(len(self.threads))
-        for thread in self.threads:
-            self._writeInt(thread.nodeId)
-            self._writeInt(thread.contextId)
-            self._writeInt(thread.threadId)
-
-            print("Handle thread %d ..." % thread.threadId)
-
-            # write function profiles
-            fpNum = len(list(thread.functionProfiles.keys()))
-            self._writeInt(fpNum)
-            for profile in self.functionProfiles[fpBegin:fpBegin + fpNum]:
-                self._writeInt(profile.functionId)
-                self._writeDouble(profile.numCalls)
-                self._writeDouble(profile.numSubr)
-
-                for metric in self.metrics:
-                    self._writeDouble(profile.exclusive[metric])
-                    self._writeDouble(profile.inclusive[metric])
-            fpBegin += fpNum
-
-            # write user event profiles
-            upNum = len(list(thread.userEventProfiles.keys()))
-            self._writeInt(upNum)
-            for profile in self.userEventProfiles[upBegin:upBegin + upNum]:
-                self._writeInt(profile.userEventId)
-                self._writeInt(profile.numSamples)
-                self._writeDouble(profile.minValue)
-                self._writeDouble(profile.maxValue)
-                self._writeDouble(profile.meanValue)
-                self._writeDouble(profile.sumSquared)
-            upBegin += upNum
-
-        f = gzip.open(ppkfile, 'wb')
-        f.write(pack(self.pack_format, *self.pack_data))
-        f.close()
+            for thread in self.threads:
+                fps = list(thread.functionProfiles.values())
+                ups = list(thread.userEventProfiles.values())
+                writer.writeThread(
+                    thread.nodeId, thread.contextId, thread.threadId,
+                    [p.functionId for p in fps],
+                    [p.numCalls for p in fps],
+                    [p.numSubr for p in fps],
+                    np.reshape([[p.exclusive[m] for m in self.metrics] for p in fps],
+                               (len(fps), len(self.metrics))),
+                    np.reshape([[p.inclusive[m] for m in self.metrics] for p in fps],
+                               (len(fps), len(self.metrics))),
+                    [p.userEventId for p in ups],
+                    [p.numSamples for p in ups],
+                    np.reshape([[p.minValue, p.maxValue, p.meanValue, p.sumSquared]
+                                for p in ups], (len(ups), 4)))
+
+    def _functionProfileDtype(self):
+        return PPKWriter.function_profile_dtype(len(self.metrics))
+
+    def _readFunctionProfileBlocks(self, count):
+        """
+        Generator. Decode `count` consecutive function profile records
+        as big-endian numpy views over what the reader returns. With the
+        streaming reader the records come in blocks of at most one
+        buffer size.
+        """
+        dtype = self._functionProfileDtype()
 
-    def _readChar(self):
-        rv = unpack("Bc", self.contents[self.pos:self.pos + 2])
-        self.pos += 2
+        if isinstance(self.reader, _StreamReader):
+            step = max(1, self.reader.bufsize // dtype.itemsize)
+        else:
+            step = max(1, count)
+
+        while count > 0:
+            n = min(count, step)
+            yield np.frombuffer(self.reader.read(n * dtype.itemsize), dtype=dtype)
+            count -= n
+
+    def _readFunctionProfiles(self, thread, count):
+        """Bulk decoder for the function profiles of `thread`"""
+        for block in self._readFunctionProfileBlocks(count):
+            self._addFunctionProfiles(thread, block["functionId"],
+                                      block["numCalls"], block["numSubr"],
+                                      block["values"][:, :, PPK.EXCLUSIVE],
+                                      block["values"][:, :, PPK.INCLUSIVE])
+
+    def _readFunctionProfilesReference(self, thread, count):
+        """
+        Reference decoder for the function profiles of `thread`, one
+        value at a time. Slow, only used to validate the bulk decoder.
+        """
+        for j in range(count):
+            functionId = self._readInt()
+            numCalls = self._readDouble()
+            numSubr = self._readDouble()
 
-        return rv[1]
+            exclusive = []
+            inclusive = []
+            for k in range(len(self.metrics)):
+                exclusive.append(self._readDouble())
+                inclusive.append(self._readDouble())
 
-    def _writeChar(self, char):
-        self.pack_format += "Bc"
-        self.pack_data.append(0)
-        self.pack_data.append(char)
+            self._addFunctionProfiles(thread, np.array([functionId]),
+                                      np.array([numCalls]), np.array([numSubr]),
+                                      np.array([exclusive]), np.array([inclusive]))
+
+    def _readChar(self):
+        rv = unpack("Bc", self.reader.read(2))
+
+        return rv[1].decode("ascii")
 
     def _readUnsignedShort(self):
-        rv = unpack(">H", self.contents[self.pos:self.pos + 2])
-        self.pos += 2
+        rv = unpack(">H", self.reader.read(2))
 
         return rv[0]
 
-    def _writeUnsignedShort(self, us):
-        self.pack_format += "H"
-        self.pack_data.append(us)
-
     def _readInt(self):
-        rv = unpack(">i", self.contents[self.pos:self.pos + 4])
-        self.pos += 4
+        rv = unpack(">i", self.reader.read(4))
 
         return rv[0]
 
-    def _writeInt(self, i):
-        self.pack_format += "i"
-        self.pack_data.append(i)
-
     def _readDouble(self):
-        rv = unpack(">d", self.contents[self.pos:self.pos + 8])
-        self.pos += 8
+        rv = unpack(">d", self.reader.read(8))
 
         return rv[0]
 
-    def _writeDouble(self, d):
-        self.pack_format += "d"
-        self.pack_data.append(d)
-
     def _readUTF(self):
         len = self._readUnsignedShort()
-        rv = unpack("%ds" % len, self.contents[self.pos:self.pos + len])
-        self.pos += len
-
-        return rv[0]
+        rv = unpack("%ds" % len, self.reader.read(len))
 
-    def _writeUTF(self, utf):
-        self.pack_format += "H%ds" % len(utf)
-        self.pack_data.append(len(utf))
-        self.pack_data.append(utf)
+        return rv[0].decode("utf-8")
 
     def _skipBytes(self, bytesToSkip):
-        self.pos += bytesToSkip
-
-    def _writePad(self, length):
-        if (length > 0):
-            self.pack_format += "%dB" % length
-            self.pack_data.extend([0x55] * length)
+        self.reader.skip(bytesToSkip)
 
     def _addNode(self, nodeId):
         if nodeId not in self.nodes:
@@ -790,7 +1927,13 @@ class PPK:
         return thread
 
     def _getAggData(self, event, metric, type, flavor):
-        if event not in self.aggEvents or metric not in self.metrics:
+        if event not in self.aggEvents:
+            return 0
+
+        if self._isDerivedOnDemand(metric, type, flavor):
+            return self._derivedStat(metric, type, flavor)[self.aggEvents.index(event)]
+
+        if metric not in self.metrics:
             return 0
 
         e = self.aggEvents.index(event)
@@ -803,18 +1946,88 @@ class PPK:
 
         return array[type][e, m]
 
+    def getAggVector(self, metric, type, flavor, events=None):
+        """
+        Batched version of the getAgg*() accessors: one statistic of
+        `metric` for many aggregated events at once.
+
+        Args:
+          metric (string): Name of the metric
+          type (int):      PPK.SUM, PPK.MAX, PPK.MIN, PPK.STD or PPK.MEAN
+          flavor (int):    PPK.EXCLUSIVE or PPK.INCLUSIVE
+          events (list):   Aggregated event names, defaults to aggEvents.
+                           Unknown events read 0, like in getAgg*()
+
+        Returns:
+          array: one value per event
+        """
+        if flavor == PPK.INCLUSIVE:
+            array = self.aggIncArray
+        elif flavor == PPK.EXCLUSIVE:
+            array = self.aggExcArray
+        else:
+            raise RuntimeError("Invalid parameter")
+
+        if events is None:
+            events = self.aggEvents
+
+        if self._isDerivedOnDemand(metric, type, flavor):
+            column = self._derivedStat(metric, type, flavor)
+        elif metric not in self.metrics:
+            return np.zeros(len(events))
+        else:
+            column = array[type][:, self.metrics.index(metric)]
+        positions = np.array([self.aggEvents.positions.get(e, -1) for e in events],
+                             dtype=np.intp)
+
+        # unknown events, at -1, read the zero padding the column
+        column = np.append(column, 0.0)
+
+        return column[positions]
+
+    def getThread(self, nodeId, contextId, threadId):
+        if (nodeId, contextId, threadId) not in self.threadIndex:
+            raise NoSuchThreadError(threadId)
+
+        return self.threads[self.threadIndex[(nodeId, contextId, threadId)]]
+
     def getDataPoint(self, thread, event, metric, flavor):
         if thread >= len(self.threads):
             raise NoSuchThreadError(thread)
 
+        if metric in self.lazyMetrics:
+            profiles = self.threads[thread].functionProfiles
+            if event not in profiles:
+                raise NoSuchEventError(event)
+
+            if flavor not in (PPK.EXCLUSIVE, PPK.INCLUSIVE):
+                raise RuntimeError("Invalid parameter")
+
+            column = self._derivedColumn(self.table, metric, flavor)
+            if column is not None:
+                return column[profiles[event].row].item()
+
         return self.threads[thread].getDataPoint(event, metric, flavor)
 
-    def attachMetricSet(self, ms):
+    def attachMetricSet(self, ms, lazy=False, writeback=False):
         """
-        Calculate and add derived metrics into the data set.
+        Calculate and add derived metrics into the data set. Every
+        expression is evaluated once, over the columns of all raw and
+        aggregated profiles, exclusive and inclusive alike. Metrics using
+        thread-axis reductions (see MathExp.reductions) are evaluated over
+        [threads, events] matrices instead, one per table and flavor, and
+        every profile gets the value of its own thread and event.
 
         Args:
-          ms (object): MetricSet
+          ms (object):      MetricSet
+          lazy (bool):      Only register the derived metrics. Each one is
+                            evaluated when first read through
+                            getDataPoint(), getAgg*() or getAggVector(),
+                            and only for the flavor and statistic read.
+                            Needs a compact PPK
+          writeback (bool): With `lazy`, a derived metric that is read
+                            becomes a regular metric of the data set, for
+                            every profile and flavor, so dump() keeps it
 
         Returns:
           None
@@ -822,27 +2035,336 @@ class PPK:
         if not ms.nmetrics <= set(self.metrics):
             raise Exception("MetricSet is bigger than PPK metrics")
 
+        if self.online is not None:
+            raise Exception("Online PPKs take their MetricSet when parsed")
+
+        if lazy:
+            if not self.compact:
+                raise Exception("Lazy derived metrics need a compact PPK")
+
+            self.lazyMetricSet = ms
+            self.lazyMetrics = _IndexedList(m for m in ms.dmetrics if m not in self.metrics)
+            self.writeback = writeback
+            self.derived = {}
+            return
+
+        self._materializeAll()
+
+        metaSym = self._getMetaSym(ms)
+
+        if self.compact:
+            tables = (self.table, self.aggTable)
+            parts = [table.values[flavor] for table in tables
+                     for flavor in (PPK.EXCLUSIVE, PPK.INCLUSIVE)]
+            names = self.metrics[:min(part.shape[1] for part in parts)]
+            axes = [self._threadAxis(table) for table in tables
+                    for flavor in (PPK.EXCLUSIVE, PPK.INCLUSIVE)]
+        else:
+            profiles = self.functionProfiles + \
+                [p for thread in self.threads for p in thread.aggProfiles.values()]
+            names = list(self.metrics)
+            parts = [np.reshape([[getattr(p, flavor)[m] for m in names] for p in profiles],
+                                (len(profiles), len(names)))
+                     for flavor in ("exclusive", "inclusive")]
+            axes = [self._profileAxis(profiles)] * 2
+
+        derived = self._evalDerivedMetric(names, parts, ms, metaSym, axes=axes)
+
         self.metrics.extend(ms.dmetrics)
 
-        metaSym = get_sys_info()
+        if self.compact:
+            self._setDerivedMetric(self.table, ms.dmetrics, derived[0:2])
+            self._setDerivedMetric(self.aggTable, ms.dmetrics, derived[2:4])
+            return
+
+        for flavor, values in zip(("exclusive", "inclusive"), derived):
+            for profile, row in zip(profiles, values.tolist()):
+                getattr(profile, flavor).update(zip(ms.dmetrics, row))
+
+    def _getMetaSym(self, ms, targets=None):
+        """
+        Values of the META_* symbols the derived metrics `targets` (all
+        of them by default) of `ms` refer to. What the PPK recorded about
+        the machine it was collected on takes precedence over this host,
+        which is only probed for the rest.
+        """
+        if targets is None:
+            symbols = set(ms.meta)
+        else:
+            symbols = set(s for s in ms.dependencies(targets) if s.startswith("META_"))
+
+        missing = symbols.difference(self.metaSym)
+        if missing:
+            if self.recordedMeta is None:
+                metadata = dict(self.threads[0].metadata) if len(self.threads) else {}
+                metadata.update(self.metadata)
+                self.recordedMeta = get_recorded_info(metadata)
+
+            self.metaSym.update((s, self.recordedMeta[s])
+                                for s in missing if s in self.recordedMeta)
+
+            missing.difference_update(self.recordedMeta)
+            if missing:
+                self.metaSym.update(get_sys_info(missing))
+
+        return dict((s, self.metaSym[s]) for s in symbols if s in self.metaSym)
+
+    def _evalDerivedMetric(self, names, parts, ms, meta, targets=None, axes=None):
+        """
+        Evaluate the derived metrics of `ms` over value matrices.
+
+        Args:
+          names (list):   metric names of the leading columns of `parts`
+          parts (list):   [rows, metrics] value arrays, evaluated together
+          ms (object):    MetricSet
+          meta (map):     system metadata
+          targets (list): only evaluate these derived metrics, see
+                          MetricSet.eval
+          axes (list):    per part, the (thread, function, events) of its
+                          rows, see _threadAxis(). Only needed by metrics
+                          that reduce over the thread axis
+
+        Returns:
+          list: per part, a [rows, len(targets or ms.dmetrics)] array of
+                values
+        """
+        rows = [len(part) for part in parts]
+        total = sum(rows)
+
+        reduced = [m for m in (ms.dmetrics if targets is None else targets)
+                   if m in ms.reduced]
+        if reduced and axes is None:
+            raise Exception("Thread-axis reductions need the layout of the profiles")
+
+        symtab = dict(meta)
+        for i, name in enumerate(names):
+            symtab[name] = np.concatenate([part[:, i] for part in parts]) \
+                if parts else np.zeros(0)
+
+        if targets is None and not reduced:
+            targets = ms.dmetrics
+            derived = ms.eval(symtab, array=True)
+        else:
+            if targets is None:
+                targets = ms.dmetrics
+            derived = ms.eval(symtab, array=True,
+                              targets=[m for m in targets if m not in reduced])
+
+        columns = np.zeros((total, len(targets)))
+        for i, metric in enumerate(targets):
+            if metric in derived:
+                # constant expressions evaluate to scalars
+                columns[:, i] = np.broadcast_to(derived[metric], (total,))
+
+        columns = np.split(columns, np.cumsum(rows)[:-1])
+
+        if reduced:
+            inputs = ms.dependencies(reduced)
+            for part, (thread, function, events), values in zip(parts, axes, columns):
+                derived = self._evalReduced(names, part, ms, meta, reduced, inputs,
+                                            thread, function, events)
+                for i, metric in enumerate(targets):
+                    if metric in derived:
+                        values[:, i] = derived[metric]
+
+        return columns
+
+    def _evalReduced(self, names, part, ms, meta, reduced, inputs, thread, function, events):
+        """
+        Evaluate the thread-reducing derived metrics `reduced` over the
+        [threads, events] matrices of the `inputs` columns of `part`.
+        Matrix cells without a profile are zeros, as in the aggregated
+        cube.
+
+        Returns:
+          map: metric name -> value of every row of `part`
+        """
+        shape = (len(self.threads), events)
+
+        symtab = dict(meta)
+        for i, name in enumerate(names):
+            if name in inputs:
+                symtab[name] = np.zeros(shape)
+                symtab[name][thread, function] = part[:, i]
+
+        derived = ms.eval(symtab, array=True, targets=reduced)
+
+        return dict((metric, np.broadcast_to(value, shape)[thread, function])
+                    for metric, value in derived.items())
+
+    def _threadAxis(self, table):
+        """(thread, function, events) of the rows of a ProfileTable"""
+        events = len(self.aggEvents) if table is self.aggTable else len(self.events)
+
+        return table.thread, table.function, events
+
+    def _profileAxis(self, profiles):
+        """
+        (thread, function, events) of the dict mode profiles attachMetricSet()
+        evaluates: the function profiles, then every thread's aggregated ones.
+        Both share one matrix, aggregated events come after the raw ones.
+        """
+        thread = [self.threadIndex[(p.nodeId, p.contextId, p.threadId)] for p in profiles]
+        function = [p.functionId for p in self.functionProfiles] + \
+            [len(self.events) + self.aggEvents.index(name)
+             for t in self.threads for name in t.aggProfiles]
+
+        return (np.array(thread, dtype=np.intp), np.array(function, dtype=np.intp),
+                len(self.events) + len(self.aggEvents))
+
+    def _isDerivedOnDemand(self, metric, type, flavor):
+        """
+        Whether the `type` statistic of `metric` has to come from
+        _derivedStat(), because the metric is still pending or was
+        written back after the cube was built
+        """
+        if metric in self.lazyMetrics:
+            return True
+
+        if self.lazyMetricSet is None or metric not in self.lazyMetricSet.rpns or \
+                metric not in self.metrics:
+            return False
+
+        array = self.aggIncArray if flavor == PPK.INCLUSIVE else self.aggExcArray
+        return type not in array or array[type].shape[-1] <= self.metrics.index(metric)
+
+    def _derivedColumn(self, table, metric, flavor):
+        """
+        Values of the pending derived metric `metric` for every row of
+        `table`, memoized per (table, metric, flavor). With writeback the
+        metric is committed to the data set instead, and None returned.
+        """
+        if self.writeback:
+            self._commitDerivedMetric(metric)
+            return None
+
+        key = (id(table), metric, flavor)
+        if key not in self.derived:
+            values = table.values[flavor]
+            names = self.metrics[:values.shape[1]]
+            [column] = self._evalDerivedMetric(names, [values], self.lazyMetricSet,
+                                               self._getMetaSym(self.lazyMetricSet, [metric]),
+                                               [metric],
+                                               [self._threadAxis(table)])
+            self.derived[key] = column[:, 0]
+
+        return self.derived[key]
+
+    def _commitDerivedMetric(self, metric):
+        """Evaluate a pending derived metric everywhere and keep it"""
+        tables = (self.table, self.aggTable)
+        parts = [table.values[flavor] for table in tables
+                 for flavor in (PPK.EXCLUSIVE, PPK.INCLUSIVE)]
+        names = self.metrics[:min(part.shape[1] for part in parts)]
+
+        derived = self._evalDerivedMetric(names, parts, self.lazyMetricSet,
+                                          self._getMetaSym(self.lazyMetricSet, [metric]),
+                                          [metric],
+                                          [self._threadAxis(table) for table in tables
+                                           for flavor in (PPK.EXCLUSIVE, PPK.INCLUSIVE)])
+
+        self.lazyMetrics.remove(metric)
+        self.metrics.append(metric)
+        self._setDerivedMetric(self.table, [metric], derived[0:2])
+        self._setDerivedMetric(self.aggTable, [metric], derived[2:4])
+
+    def _derivedStat(self, metric, type, flavor):
+        """
+        The `type` statistic of a derived metric over the aggregated
+        profiles, one value per aggregated event, memoized per (metric,
+        flavor, statistic). PPK.AGG gives the [nodes, contexts, threads,
+        events] cube of the metric instead.
+        """
+        key = ("stat", metric, flavor, type)
+        if key not in self.derived:
+            if metric in self.lazyMetrics:
+                column = self._derivedColumn(self.aggTable, metric, flavor)
+
+            # written back, possibly just now
+            if metric not in self.lazyMetrics:
+                column = self.aggTable.values[flavor][:, self.metrics.index(metric)]
+
+            dims = self._aggDims()
+            index = self._aggIndex()
+            inside = self._aggInside(index, dims)
+            events = index[inside, 3]
+
+            values = column[inside]
+
+            if type == PPK.AGG:
+                shape = dims + (len(self.aggEvents),)
+                values = values.astype(self.valueType, copy=False)
+                if self.sparse:
+                    self.derived[key] = SparseCube.SparseCube(shape, index[inside], values)
+                else:
+                    cube = np.zeros(shape, dtype=self.valueType)
+                    cube[tuple(index[inside].T)] = values
+                    self.derived[key] = cube
+            else:
+                stats = self._reduce(events, values[:, None], len(self.aggEvents),
+                                     dims[0] * dims[1] * dims[2])
+                self.derived[key] = stats[type][:, 0]
+
+        return self.derived[key]
+
+    def _setDerivedMetric(self, table, dmetrics, values):
+        """Write the derived metric columns `values` into `table`"""
+        columns = [self.metrics.index(metric) for metric in dmetrics]
+        for flavor in (PPK.EXCLUSIVE, PPK.INCLUSIVE):
+            table.writable(flavor)[:, columns] = values[flavor]
+
+    def _aggColumns(self):
+        """
+        Gather the aggregated profiles of all threads, one row per
+        non-empty (thread, event) pair.
+
+        Returns:
+          (index, exclusive, inclusive): `index` is a [rows, 4] array of
+          (nodeId, contextId, threadId, aggEvents index), the other two
+          are [rows, metrics] arrays of values
+        """
+        if self.compact:
+            return (self._aggIndex(),
+                    self.aggTable.padded(PPK.EXCLUSIVE),
+                    self.aggTable.padded(PPK.INCLUSIVE))
 
-        # handle raw data
-        for profile in self.functionProfiles:
-            profile.updateDerivedMetric(ms, metaSym)
+        aggIndex = self.aggEvents.positions
 
-        # handle aggregated data
+        index = []
+        exclusive = []
+        inclusive = []
         for thread in self.threads:
-            for profile in thread.aggProfiles.values():
-                profile.updateDerivedMetric(ms, metaSym)
+            for name, profile in thread.aggProfiles.items():
+                index.append((thread.nodeId, thread.contextId, thread.threadId,
+                              aggIndex[name]))
+                exclusive.append([profile.exclusive.get(m, 0) for m in self.metrics])
+                inclusive.append([profile.inclusive.get(m, 0) for m in self.metrics])
+
+        shape = (len(index), len(self.metrics))
+        return (np.reshape(np.array(index, dtype=np.intp), (len(index), 4)),
+                np.reshape(np.array(exclusive, dtype=np.float64), shape),
+                np.reshape(np.array(inclusive, dtype=np.float64), shape))
+
+    def _aggIndex(self):
+        """
+        (nodeId, contextId, threadId, aggEvents index) of every row of
+        the aggregated ProfileTable, see _aggColumns()
+        """
+        agg = self.aggTable
+        ids = np.array([(t.nodeId, t.contextId, t.threadId) for t in self.threads],
+                       dtype=np.intp).reshape(-1, 3)
+        index = np.column_stack([ids[agg.thread], agg.function]).astype(np.intp)
 
-    def populateAggData(self):
-        """Populate aggregated data into a numpy array"""
+        return index.reshape(-1, 4)
 
+    def _aggDims(self):
+        """
+        Returns:
+          (dimN, dimC, dimT): node, context and thread extent of the cube
+        """
         dimN = len(self.nodes)
         dimC = 0
         dimT = 0
-        dimE = len(self.aggEvents)
-        dimM = len(self.metrics)
 
         for n in self.nodes.values():
             dimC = max(dimC, len(n.contexts))
@@ -850,43 +2372,86 @@ class PPK:
         for c in self.contexts:
             dimT = max(dimT, len(c.threads))
 
-        self.aggExcArray[PPK.AGG] = np.zeros([dimN, dimC, dimT, dimE, dimM])
-        self.aggIncArray[PPK.AGG] = np.zeros([dimN, dimC, dimT, dimE, dimM])
-        for n, c, t, e, m in product(list(range(dimN)), list(range(dimC)), \
-                                     list(range(dimT)), list(range(dimE)), list(range(dimM))):
-            try:
-                excData = self.nodes[n]. \
-                    contexts[c]. \
-                    threads[t]. \
-                    aggProfiles[self.aggEvents[e]]. \
-                    exclusive[self.metrics[m]]
-            except (KeyError, IndexError) as e:
-                excData = 0
-            finally:
-                self.aggExcArray[PPK.AGG][n, c, t, e, m] = excData
+        return dimN, dimC, dimT
 
-            try:
-                incData = self.nodes[n]. \
-                    contexts[c]. \
-                    threads[t]. \
-                    aggProfiles[self.aggEvents[e]]. \
-                    inclusive[self.metrics[m]]
-            except (KeyError, IndexError) as e:
-                incData = 0
-            finally:
-                self.aggIncArray[PPK.AGG][n, c, t, e, m] = incData
-
-        self.aggExcArray[PPK.SUM] = self.aggExcArray[PPK.AGG].sum((0, 1, 2))
-        self.aggExcArray[PPK.MAX] = self.aggExcArray[PPK.AGG].max((0, 1, 2))
-        self.aggExcArray[PPK.MIN] = self.aggExcArray[PPK.AGG].min((0, 1, 2))
-        self.aggExcArray[PPK.STD] = self.aggExcArray[PPK.AGG].std((0, 1, 2))
-        self.aggExcArray[PPK.MEAN] = self.aggExcArray[PPK.AGG].mean((0, 1, 2))
-
-        self.aggIncArray[PPK.SUM] = self.aggIncArray[PPK.AGG].sum((0, 1, 2))
-        self.aggIncArray[PPK.MAX] = self.aggIncArray[PPK.AGG].max((0, 1, 2))
-        self.aggIncArray[PPK.MIN] = self.aggIncArray[PPK.AGG].min((0, 1, 2))
-        self.aggIncArray[PPK.STD] = self.aggIncArray[PPK.AGG].std((0, 1, 2))
-        self.aggIncArray[PPK.MEAN] = self.aggIncArray[PPK.AGG].mean((0, 1, 2))
+    @staticmethod
+    def _aggInside(index, dims):
+        """
+        Cells are addressed by id, rows of threads with ids beyond the
+        bounding box never make it into the cube
+        """
+        return (index[:, 0] < dims[0]) & (index[:, 1] < dims[1]) & (index[:, 2] < dims[2])
+
+    @staticmethod
+    def _reduce(events, values, dimE, cells):
+        """
+        Statistics over the node, context and thread axes of the cube,
+        computed out of its non-empty rows only. Each of the `cells`
+        (node, context, thread) slots without a row for an event counts
+        as a zero, exactly as in the dense cube.
+
+        Args:
+          events (array): aggEvents index of every row
+          values (array): [rows, metrics] values
+          dimE (int):     number of aggregated events
+          cells (int):    number of (node, context, thread) slots
+
+        Returns:
+          map: PPK.SUM/MAX/MIN/STD/MEAN -> [events, metrics] array
+        """
+        stats = SparseCube.reduce(events, values, dimE, cells)
+
+        return {PPK.SUM: stats["sum"],
+                PPK.MAX: stats["max"],
+                PPK.MIN: stats["min"],
+                PPK.STD: stats["std"],
+                PPK.MEAN: stats["mean"]}
+
+    def populateAggData(self, sparse=None):
+        """
+        Populate aggregated data into a numpy array. The cube is built
+        with a single scatter of the non-empty profiles and the
+        statistics are computed from those rows, so the cost is linear in
+        the number of profiles rather than in the size of the cube. The
+        cube has the precision of the PPK, the statistics are float64.
+
+        Args:
+          sparse (bool): Keep the PPK.AGG cubes as SparseCube, which only
+                         stores the non-empty profiles. By default that
+                         is done when less than SPARSE_DENSITY of the
+                         (node, context, thread, event) cells are filled
+        """
+        # the statistics were computed while parsing, there is no cube
+        if self.online is not None:
+            return
+
+        self._materializeAll()
+
+        dimN, dimC, dimT = self._aggDims()
+        dimE = len(self.aggEvents)
+        dimM = len(self.metrics)
+
+        index, exclusive, inclusive = self._aggColumns()
+
+        inside = self._aggInside(index, (dimN, dimC, dimT))
+        index = index[inside]
+        n, c, t, e = index.T
+
+        cells = dimN * dimC * dimT
+        if sparse is None:
+            sparse = len(index) < PPK.SPARSE_DENSITY * cells * dimE
+        self.sparse = sparse
+
+        shape = (dimN, dimC, dimT, dimE, dimM)
+        for array, values in ((self.aggExcArray, exclusive[inside]),
+                              (self.aggIncArray, inclusive[inside])):
+            if sparse:
+                array[PPK.AGG] = SparseCube.SparseCube(
+                    shape, index, values.astype(self.valueType, copy=False))
+            else:
+                array[PPK.AGG] = np.zeros(shape, dtype=self.valueType)
+                array[PPK.AGG][n, c, t, e] = values
+            array.update(self._reduce(e, values, dimE, cells))
 
     def aggEventsIter(self):
         for e in self.aggEvents:
@@ -927,6 +2492,131 @@ class PPK:
         return self._getAggData(event, metric, PPK.MEAN, PPK.INCLUSIVE)
 
 
+class PPKBuilder:
+    """
+    Assemble a PPK out of arrays, one thread at a time:
+
+      builder = PPKBuilder(["TIME"], {"Application": "pi"})
+      main = builder.addEvent("main")
+      builder.addThread(0, 0, 0, [main], [1], [0], [[2.0]], [[3.0]])
+
+      builder.write("data.ppk")  # stream it to disk, or
+      ppk = builder.build([])    # get the PPK in memory
+    """
+
+    def __init__(self, metrics, metadata=None, version=2):
+        self.header = {
+            "version": version,
+            "compatible": version,
+            "pad1": 0,
+            "bytesToSkip": 0,
+            "metadata": dict(metadata or {}),
+            "metrics": list(metrics),
+            "groups": [],
+            "events": [],
+            "userEvents": [],
+            "threads": [],
+        }
+        self.blocks = []  # per thread column arrays
+
+        self._groupIds = {}
+        self._eventIds = {}
+        self._userEventIds = {}
+
+    def addMetadata(self, name, value):
+        self.header["metadata"][name] = value
+
+    def addGroup(self, name):
+        """Returns: int: id of group `name`"""
+        if name not in self._groupIds:
+            self._groupIds[name] = len(self.header["groups"])
+            self.header["groups"].append(name)
+
+        return self._groupIds[name]
+
+    def addEvent(self, fullname, groups=("TAU_DEFAULT",)):
+        """Returns: int: id of event `fullname`"""
+        if fullname not in self._eventIds:
+            self._eventIds[fullname] = len(self.header["events"])
+            self.header["events"].append([fullname, [self.addGroup(g) for g in groups]])
+
+        return self._eventIds[fullname]
+
+    def addUserEvent(self, name):
+        """Returns: int: id of user event `name`"""
+        if name not in self._userEventIds:
+            self._userEventIds[name] = len(self.header["userEvents"])
+            self.header["userEvents"].append(name)
+
+        return self._userEventIds[name]
+
+    def addThread(self, nodeId, contextId, threadId,
+                  functionIds, numCalls, numSubr, exclusive, inclusive,
+                  metadata=None, userEventIds=(), numSamples=(), userEventValues=()):
+        """
+        Add a thread with its profiles, see PPKWriter.writeThread() for
+        the arrays.
+        """
+        numMetrics = len(self.header["metrics"])
+
+        self.header["threads"].append([nodeId, contextId, threadId, dict(metadata or {})])
+        self.blocks.append((np.asarray(functionIds, dtype=np.int32),
+                            np.asarray(numCalls, dtype=np.float64),
+                            np.asarray(numSubr, dtype=np.float64),
+                            np.reshape(np.asarray(exclusive, dtype=np.float64), (-1, numMetrics)),
+                            np.reshape(np.asarray(inclusive, dtype=np.float64), (-1, numMetrics)),
+                            np.asarray(userEventIds, dtype=np.int32),
+                            np.asarray(numSamples, dtype=np.int32),
+                            np.reshape(np.asarray(userEventValues, dtype=np.float64), (-1, 4))))
+
+    def columns(self):
+        """
+        Returns:
+          map: the profiles of all threads as PPKCache columns
+        """
+        def concat(i, shape):
+            parts = [block[i] for block in self.blocks]
+            return np.concatenate(parts) if parts else np.zeros(shape)
+
+        numMetrics = len(self.header["metrics"])
+        fpThread = [np.full(len(block[0]), i, dtype=np.int32) for i, block in enumerate(self.blocks)]
+        ueThread = [np.full(len(block[5]), i, dtype=np.int32) for i, block in enumerate(self.blocks)]
+
+        return {
+            "fp_thread": np.concatenate(fpThread) if fpThread else np.zeros(0),
+            "fp_function": concat(0, 0),
+            "fp_calls": concat(1, 0),
+            "fp_subr": concat(2, 0),
+            "fp_exclusive": concat(3, (0, numMetrics)),
+            "fp_inclusive": concat(4, (0, numMetrics)),
+            "ue_thread": np.concatenate(ueThread) if ueThread else np.zeros(0),
+            "ue_id": concat(5, 0),
+            "ue_samples": concat(6, 0),
+            "ue_values": concat(7, (0, 4)),
+        }
+
+    def write(self, filename, compresslevel=PPKWriter.COMPRESSLEVEL):
+        """Stream the PPK to `filename`"""
+        header = self.header
+
+        with PPKWriter.PPKWriter(filename, compresslevel) as writer:
+            writer.writeHeader(header["version"], header["compatible"],
+                               header["pad1"], header["bytesToSkip"],
+                               header["metadata"], header["threads"])
+            writer.writeTables(header["metrics"], header["groups"],
+                               header["events"], header["userEvents"])
+
+            for (nodeId, contextId, threadId, metadata), block in zip(header["threads"], self.blocks):
+                writer.writeThread(nodeId, contextId, threadId, *block)
+
+    def build(self, hotspots, compact=False, precision="double"):
+        """
+        Returns:
+          PPK: the assembled data set, see PPK.fromColumns()
+        """
+        return PPK.fromColumns(self.header, self.columns(), hotspots, compact, precision)
+
+
 if __name__ == "__main__":
     ppk = PPK(sys.argv[1], "whatever")
     ppk.addMetadata("AP_CONFIG", "deadbeef")
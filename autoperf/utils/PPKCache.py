@@ -0,0 +1,254 @@
+"""
+Columnar sidecar cache of parsed PPK files.
+
+The sidecar of `data.ppk` is the directory `data.ppk.cache`, which holds
+
+  header.json -- the cache key, the string tables (metadata, metrics,
+                 groups, events, user events) and the thread list
+  *.npy       -- one uncompressed array per column, loaded back with
+                 np.load(mmap_mode='r')
+
+A much smaller thread offset index, `data.ppk.idx`, records where each
+thread block starts in the decompressed stream; lazy PPKs use it to
+avoid scanning the file. See load_index().
+
+Both are keyed by the size, mtime and content hash of the PPK. Size
+and mtime are checked on every load; the content hash is only
+recomputed when the mtime changed but the size did not, so a warm load
+never has to read the PPK itself.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .hashing import content_hash
+
+# bump this whenever the sidecar layout changes
+FORMAT = 1
+
+# column name -> dtype
+COLUMNS = {
+    "fp_thread": np.int32,  # index into the thread list
+    "fp_function": np.int32,  # index into the event table
+    "fp_calls": np.float64,
+    "fp_subr": np.float64,
+    "fp_exclusive": np.float64,  # [profiles, metrics]
+    "fp_inclusive": np.float64,  # [profiles, metrics]
+    "ue_thread": np.int32,
+    "ue_id": np.int32,
+    "ue_samples": np.int32,
+    "ue_values": np.float64,  # [profiles, (min, max, mean, sumSquared)]
+}
+
+logger = logging.getLogger(__name__)
+
+
+def sidecar(filename):
+    """Path of the sidecar directory of PPK `filename`"""
+    return "%s.cache" % filename
+
+
+def _make_key(filename):
+    st = os.stat(filename)
+
+    return {"size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "sha1": content_hash(filename)}
+
+
+def _check_key(filename, key):
+    """
+    Check a cache `key` against PPK `filename`.
+
+    Returns:
+      (fresh, touched): whether the cache is usable, and whether only the
+                        mtime changed, in which case key["mtime"] has been
+                        updated and the caller should persist it
+    """
+    st = os.stat(filename)
+
+    if key["size"] != st.st_size:
+        return False, False
+
+    if key["mtime"] == st.st_mtime_ns:
+        return True, False
+
+    if key["sha1"] != content_hash(filename):
+        return False, False
+
+    # same contents, just touched: remember the new mtime
+    key["mtime"] = st.st_mtime_ns
+    return True, True
+
+
+def _is_fresh(filename, header):
+    if header.get("format") != FORMAT:
+        return False
+
+    fresh, touched = _check_key(filename, header["key"])
+    if touched:
+        try:
+            _write_header(sidecar(filename), header)
+        except OSError:
+            pass
+
+    return fresh
+
+
+def _write_header(path, header):
+    tmp = os.path.join(path, "header.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(header, f)
+    os.replace(tmp, os.path.join(path, "header.json"))
+
+
+def load(filename):
+    """
+    Load the sidecar of PPK `filename`.
+
+    Returns:
+      (header, columns): the header map and a map of column name to
+                         read-only memory-mapped array, or None if there
+                         is no usable sidecar
+    """
+    path = sidecar(filename)
+
+    try:
+        with open(os.path.join(path, "header.json")) as f:
+            header = json.load(f)
+
+        if not _is_fresh(filename, header):
+            logger.info("Stale PPK cache %s, rebuilding", path)
+            return None
+
+        columns = dict()
+        for name in COLUMNS:
+            columns[name] = np.load(os.path.join(path, "%s.npy" % name),
+                                    mmap_mode="r")
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return header, columns
+
+
+def save(filename, header, columns):
+    """
+    Write the sidecar of PPK `filename`. The sidecar is built in a
+    temporary directory and moved into place, so readers never see a
+    half written cache. Failing to write the cache is not fatal.
+
+    Args:
+      header (map):  JSON serializable tables of the PPK
+      columns (map): column name -> array, see COLUMNS
+    """
+    path = sidecar(filename)
+
+    header = dict(header)
+    header["format"] = FORMAT
+    header["key"] = _make_key(filename)
+
+    tmp = None
+    try:
+        tmp = tempfile.mkdtemp(prefix=".%s." % os.path.basename(path),
+                               dir=os.path.dirname(os.path.abspath(path)))
+        for name, dtype in COLUMNS.items():
+            np.save(os.path.join(tmp, "%s.npy" % name),
+                    np.ascontiguousarray(columns[name], dtype=dtype))
+        _write_header(tmp, header)
+
+        _replace(tmp, path)
+    except OSError as e:
+        logger.warning("Can not write PPK cache %s: %s", path, e)
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _replace(tmp, path):
+    """
+    Move the directory `tmp` to `path`. Readers and other writers may
+    be at it concurrently: the current sidecar is renamed away to a
+    unique name first, and if another writer put its own sidecar in
+    place meanwhile, that one is kept and `tmp` is dropped.
+    """
+    stale = tmp + ".stale"
+    try:
+        os.rename(path, stale)
+    except FileNotFoundError:
+        stale = None
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+        logger.debug("PPK cache %s was written concurrently", path)
+        shutil.rmtree(tmp, ignore_errors=True)
+    finally:
+        if stale is not None:
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+def index_path(filename):
+    """Path of the thread offset index of PPK `filename`"""
+    return "%s.idx" % filename
+
+
+def load_index(filename):
+    """
+    Load the thread offset index of PPK `filename`.
+
+    Returns:
+      map: array name -> array as given to save_index(), or None if
+           there is no usable index
+    """
+    path = index_path(filename)
+
+    try:
+        with np.load(path) as data:
+            index = dict((name, data[name]) for name in data.files)
+
+        key = json.loads(str(index.pop("key")))
+        if key.get("format") != FORMAT:
+            return None
+
+        fresh, touched = _check_key(filename, key)
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if not fresh:
+        logger.info("Stale PPK index %s, rebuilding", path)
+        return None
+
+    if touched:
+        _write_index(path, key, index)
+
+    return index
+
+
+def save_index(filename, index):
+    """
+    Write the thread offset index of PPK `filename`. Failing to write
+    the index is not fatal.
+
+    Args:
+      index (map): array name -> array
+    """
+    key = _make_key(filename)
+    key["format"] = FORMAT
+
+    _write_index(index_path(filename), key, index)
+
+
+def _write_index(path, key, index):
+    tmp = "%s.tmp" % path
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(f, key=json.dumps(key), **index)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("Can not write PPK index %s: %s", path, e)
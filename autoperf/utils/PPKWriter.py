@@ -0,0 +1,233 @@
+"""
+Streaming writer of the PPK wire format.
+
+The file is emitted section by section into a gzip stream, and the
+value blocks of every thread go out as one big-endian numpy record array
+each, so writing a trial needs little more memory than its largest
+thread block: write() slices existing columns, such as the ProfileTable
+of a compact PPK or the memory-mapped columns of PPKCache, and
+PPK.dump() feeds the object model to writeThread() one thread at a time.
+
+The tables and columns have the same layout as the ones of PPKCache:
+
+  header  -- version, compatible, pad1, bytesToSkip, metadata, metrics,
+             groups, events ([fullname, groupIds]), userEvents and
+             threads ([nodeId, contextId, threadId, metadata])
+  columns -- fp_thread, fp_function, fp_calls, fp_subr, fp_exclusive,
+             fp_inclusive, ue_thread, ue_id, ue_samples, ue_values
+"""
+
+import gzip
+from struct import pack
+
+import numpy as np
+
+# same as java.util.zip.GZIPOutputStream, which paraprof uses
+COMPRESSLEVEL = 6
+
+
+def function_profile_dtype(numMetrics):
+    """
+    Wire layout of a single function profile record:
+
+      functionId, numCalls, numSubr, numMetrics x (exclusive, inclusive)
+    """
+    return np.dtype([("functionId", ">i4"),
+                     ("numCalls", ">f8"),
+                     ("numSubr", ">f8"),
+                     ("values", ">f8", (numMetrics, 2))])
+
+
+# userEventId, numSamples, min, max, mean, sumSquared
+USER_EVENT_DTYPE = np.dtype([("userEventId", ">i4"),
+                             ("numSamples", ">i4"),
+                             ("values", ">f8", (4,))])
+
+
+def _utf(s):
+    s = s.encode("utf-8")
+    return pack(">H", len(s)) + s
+
+
+def _metadata(metadata):
+    return pack(">i", len(metadata)) + \
+        b"".join(_utf(name) + _utf(value) for name, value in metadata.items())
+
+
+class PPKWriter:
+    """
+    Write a PPK file section by section:
+
+      writer = PPKWriter(filename)
+      writer.writeHeader(version, compatible, pad1, bytesToSkip, metadata, threads)
+      writer.writeTables(metrics, groups, events, userEvents)
+      for thread in threads:
+          writer.writeThread(nodeId, contextId, threadId, ...)
+      writer.close()
+
+    The number of thread blocks is fixed by the `threads` given to
+    writeHeader().
+    """
+
+    def __init__(self, filename, compresslevel=COMPRESSLEVEL):
+        self.filename = filename
+        self.file = gzip.open(filename, "wb", compresslevel=compresslevel)
+
+        self.numThreads = None
+        self.written = 0
+        self.dtype = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def writeHeader(self, version, compatible, pad1, bytesToSkip, metadata, threads):
+        """
+        Args:
+          metadata (map): trial metadata
+          threads (list): (nodeId, contextId, threadId, metadata) of every
+                          thread, in the order of the thread blocks
+        """
+        data = [pack(">BcBcBc", 0, b'P', 0, b'P', 0, b'K'),
+                pack(">ii", version, compatible)]
+
+        if version >= 2:
+            data.append(pack(">ii", pad1, bytesToSkip))
+            data.append(b"\x55" * bytesToSkip)
+
+            data.append(_metadata(metadata))
+            data.append(pack(">i", len(threads)))
+            for nodeId, contextId, threadId, threadMetadata in threads:
+                data.append(pack(">iii", nodeId, contextId, threadId))
+                data.append(_metadata(threadMetadata))
+        else:
+            data.append(pack(">i", bytesToSkip))
+            data.append(b"\x55" * bytesToSkip)
+
+        self.numThreads = len(threads)
+        self.file.write(b"".join(data))
+
+    def writeTables(self, metrics, groups, events, userEvents):
+        """
+        Args:
+          metrics (list):    metric names
+          groups (list):     group names
+          events (list):     (fullname, groupIds) of every event
+          userEvents (list): user event names
+        """
+        data = [pack(">i", len(metrics))]
+        data.extend(_utf(m) for m in metrics)
+
+        data.append(pack(">i", len(groups)))
+        data.extend(_utf(g) for g in groups)
+
+        data.append(pack(">i", len(events)))
+        for fullname, groupIds in events:
+            data.append(_utf(fullname))
+            data.append(pack(">i%di" % len(groupIds), len(groupIds), *groupIds))
+
+        data.append(pack(">i", len(userEvents)))
+        data.extend(_utf(e) for e in userEvents)
+
+        data.append(pack(">i", self.numThreads))
+
+        self.dtype = function_profile_dtype(len(metrics))
+        self.file.write(b"".join(data))
+
+    def writeThread(self, nodeId, contextId, threadId,
+                    functionIds, numCalls, numSubr, exclusive, inclusive,
+                    userEventIds=(), numSamples=(), userEventValues=None):
+        """
+        Write the profiles of one thread.
+
+        Args:
+          functionIds (array):     event ids, one per function profile
+          numCalls (array):        call counts
+          numSubr (array):         subroutine counts
+          exclusive (array):       [profiles, metrics] exclusive values
+          inclusive (array):       [profiles, metrics] inclusive values
+          userEventIds (array):    user event ids, one per user event profile
+          numSamples (array):      sample counts
+          userEventValues (array): [profiles, (min, max, mean, sumSquared)]
+        """
+        if self.written == self.numThreads:
+            raise Exception("More thread blocks than threads in %s" % self.filename)
+
+        records = np.empty(len(functionIds), dtype=self.dtype)
+        records["functionId"] = functionIds
+        records["numCalls"] = numCalls
+        records["numSubr"] = numSubr
+        records["values"][:, :, 0] = exclusive
+        records["values"][:, :, 1] = inclusive
+
+        userEvents = np.empty(len(userEventIds), dtype=USER_EVENT_DTYPE)
+        userEvents["userEventId"] = userEventIds
+        userEvents["numSamples"] = numSamples
+        if len(userEventIds):
+            userEvents["values"] = userEventValues
+
+        self.file.write(pack(">iiii", nodeId, contextId, threadId, len(records)))
+        self.file.write(records.tobytes())
+        self.file.write(pack(">i", len(userEvents)))
+        self.file.write(userEvents.tobytes())
+
+        self.written += 1
+
+    def close(self):
+        if self.numThreads is not None and self.written != self.numThreads:
+            self.file.close()
+            raise Exception("Missing thread blocks in %s" % self.filename)
+
+        self.file.close()
+
+
+def write(filename, header, columns, compresslevel=COMPRESSLEVEL):
+    """
+    Write a whole PPK out of its tables and columns, see the module
+    docstring. Rows of a thread need not be contiguous.
+    """
+    threads = header["threads"]
+    columns = dict((name, np.asarray(column)) for name, column in columns.items())
+
+    fpOrder, fpBounds = _group(columns["fp_thread"], len(threads))
+    ueOrder, ueBounds = _group(columns["ue_thread"], len(threads))
+
+    with PPKWriter(filename, compresslevel) as writer:
+        writer.writeHeader(header["version"], header["compatible"],
+                           header["pad1"], header["bytesToSkip"],
+                           header["metadata"], threads)
+        writer.writeTables(header["metrics"], header["groups"],
+                           header["events"], header["userEvents"])
+
+        numMetrics = len(header["metrics"])
+        for i, (nodeId, contextId, threadId, metadata) in enumerate(threads):
+            fp = fpOrder[fpBounds[i]:fpBounds[i + 1]]
+            ue = ueOrder[ueBounds[i]:ueBounds[i + 1]]
+
+            writer.writeThread(nodeId, contextId, threadId,
+                               columns["fp_function"][fp],
+                               columns["fp_calls"][fp],
+                               columns["fp_subr"][fp],
+                               columns["fp_exclusive"][fp, :numMetrics],
+                               columns["fp_inclusive"][fp, :numMetrics],
+                               columns["ue_id"][ue],
+                               columns["ue_samples"][ue],
+                               columns["ue_values"][ue])
+
+
+def _group(owners, numThreads):
+    """
+    Returns:
+      (order, bounds): row numbers sorted by thread, stable, and where the
+                       rows of each thread begin in there
+    """
+    owners = np.asarray(owners, dtype=np.int64)
+    order = np.argsort(owners, kind="stable")
+    bounds = np.searchsorted(owners[order], np.arange(numThreads + 1))
+
+    return order, bounds
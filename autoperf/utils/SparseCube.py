@@ -0,0 +1,169 @@
+"""
+Sparse storage of the aggregated cube.
+
+Sampling profiles touch a small fraction of the events on every thread,
+so most of the dense [nodes, contexts, threads, events, metrics] cube is
+zeros. A SparseCube keeps the non-empty (node, context, thread, event)
+cells only, in coordinate (COO) form, and computes the statistics over
+the thread axes out of them, counting the missing cells as zeros.
+"""
+
+import numpy as np
+
+
+def reduce(groups, values, numGroups, cells):
+    """
+    Statistics of every group of rows, computed out of the non-empty
+    rows only. Each of the `cells` slots of a group without a row counts
+    as a zero, exactly as in a dense array.
+
+    Args:
+      groups (array):  group of every row
+      values (array):  [rows, ...] values
+      numGroups (int): number of groups
+      cells (int):     number of slots in every group
+
+    Returns:
+      map: "sum", "max", "min", "std" and "mean" -> [groups, ...] float64
+           array
+    """
+    shape = (numGroups,) + values.shape[1:]
+    count = np.bincount(groups, minlength=numGroups).reshape((-1,) + (1,) * (len(shape) - 1))
+
+    total = np.zeros(shape)
+    high = np.full(shape, -np.inf)
+    low = np.full(shape, np.inf)
+    square = np.zeros(shape)
+
+    if len(groups):
+        # segments of rows per group, in row order within each
+        order = np.argsort(groups, kind="stable")
+        groups = groups[order]
+        values = values[order]
+        present, starts = np.unique(groups, return_index=True)
+
+        # sums are accumulated in float64, whatever the precision
+        total[present] = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+        high[present] = np.maximum.reduceat(values, starts, axis=0)
+        low[present] = np.minimum.reduceat(values, starts, axis=0)
+
+    # implicit zeros take part in max/min as well
+    missing = count < cells
+    high = np.where(missing, np.maximum(high, 0), high)
+    low = np.where(missing, np.minimum(low, 0), low)
+
+    mean = total / cells
+
+    # two-pass variance, the implicit zeros deviate by -mean each
+    if len(groups):
+        dev = values - mean[groups]
+        square[present] = np.add.reduceat(dev * dev, starts, axis=0)
+    square += (cells - count) * mean * mean
+
+    return {"sum": total,
+            "max": high,
+            "min": low,
+            "std": np.sqrt(square / cells),
+            "mean": mean}
+
+
+class SparseCube:
+    """
+    An array of shape `shape` whose leading len(coords[0]) axes are
+    sparse: only the cells in `coords` are stored, each with a
+    values[row] of shape shape[len(coords[0]):]. Everything else is zero.
+
+    Reading a cell and reducing over all sparse axes but the last (e.g.
+    cube.max((0, 1, 2)) of the aggregated cube) are done on the stored
+    cells. Anything else goes through a dense copy, see todense().
+    """
+
+    def __init__(self, shape, coords, values):
+        self.shape = tuple(shape)
+        self.coords = np.asarray(coords, dtype=np.intp)
+        self.values = np.asarray(values)
+
+        self.sparse = self.coords.shape[1]
+        if self.values.shape[1:] != self.shape[self.sparse:]:
+            raise Exception("Values do not match the shape of the cube")
+
+        self.rows = None  # cell -> row, see _row()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nnz(self):
+        """Number of stored cells"""
+        return len(self.coords)
+
+    @property
+    def density(self):
+        return self.nnz / max(int(np.prod(self.shape[:self.sparse])), 1)
+
+    @property
+    def nbytes(self):
+        return self.coords.nbytes + self.values.nbytes
+
+    def todense(self):
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        dense[tuple(self.coords.T)] = self.values
+
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.todense()
+        if dtype is not None:
+            dense = dense.astype(dtype, copy=False)
+
+        return dense
+
+    def _row(self, cell):
+        if self.rows is None:
+            self.rows = dict(zip(map(tuple, self.coords.tolist()), range(self.nnz)))
+
+        return self.rows.get(cell)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        cell = key[:self.sparse]
+        if len(cell) == self.sparse and all(isinstance(i, (int, np.integer)) for i in cell):
+            cell = tuple(int(i) if i >= 0 else int(i) + n for i, n in zip(cell, self.shape))
+            row = self._row(cell)
+            if row is None:
+                return np.zeros(self.shape[self.sparse:], dtype=self.dtype)[key[self.sparse:]]
+
+            return self.values[row][key[self.sparse:]]
+
+        return self.todense()[key]
+
+    def _reduce(self, statistic, axis):
+        axis = tuple(sorted(a % self.ndim for a in axis)) if isinstance(axis, tuple) else axis
+        if axis != tuple(range(self.sparse - 1)):
+            return getattr(self.todense(), statistic)(axis)
+
+        cells = int(np.prod(self.shape[:self.sparse - 1]))
+        return reduce(self.coords[:, -1], self.values, self.shape[self.sparse - 1],
+                      cells)[statistic]
+
+    def sum(self, axis=None):
+        return self._reduce("sum", axis)
+
+    def max(self, axis=None):
+        return self._reduce("max", axis)
+
+    def min(self, axis=None):
+        return self._reduce("min", axis)
+
+    def std(self, axis=None):
+        return self._reduce("std", axis)
+
+    def mean(self, axis=None):
+        return self._reduce("mean", axis)
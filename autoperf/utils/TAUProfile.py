@@ -0,0 +1,268 @@
+"""
+Reader of TAU text profiles.
+
+TAU writes one `profile.<node>.<context>.<thread>` file per thread, right
+into the profile directory when it measures a single metric, or into one
+`MULTI__<metric>` sub-directory per metric. A profile file looks like
+
+  3 templated_functions_MULTI_TIME
+  # Name Calls Subrs Excl Incl ProfileCalls # <metadata>...</metadata>
+  "main" 1 1 10 30 0 GROUP="TAU_DEFAULT"
+  ...
+  0 aggregates
+  1 userevents
+  # eventname numevents max min mean sumsqr
+  "Message size" 4 8 1 3.5 70
+
+read() turns a profile directory into a PPKBuilder, so the PPK can be
+built in memory or written out directly, without a round trip through
+`paraprof --pack`. Threads are parsed in worker processes.
+"""
+
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .PPK import PPKBuilder
+
+logger = logging.getLogger(__name__)
+
+PROFILE_RE = re.compile(r"^profile\.(\d+)\.(\d+)\.(\d+)$")
+MULTI_PREFIX = "MULTI__"
+
+# metric of a profile without MULTI__ directories, as paraprof names it
+DEFAULT_METRIC = "TIME"
+
+# threads handed to a worker at once
+CHUNKSIZE = 64
+
+
+def _profiles(directory):
+    """
+    Returns:
+      map: (node, context, thread) -> path of its profile in `directory`
+    """
+    rv = dict()
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return rv
+
+    for entry in entries:
+        m = PROFILE_RE.match(entry.name)
+        if m is not None:
+            rv[tuple(int(i) for i in m.groups())] = entry.path
+
+    return rv
+
+
+def find(path):
+    """
+    Locate the profiles under `path`.
+
+    Returns:
+      (list, map): the metric names, and (node, context, thread) -> list of
+                   profile paths, one per metric (None where a metric has no
+                   profile for that thread). Both are empty when `path`
+                   holds no TAU text profiles
+    """
+    multi = []
+    try:
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.name.startswith(MULTI_PREFIX) and entry.is_dir():
+                multi.append((entry.name[len(MULTI_PREFIX):], entry.path))
+    except OSError:
+        return [], {}
+
+    if multi:
+        metrics = [metric for metric, directory in multi]
+        perMetric = [_profiles(directory) for metric, directory in multi]
+    else:
+        perMetric = [_profiles(path)]
+        metrics = [_metric(next(iter(perMetric[0].values())))] if perMetric[0] else []
+
+    if not metrics or not any(perMetric):
+        return [], {}
+
+    threads = sorted(set().union(*perMetric))
+    return metrics, dict((t, [profiles.get(t) for profiles in perMetric]) for t in threads)
+
+
+def _metric(filename):
+    """Name of the metric of a single metric profile"""
+    with open(filename) as f:
+        header = f.readline()
+
+    m = re.match(r"\s*\d+\s+templated_functions_MULTI_(\S+)", header)
+    return m.group(1) if m is not None else DEFAULT_METRIC
+
+
+def _metadata(line):
+    """Thread metadata out of the XML trailing the column header"""
+    start = line.find("<metadata")
+    if start < 0:
+        return {}
+
+    try:
+        root = ET.fromstring(line[start:].strip())
+    except ET.ParseError:
+        logger.warning("Ignoring malformed profile metadata")
+        return {}
+
+    return dict((a.findtext("name", ""), a.findtext("value", ""))
+                for a in root.iter("attribute"))
+
+
+def parse(filename):
+    """
+    Parse one profile file.
+
+    Returns:
+      map: "functions" -> list of (name, groups, calls, subrs, exclusive,
+           inclusive), "metadata" -> map, "userEvents" -> list of (name,
+           numSamples, min, max, mean, sumSquared)
+    """
+    with open(filename, errors="replace") as f:
+        lines = f.read().split("\n")
+
+    numFunctions = int(lines[0].split()[0])
+    metadata = _metadata(lines[1])
+
+    functions = []
+    for line in lines[2:2 + numFunctions]:
+        head, sep, groups = line.rpartition(' GROUP="')
+        if not sep:
+            head, groups = line, ""
+
+        end = head.rindex('"')
+        calls, subrs, exclusive, inclusive = head[end + 1:].split()[:4]
+        functions.append((head[head.index('"') + 1:end],
+                          [g.strip() for g in groups.rstrip().rstrip('"').split("|") if g.strip()],
+                          float(calls), float(subrs), float(exclusive), float(inclusive)))
+
+    userEvents = []
+    i = 2 + numFunctions
+    while i < len(lines):
+        words = lines[i].split()
+        i += 1
+        if len(words) < 2:
+            continue
+
+        if words[1] == "aggregates":
+            i += int(words[0])
+        elif words[1] == "userevents":
+            # skip the column header
+            for line in lines[i + 1:i + 1 + int(words[0])]:
+                end = line.rindex('"')
+                numSamples, high, low, mean, sumSquared = line[end + 1:].split()[:5]
+                userEvents.append((line[line.index('"') + 1:end], int(float(numSamples)),
+                                   float(low), float(high), float(mean), float(sumSquared)))
+            break
+
+    return {"functions": functions, "metadata": metadata, "userEvents": userEvents}
+
+
+def _readThread(filenames):
+    """
+    Parse the profiles of one thread, one per metric, and line them up
+    into [functions, metrics] arrays. Functions are in the order of
+    their first appearance, missing values are zeros.
+    """
+    names = []
+    groups = []
+    rows = dict()
+    parsed = [parse(f) if f is not None else None for f in filenames]
+
+    for profile in parsed:
+        if profile is None:
+            continue
+        for name, g, calls, subrs, exclusive, inclusive in profile["functions"]:
+            if name not in rows:
+                rows[name] = len(names)
+                names.append(name)
+                groups.append(g)
+
+    numCalls = np.zeros(len(names))
+    numSubr = np.zeros(len(names))
+    exclusive = np.zeros((len(names), len(filenames)))
+    inclusive = np.zeros((len(names), len(filenames)))
+
+    # calls are the same for every metric, take the first one seen
+    counted = np.zeros(len(names), dtype=bool)
+    for m, profile in enumerate(parsed):
+        if profile is None:
+            continue
+        for name, g, calls, subrs, excl, incl in profile["functions"]:
+            row = rows[name]
+            if not counted[row]:
+                numCalls[row] = calls
+                numSubr[row] = subrs
+                counted[row] = True
+            exclusive[row, m] = excl
+            inclusive[row, m] = incl
+
+    first = next(profile for profile in parsed if profile is not None)
+
+    return {"names": names, "groups": groups, "numCalls": numCalls, "numSubr": numSubr,
+            "exclusive": exclusive, "inclusive": inclusive,
+            "metadata": first["metadata"], "userEvents": first["userEvents"]}
+
+
+def read(path, metadata=None, processes=None):
+    """
+    Read the TAU text profiles under `path`.
+
+    Args:
+      path (string):   profile directory, holding either profile.N.C.T
+                       files or MULTI__<metric> directories of them
+      metadata (map):  trial metadata of the PPK
+      processes (int): Size of the process pool, defaults to the number of
+                       CPUs. With 1, everything runs in this process
+
+    Returns:
+      PPKBuilder: the profiles, see PPKBuilder.build() and write()
+    """
+    metrics, threads = find(path)
+    if not threads:
+        raise Exception("Can not find TAU profiles in `%s`" % path)
+
+    ids = sorted(threads)
+    files = [threads[t] for t in ids]
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(files) // CHUNKSIZE + 1))
+
+    logger.info("Reading %d TAU profiles of %d metrics with %d processes",
+                len(files), len(metrics), processes)
+
+    if processes == 1:
+        results = map(_readThread, files)
+        return _assemble(metrics, metadata, ids, results)
+
+    with ProcessPoolExecutor(processes) as pool:
+        results = pool.map(_readThread, files, chunksize=CHUNKSIZE)
+        return _assemble(metrics, metadata, ids, results)
+
+
+def _assemble(metrics, metadata, ids, results):
+    builder = PPKBuilder(metrics, metadata)
+
+    for (nodeId, contextId, threadId), thread in zip(ids, results):
+        functionIds = [builder.addEvent(name, groups or ("TAU_DEFAULT",))
+                       for name, groups in zip(thread["names"], thread["groups"])]
+
+        userEvents = thread["userEvents"]
+        builder.addThread(nodeId, contextId, threadId, functionIds,
+                          thread["numCalls"], thread["numSubr"],
+                          thread["exclusive"], thread["inclusive"],
+                          metadata=thread["metadata"],
+                          userEventIds=[builder.addUserEvent(u[0]) for u in userEvents],
+                          numSamples=[u[1] for u in userEvents],
+                          userEventValues=[u[2:] for u in userEvents])
+
+    return builder
@@ -141,14 +141,18 @@ class Config:
 
         try:
             section, option = self._unpack_spec(spec)
+            # comments are stripped before the value is converted
+            value = self._strip_comments(self.cfg_parser.get(section, option))
             if datatype is None:
-                return self._strip_comments(self.cfg_parser.get(section, option))
+                return value
             elif datatype == "int":
-                return self._strip_comments(self.cfg_parser.getint(section, option))
+                return int(value)
             elif datatype == "float":
-                return self._strip_comments(self.cfg_parser.getfloat(section, option))
+                return float(value)
             elif datatype == "boolean":
-                return self._strip_comments(self.cfg_parser.getboolean(section, option))
+                if value.lower() not in self.cfg_parser.BOOLEAN_STATES:
+                    raise ValueError("Not a boolean: %s" % value)
+                return self.cfg_parser.BOOLEAN_STATES[value.lower()]
             else:
                 raise configparser.Error("invalid data type")
         except configparser.Error:
@@ -0,0 +1,20 @@
+"""
+Content hashes of files, the keys of the caches autoperf keeps next to
+its inputs or under ~/.cache/autoperf.
+"""
+
+import hashlib
+
+
+def content_hash(filename):
+    """
+    Returns:
+      string: hex SHA-1 of the contents of `filename`, read in 1 MiB
+              chunks
+    """
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
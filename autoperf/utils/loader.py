@@ -0,0 +1,210 @@
+"""
+Load several PPK files at once.
+
+Every file is parsed in a worker process, which leaves the columnar
+sidecar (see PPKCache) behind. The parent then maps the sidecars back in
+without parsing anything. If asked to, the workers also evaluate the
+derived metrics and aggregate the data; the derived columns come back as
+plain numpy arrays, never as a pickled object graph. The aggregated
+cubes and statistics are written as .npy files into the sidecar and
+memory mapped by the parent, so they do not go through the pool's pipe
+at all. Lazily attached metric sets are left to the parent, which
+evaluates a derived metric only when it is read. Without a sidecar, the
+columns of the PPK come back instead, so no file is parsed twice.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from . import PPKCache
+from . import SparseCube
+from .PPK import PPK
+
+logger = logging.getLogger(__name__)
+
+
+def _load(filename, hotspots, metric_set, aggregate, lazy, precision):
+    """load() of a single file, in this process"""
+    ppk = PPK(filename, hotspots, cache=True, compact=True, precision=precision)
+
+    if metric_set is not None:
+        ppk.attachMetricSet(metric_set, lazy=lazy)
+
+    if aggregate:
+        ppk.populateAggData()
+
+    return ppk
+
+
+def _prepare(filename, hotspots, metric_set, aggregate, precision):
+    """
+    Worker side of load(): parse `filename` into its sidecar and do the
+    heavy lifting the parent asked for.
+
+    Returns:
+      map: "derived" -> per table (raw, aggregated) and flavor, the
+           derived metric columns; "agg" -> see _saveAgg(), or
+           "aggArrays" -> (aggExcArray, aggIncArray, sparse) if that
+           fails; "columns" -> the tables and columns of the PPK, see
+           PPK.fromColumns(), if the sidecar could not be written
+    """
+    ppk = PPK(filename, hotspots, cache=True, compact=True, precision=precision)
+
+    rv = {}
+    if PPKCache.load(filename) is None:
+        # the parent would have to parse the file again
+        rv["columns"] = ppk._saveColumns()
+
+    if metric_set is not None:
+        ppk.attachMetricSet(metric_set)
+
+        columns = [ppk.metrics.index(metric) for metric in metric_set.dmetrics]
+        rv["derived"] = [[table.values[flavor][:, columns]
+                          for flavor in (PPK.EXCLUSIVE, PPK.INCLUSIVE)]
+                         for table in (ppk.table, ppk.aggTable)]
+
+    if aggregate:
+        ppk.populateAggData()
+        agg = _saveAgg(filename, ppk)
+        if agg is not None:
+            rv["agg"] = agg
+        else:
+            rv["aggArrays"] = (ppk.aggExcArray, ppk.aggIncArray, ppk.sparse)
+
+    return rv
+
+
+def _saveAgg(filename, ppk):
+    """
+    Write the aggregated data of `ppk` into a fresh directory next to
+    the sidecar of `filename`, one .npy file per flavor and statistic. A
+    sparse PPK.AGG cube is written as its coordinates and values. The
+    directory is not inside the sidecar, which is replaced as a whole
+    whenever it is rebuilt.
+
+    Returns:
+      (string, list, tuple, bool): the directory, the statistics, the
+                                   shape of the cube and whether it is
+                                   sparse; None if the directory is
+                                   not writable
+    """
+    path = PPKCache.sidecar(filename)
+
+    directory = None
+    try:
+        directory = tempfile.mkdtemp(prefix=".%s.agg." % os.path.basename(path),
+                                     dir=os.path.dirname(os.path.abspath(path)))
+        for flavor, array in enumerate((ppk.aggExcArray, ppk.aggIncArray)):
+            for key, value in array.items():
+                path = os.path.join(directory, "%d-%d" % (flavor, key))
+                if isinstance(value, SparseCube.SparseCube):
+                    np.save(path + ".coords.npy", value.coords)
+                    np.save(path + ".values.npy", value.values)
+                else:
+                    np.save(path + ".npy", value)
+    except OSError as e:
+        logger.warning("Can not write the aggregated data of %s: %s", filename, e)
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+        return None
+
+    return directory, list(ppk.aggExcArray), ppk.aggExcArray[PPK.AGG].shape, ppk.sparse
+
+
+def _loadAgg(ppk, directory, keys, shape, sparse):
+    """Memory map the aggregated data _saveAgg() wrote into `ppk`"""
+    ppk.sparse = sparse
+    for flavor, array in enumerate((ppk.aggExcArray, ppk.aggIncArray)):
+        for key in keys:
+            path = os.path.join(directory, "%d-%d" % (flavor, key))
+            if sparse and key == PPK.AGG:
+                array[key] = SparseCube.SparseCube(
+                    shape, np.load(path + ".coords.npy", mmap_mode="r"),
+                    np.load(path + ".values.npy", mmap_mode="r"))
+            else:
+                array[key] = np.load(path + ".npy", mmap_mode="r")
+
+    # the mappings outlive the files
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def _finish(filename, hotspots, metric_set, result, lazy, precision):
+    """Parent side of load(): assemble the PPK `result` belongs to"""
+    if "columns" in result:
+        ppk = PPK.fromColumns(*result["columns"], hotspots, compact=True, precision=precision)
+        ppk.filename = filename
+    else:
+        ppk = PPK(filename, hotspots, cache=True, compact=True, precision=precision)
+
+    if lazy and metric_set is not None:
+        ppk.attachMetricSet(metric_set, lazy=True)
+
+    if "derived" in result:
+        if not metric_set.nmetrics <= set(ppk.metrics):
+            raise Exception("MetricSet is bigger than PPK metrics")
+
+        ppk.metrics.extend(metric_set.dmetrics)
+        for table, values in zip((ppk.table, ppk.aggTable), result["derived"]):
+            ppk._setDerivedMetric(table, metric_set.dmetrics, values)
+
+    if "agg" in result:
+        _loadAgg(ppk, *result["agg"])
+    elif "aggArrays" in result:
+        ppk.aggExcArray, ppk.aggIncArray, ppk.sparse = result["aggArrays"]
+
+    return ppk
+
+
+def load(filenames, hotspots, metric_set=None, aggregate=False, processes=None,
+         lazy=False, precision="double"):
+    """
+    Load the PPK files `filenames` concurrently, in compact mode.
+
+    Args:
+      filenames (list):    Paths to .ppk files
+      hotspots (list):     Regexes of source files we are interested in
+      metric_set (object): MetricSet to attach to every PPK, or None
+      aggregate (bool):    Also populate the aggregated data
+      processes (int):     Size of the process pool, defaults to the number
+                           of CPUs. With 1, everything runs in this process
+      lazy (bool):         Attach `metric_set` lazily, see
+                           PPK.attachMetricSet()
+      precision (string):  "double" or "single", see PPK
+
+    Returns:
+      list: the PPKs, in the order of `filenames`. A file given more than
+            once is loaded once, and the same PPK is returned for each
+            occurrence
+    """
+    # files given twice would have two workers writing the same sidecar
+    unique = dict()
+    for f in filenames:
+        unique.setdefault(os.path.abspath(f), f)
+    keys = [os.path.abspath(f) for f in filenames]
+    filenames = list(unique.values())
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(filenames)))
+
+    if processes == 1:
+        ppks = [_load(f, hotspots, metric_set, aggregate, lazy, precision)
+                for f in filenames]
+    else:
+        logger.info("Loading %d PPK files with %d processes", len(filenames), processes)
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(_prepare, f, hotspots,
+                                   None if lazy else metric_set, aggregate, precision)
+                       for f in filenames]
+            results = [future.result() for future in futures]
+
+        ppks = [_finish(f, hotspots, metric_set, result, lazy, precision)
+                for f, result in zip(filenames, results)]
+
+    ppks = dict(zip(unique, ppks))
+    return [ppks[key] for key in keys]
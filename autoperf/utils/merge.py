@@ -0,0 +1,155 @@
+"""
+Merge the data sets of several iterations of an experiment.
+
+Every iteration measures a part of the metrics, on the same threads and
+mostly the same events. merge() lines the parts up in memory: events
+are matched by full name, user events by name and threads by (node,
+context, thread) id. Profiles missing from a part count as zeros.
+
+Metrics measured by more than one iteration, typically TIME, are either
+averaged over the iterations or kept once per iteration, see SHARED.
+"""
+
+import re
+
+import numpy as np
+
+from .PPK import PPKBuilder
+
+# how metrics measured by several iterations are merged:
+#   "average" -- one metric, the mean over the iterations measuring it
+#   "keep"    -- the first iteration keeps the name, the others add
+#                copies named <metric>_<label>, e.g. TIME_iter01, with
+#                the label reduced to letters, digits and underscores so
+#                that MathExp reads the copy as a single variable ("@"
+#                separates the interval of a metric, "-" subtracts)
+SHARED = ("average", "keep")
+
+
+def merge(parts, labels=None, shared="average"):
+    """
+    Args:
+      parts (list):  (header, columns) of every iteration, laid out like
+                     PPKBuilder.header and PPKBuilder.columns()
+      labels (list): name of every iteration, used to name the copies of
+                     shared metrics. Defaults to the position in `parts`
+      shared (string): "average" or "keep", see SHARED
+
+    Returns:
+      PPKBuilder: the merged data set. Calls and subroutine counts,
+                  user events and metadata come from the first iteration
+                  that has them
+    """
+    if shared not in SHARED:
+        raise Exception("Invalid shared metric mode `%s` (Available: %s)"
+                        % (shared, ", ".join(SHARED)))
+
+    if labels is None:
+        labels = [str(i) for i in range(len(parts))]
+
+    # metric columns of every part in the merged data set
+    metrics = []
+    columnOf = []
+    for (header, columns), label in zip(parts, labels):
+        cols = []
+        for metric in header["metrics"]:
+            if metric in metrics and shared == "keep":
+                metric = "%s_%s" % (metric, re.sub(r"\W", "", label))
+            if metric not in metrics:
+                metrics.append(metric)
+            cols.append(metrics.index(metric))
+        columnOf.append(np.array(cols, dtype=np.intp))
+
+    metadata = dict()
+    for header, columns in reversed(parts):
+        metadata.update(header["metadata"])
+
+    builder = PPKBuilder(metrics, metadata)
+
+    # tables, threads in id order
+    threads = dict()
+    for header, columns in parts:
+        for nodeId, contextId, threadId, meta in header["threads"]:
+            threads.setdefault((nodeId, contextId, threadId), meta)
+    ids = sorted(threads)
+    threadIndex = dict((t, i) for i, t in enumerate(ids))
+
+    eventOf = []
+    userEventOf = []
+    threadOf = []
+    for header, columns in parts:
+        eventOf.append(np.array([builder.addEvent(name, [header["groups"][g] for g in groups])
+                                 for name, groups in header["events"]], dtype=np.intp))
+        userEventOf.append(np.array([builder.addUserEvent(name) for name in header["userEvents"]],
+                                    dtype=np.intp))
+        threadOf.append(np.array([threadIndex[tuple(t[:3])] for t in header["threads"]],
+                                 dtype=np.intp))
+
+    numEvents = len(builder.header["events"])
+    numUserEvents = max(len(builder.header["userEvents"]), 1)
+
+    # one row per (thread, event) of any part, contiguous per thread
+    keys = [threadOf[p][np.asarray(c["fp_thread"], dtype=np.intp)] * numEvents +
+            eventOf[p][np.asarray(c["fp_function"], dtype=np.intp)]
+            for p, (h, c) in enumerate(parts)]
+    rows, inverse = np.unique(np.concatenate(keys), return_inverse=True) if keys \
+        else (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+    inverse = np.split(inverse.reshape(-1), np.cumsum([len(k) for k in keys])[:-1])
+
+    numCalls = np.zeros(len(rows))
+    numSubr = np.zeros(len(rows))
+    exclusive = np.zeros((len(rows), len(metrics)))
+    inclusive = np.zeros((len(rows), len(metrics)))
+
+    # number of parts measuring every (thread, metric), to average over
+    measured = np.zeros((len(ids), len(metrics)))
+
+    # earlier parts are written last, so the first one wins
+    for p in reversed(range(len(parts))):
+        header, columns = parts[p]
+        where = inverse[p]
+        cols = columnOf[p]
+
+        numCalls[where] = columns["fp_calls"]
+        numSubr[where] = columns["fp_subr"]
+
+        exc = np.reshape(columns["fp_exclusive"], (-1, len(cols)))
+        inc = np.reshape(columns["fp_inclusive"], (-1, len(cols)))
+        np.add.at(exclusive, (where[:, None], cols[None, :]), exc)
+        np.add.at(inclusive, (where[:, None], cols[None, :]), inc)
+
+        np.add.at(measured, (threadOf[p][:, None], cols[None, :]), 1)
+
+    rowThread = rows // numEvents
+    if len(rows):
+        scale = 1.0 / np.maximum(measured[rowThread], 1)
+        exclusive *= scale
+        inclusive *= scale
+
+    # user events, the first part that has one wins
+    userEvents = dict()
+    for p, (header, columns) in enumerate(parts):
+        owners = threadOf[p][np.asarray(columns["ue_thread"], dtype=np.intp)]
+        events = userEventOf[p][np.asarray(columns["ue_id"], dtype=np.intp)]
+        values = np.reshape(columns["ue_values"], (-1, 4))
+        for t, e, n, v in zip(owners.tolist(), events.tolist(),
+                              np.asarray(columns["ue_samples"]).tolist(), values.tolist()):
+            userEvents.setdefault(t * numUserEvents + e, (t, e, n, v))
+
+    perThread = [[] for t in ids]
+    for key in sorted(userEvents):
+        t, e, n, v = userEvents[key]
+        perThread[t].append((e, n, v))
+
+    bounds = np.searchsorted(rowThread, np.arange(len(ids) + 1))
+    for i, t in enumerate(ids):
+        begin, end = bounds[i], bounds[i + 1]
+        ues = perThread[i]
+        builder.addThread(*t, rows[begin:end] % numEvents, numCalls[begin:end],
+                          numSubr[begin:end], exclusive[begin:end], inclusive[begin:end],
+                          metadata=threads[t],
+                          userEventIds=[u[0] for u in ues],
+                          numSamples=[u[1] for u in ues],
+                          userEventValues=[u[2] for u in ues])
+
+    return builder
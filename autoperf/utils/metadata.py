@@ -1,8 +1,17 @@
+import json
+import logging
+import os
 import re
+import socket
 
 from os import listdir
 from os.path import join
 
+logger = logging.getLogger(__name__)
+
+# probe name -> metadata of this host, filled on first use. See _probe()
+_cache = dict()
+
 
 class _CPUInfo:
     def __eq__(self, other):
@@ -18,6 +27,10 @@ class _CPUInfo:
         # get cache info
         sysfs = "/sys/devices/system/cpu/cpu%d" % cpuid
         for d in listdir(join(sysfs, "cache")):
+            # there are files like "uevent" next to the index* directories
+            if not d.startswith("index"):
+                continue
+
             index = join(sysfs, "cache", d)
 
             with open(join(index, "level")) as f:
@@ -49,6 +62,15 @@ class _CPUInfo:
         with open(join(sysfs, "topology", "physical_package_id")) as f:
             self.physical_id = int(f.read())
 
+        # nominal clock rate, cpufreq knows better than /proc/cpuinfo,
+        # which shows the current one
+        self.hz = None
+        try:
+            with open(join(sysfs, "cpufreq", "cpuinfo_max_freq")) as f:
+                self.hz = int(f.read()) * 1000
+        except (OSError, ValueError):
+            pass
+
         # get other info from /proc/cpuinfo
         for line in procinfo.split('\n'):
             m = re.match(r"model name\s*: (.*)", line)
@@ -59,6 +81,10 @@ class _CPUInfo:
             if m is not None:
                 self.cores = int(m.group(1))
 
+            m = re.match(r"cpu MHz\s*: (.*)", line)
+            if m is not None and self.hz is None:
+                self.hz = float(m.group(1)) * 1e6
+
             m = re.match(r"physical id\s*: (.*)", line)
             if m is not None:
                 if self.physical_id != int(m.group(1)):
@@ -66,38 +92,39 @@ class _CPUInfo:
 
 
 def _get_cpu_info():
+    """
+    Probe CPU 0 only, the rest of the machine is summarized out of
+    /proc/cpuinfo, which is read once
+    """
     metadata = dict()
 
     with open("/proc/cpuinfo") as f:
-        procinfo = f.read().split('\n\n')
+        text = f.read()
 
-    procinfo = [info for info in procinfo if info != '']
+    procinfo = [info for info in text.split('\n\n') if info.strip() != '']
 
     # CPU core / thread number
     metadata["META_CORE_NUM"] = len(procinfo)
 
-    cpuinfo = []
-    physical_id = set()
-    for cpuid in range(len(procinfo)):
-        cpuinfo.append(_CPUInfo(cpuid, procinfo[cpuid]))
+    if len(set(re.findall(r"^model name\s*: (.*)$", text, re.M))) > 1:
+        raise Exception("Different CPU models are installed")
 
-    for cpuid in range(len(procinfo)):
-        a = cpuinfo[cpuid]
-        b = cpuinfo[(cpuid + 1) % len(procinfo)]
-        if a != b:
-            raise Exception("Different CPU models are installed")
-        else:
-            physical_id.add(a.physical_id)
+    cpuinfo = _CPUInfo(0, procinfo[0])
 
     # cache size in kB
-    for key in cpuinfo[0].cache:
-        metadata["META_" + key + "SIZE"] = cpuinfo[0].cache[key]
+    for key in cpuinfo.cache:
+        metadata["META_" + key + "SIZE"] = cpuinfo.cache[key]
 
     # physical CPU number
-    metadata["META_CPU_NUM"] = len(physical_id)
+    physical_id = set(re.findall(r"^physical id\s*: (\d+)$", text, re.M))
+    metadata["META_CPU_NUM"] = max(len(physical_id), 1)
 
     # CPU model
-    metadata["META_CPU_MODEL"] = cpuinfo[0].model
+    metadata["META_CPU_MODEL"] = cpuinfo.model
+
+    # clock rate in Hz
+    if cpuinfo.hz is not None:
+        metadata["META_CPU_HZ"] = cpuinfo.hz
 
     return metadata
 
@@ -118,11 +145,156 @@ def _get_memory_info():
     return metadata
 
 
-def get_sys_info():
-    cpu = _get_cpu_info()
-    memory = _get_memory_info()
+# probe name -> function
+_PROBES = {
+    "cpu": _get_cpu_info,
+    "memory": _get_memory_info,
+}
+
+
+def _probe_of(symbol):
+    """Name of the probe which provides META_* `symbol`"""
+    if symbol == "META_MEM_SIZE":
+        return "memory"
+
+    return "cpu"
+
+
+def _boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cache_path():
+    """
+    On-disk cache of the probes of this host. It lives as long as the
+    boot it was written in, see _probe()
+    """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+
+    return join(base, "autoperf", "sysinfo-%s.json" % socket.gethostname())
+
+
+def _load_cache(path, boot):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if data.get("boot_id") != boot:
+        return {}
+
+    return data.get("probes", {})
+
+
+def _save_cache(path, boot, probes):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump({"boot_id": boot, "probes": probes}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug("Can not write system info cache %s: %s", path, e)
+
+
+def _probe(name):
+    """
+    Run probe `name`, unless it already ran in this process or since
+    this host booted. Machines are not expected to change without a
+    reboot.
+    """
+    if name in _cache:
+        return _cache[name]
+
+    boot = _boot_id()
+    path = _cache_path()
+
+    probes = _load_cache(path, boot) if boot is not None else {}
+    if name not in probes:
+        probes[name] = _PROBES[name]()
+        if boot is not None:
+            _save_cache(path, boot, probes)
+
+    _cache.update(probes)
+
+    return _cache[name]
+
+
+def get_sys_info(symbols=None):
+    """
+    System metadata of this host.
+
+    Args:
+      symbols (iterable): only these META_* symbols are wanted; only the
+                          probes providing them run. None for everything
+
+    Returns:
+      map: META_* symbol -> value
+    """
+    if symbols is None:
+        probes = list(_PROBES)
+    else:
+        symbols = set(symbols)
+        probes = sorted(set(_probe_of(s) for s in symbols if s.startswith("META_")))
+
+    metadata = dict()
+    for name in probes:
+        metadata.update(_probe(name))
+
+    if symbols is not None:
+        metadata = dict((k, v) for k, v in metadata.items() if k in symbols)
+
+    return metadata
+
+
+def _number(value):
+    m = re.match(r"\s*([-+]?[0-9.]+(?:[eE][-+]?\d+)?)", value)
+    return float(m.group(1))
+
+
+# TAU metadata name -> (META_* symbol, conversion)
+_TAU_METADATA = {
+    "CPU MHz": ("META_CPU_HZ", lambda v: _number(v) * 1e6),
+    "CPU Type": ("META_CPU_MODEL", str.strip),
+    "Memory Size": ("META_MEM_SIZE", lambda v: int(_number(v))),  # "... kB"
+}
+
+
+def get_recorded_info(metadata):
+    """
+    System metadata recorded in a profile, i.e. of the machine it was
+    collected on.
+
+    Args:
+      metadata (map): profile metadata, name -> string value. META_*
+                      entries are taken as they are, known TAU entries
+                      are translated; explicit META_* entries win
+
+    Returns:
+      map: META_* symbol -> value
+    """
+    rv = dict()
+
+    for name, (symbol, convert) in _TAU_METADATA.items():
+        if name in metadata:
+            try:
+                rv[symbol] = convert(metadata[name])
+            except (AttributeError, ValueError):
+                pass
+
+    for name, value in metadata.items():
+        if name.startswith("META_"):
+            try:
+                rv[name] = float(value)
+            except (TypeError, ValueError):
+                rv[name] = value
 
-    return dict(list(cpu.items()) + list(memory.items()))
+    return rv
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import struct
+
+import numpy as np
+import pytest
+
+from . import GProf
+from .PPK import PPK
+
+OUTPUT = """Flat profile:
+
+Each sample counts as 0.01 seconds.
+  %   cumulative   self              self     total
+ time   seconds   seconds    calls  ms/call  ms/call  name
+ 60.00      0.06     0.06        1    60.00    90.00  compute
+ 30.00      0.09     0.03        3    10.00    10.00  helper(int, char*)
+ 10.00      0.10     0.01                             main
+
+\t\t\tCall graph
+
+
+granularity: each sample hit covers 2 byte(s) for 10.00% of 0.10 seconds
+
+index % time    self  children    called     name
+                0.06    0.03       1/1           main [2]
+[1]     90.0    0.06    0.03       1+2       compute [1]
+                0.03    0.00       3/3           helper(int, char*) [3]
+                                   2             compute [1]
+-----------------------------------------------
+                                                 <spontaneous>
+[2]    100.0    0.01    0.09                 main [2]
+                0.06    0.03       1/1           compute [1]
+-----------------------------------------------
+                0.03    0.00       3/3           compute [1]
+[3]     30.0    0.03    0.00       3         helper(int, char*) [3]
+-----------------------------------------------
+
+Index by function name
+
+   [1] compute                 [3] helper(int, char*)   [2] main
+"""
+
+
+def write_gmon(path, counts, arcs, lowpc=0x1000):
+    data = b"gmon" + struct.pack("@I", 1) + b"\0" * 12
+    data += bytes([0]) + struct.pack("@PP", lowpc, lowpc + 2 * len(counts))
+    data += struct.pack("@II", len(counts), 100) + b"seconds".ljust(15, b"\0") + b"s"
+    data += np.array(counts, dtype=np.uint16).tobytes()
+    for frompc, selfpc, count in arcs:
+        data += bytes([1]) + struct.pack("@PPI", frompc, selfpc, count)
+
+    path.write_bytes(data)
+
+
+def test_merge(tmp_path):
+    write_gmon(tmp_path / "gmon.out.1", [1, 0, 60000], [(0x1002, 0x1004, 1)])
+    write_gmon(tmp_path / "gmon.out.2", [2, 5, 10000], [(0x1002, 0x1004, 2), (0x1004, 0x1000, 7)])
+
+    assert GProf.merge([str(tmp_path / "gmon.out.1"), str(tmp_path / "gmon.out.2")],
+                       str(tmp_path / "gmon.sum")) == 2
+
+    merged = GProf.read_gmon(str(tmp_path / "gmon.sum"))
+    [counts] = merged["hist"].values()
+    assert counts.tolist() == [3, 5, 0xffff]  # saturated
+    assert merged["arcs"] == {(0x1002, 0x1004): 3, (0x1004, 0x1000): 7}
+
+
+def test_merge_relocated(tmp_path):
+    # the same position independent executable, loaded at two addresses
+    write_gmon(tmp_path / "gmon.out.1", [1, 0, 4], [(0x1002, 0x1004, 1)])
+    write_gmon(tmp_path / "gmon.out.2", [2, 5, 1], [(0x7f02, 0x7f04, 2)], lowpc=0x7f00)
+
+    GProf.merge([str(tmp_path / "gmon.out.1"), str(tmp_path / "gmon.out.2")],
+                str(tmp_path / "gmon.sum"))
+
+    merged = GProf.read_gmon(str(tmp_path / "gmon.sum"))
+    assert list(merged["hist"]) == [(0x1000, 0x1006, 100, b"seconds".ljust(15, b"\0"), b"s")]
+    assert merged["hist"][list(merged["hist"])[0]].tolist() == [3, 5, 5]
+    assert merged["arcs"] == {(0x1002, 0x1004): 3}
+
+    # another executable is not summed
+    write_gmon(tmp_path / "gmon.out.3", [1, 2, 3, 4], [], lowpc=0x7f00)
+    with pytest.raises(Exception, match="another executable"):
+        GProf.merge([str(tmp_path / "gmon.out.1"), str(tmp_path / "gmon.out.3")],
+                    str(tmp_path / "gmon.sum"))
+
+
+def test_parse():
+    ppk = GProf.parse(OUTPUT).build([])
+    assert ppk.metrics == ["TIME"]
+
+    helper = "helper(int, char*)"
+    assert np.isclose(ppk.getDataPoint(0, "compute", "TIME", PPK.EXCLUSIVE), 0.06e6)
+    assert np.isclose(ppk.getDataPoint(0, "compute", "TIME", PPK.INCLUSIVE), 0.09e6)
+    assert np.isclose(ppk.getDataPoint(0, "main", "TIME", PPK.INCLUSIVE), 0.1e6)
+
+    profiles = ppk.threads[0].functionProfiles
+    assert set(profiles) == {"compute", "main", helper}
+    assert profiles["compute"].numCalls == 3 and profiles["compute"].numSubr == 5
+    assert profiles[helper].numCalls == 3
+
+    # every function is aggregated once
+    ppk.populateAggData()
+    assert set(ppk.aggEvents) == {"compute", "main", helper}
+    assert np.isclose(ppk.getAggExcSum("compute", "TIME"), 0.06e6)
+    assert np.isclose(ppk.getAggIncSum("compute", "TIME"), 0.09e6)
+    assert np.isclose(ppk.getAggExcSum(helper, "TIME"), 0.03e6)
+    assert np.isclose(ppk.getAggIncMax("main", "TIME"), 0.1e6)
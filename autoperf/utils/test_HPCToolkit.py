@@ -0,0 +1,141 @@
+import numpy as np
+
+from . import HPCToolkit
+from .PPK import PPK
+
+EXPERIMENT = """<?xml version="1.0"?>
+<HPCToolkitExperiment version="2.0">
+<Header n="pi"><Info/></Header>
+<SecCallPathProfile i="0" n="pi">
+<SecHeader>
+  <MetricTable>
+    <Metric i="0" n="PAPI_TOT_CYC:Sum (I)" v="derived-incr" t="inclusive" partner="1">
+      <Info><NV n="units" v="events"/></Info>
+    </Metric>
+    <Metric i="1" n="PAPI_TOT_CYC:Sum (E)" v="derived-incr" t="exclusive" partner="0"/>
+    <Metric i="2" n="PAPI_TOT_CYC:Mean (I)" v="derived-incr" t="inclusive"/>
+  </MetricTable>
+  <MetricDBTable>
+    <MetricDB i="0" n="PAPI_TOT_CYC (I)" t="inclusive" db-glob="*.metric-db" db-id="0" db-num-metrics="4" db-header-sz="32"/>
+    <MetricDB i="1" n="PAPI_TOT_CYC (E)" t="exclusive" db-glob="*.metric-db" db-id="1" db-num-metrics="4" db-header-sz="32"/>
+    <MetricDB i="2" n="TIME (I)" t="inclusive" db-glob="*.metric-db" db-id="2" db-num-metrics="4" db-header-sz="32"/>
+    <MetricDB i="3" n="TIME (E)" t="exclusive" db-glob="*.metric-db" db-id="3" db-num-metrics="4" db-header-sz="32"/>
+  </MetricDBTable>
+  <FileTable><File i="2" n="./src/pi.c"/></FileTable>
+  <ProcedureTable><Procedure i="3" n="main"/><Procedure i="4" n="compute"/></ProcedureTable>
+</SecHeader>
+<SecCallPathProfileData>
+<PF i="2" s="3" l="10" lm="1" f="2" n="3">
+  <M n="0" v="200"/><M n="1" v="20"/><M n="2" v="100"/>
+  <S i="3" s="5" l="11"><M n="1" v="20"/></S>
+  <C i="4" s="6" l="12">
+    <PF i="5" s="7" l="1" f="2" n="4">
+      <M n="0" v="180"/><M n="1" v="120"/>
+      <L i="6" s="8" l="2"><S i="7" s="9" l="3"><M n="1" v="120"/></S></L>
+      <C i="8" s="10" l="4">
+        <PF i="9" s="7" l="1" f="2" n="4"><M n="0" v="60"/><M n="1" v="60"/></PF>
+      </C>
+    </PF>
+  </C>
+</PF>
+</SecCallPathProfileData>
+</SecCallPathProfile>
+</HPCToolkitExperiment>
+"""
+
+MAIN = "main [{./src/pi.c} {10}]"
+COMPUTE = "compute [{./src/pi.c} {1}]"
+
+
+def write_metricdb(path, frames):
+    """`frames`: CCT node id -> [PAPI (I), PAPI (E), TIME (I), TIME (E)]"""
+    values = np.zeros((9, 4))  # node ids 1..9
+    for node, row in frames.items():
+        values[node - 1] = row
+
+    header = b"HPCPROF-metricdb" + b"00.10" + b"b"
+    header += np.array([10, 4], dtype=">u4").tobytes()
+    header += b"\0" * (32 - len(header))
+    path.write_bytes(header + values.astype(">f8").tobytes())
+
+
+def make_database(path):
+    path.mkdir()
+    (path / "experiment.xml").write_text(EXPERIMENT)
+    write_metricdb(path / "pi-000000-000-a8c00270-1234-0.metric-db",
+                   {2: [100, 10, 1.0, 0.1], 5: [90, 60, 0.9, 0.6], 9: [30, 30, 0.3, 0.3]})
+    write_metricdb(path / "pi-000001-002-a8c00270-1235-0.metric-db",
+                   {2: [100, 10, 1.0, 0.1], 5: [90, 90, 0.9, 0.9]})
+
+
+def test_metric_database(tmp_path):
+    make_database(tmp_path / "database")
+
+    ppk = HPCToolkit.read(str(tmp_path / "database")).build([])
+    assert ppk.metrics == ["PAPI_TOT_CYC", "TIME"]
+    # thread 2 is the first thread of rank 1
+    assert [(t.nodeId, t.contextId, t.threadId) for t in ppk.threads] == [(0, 0, 0), (1, 0, 0)]
+
+    assert ppk.getDataPoint(0, MAIN, "PAPI_TOT_CYC", PPK.INCLUSIVE) == 100
+    assert ppk.getDataPoint(0, MAIN, "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 10
+
+    # the flat profile counts recursive calls once
+    assert ppk.getDataPoint(0, COMPUTE, "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 90
+    assert ppk.getDataPoint(0, COMPUTE, "PAPI_TOT_CYC", PPK.INCLUSIVE) == 90
+    assert ppk.getDataPoint(1, COMPUTE, "TIME", PPK.EXCLUSIVE) == 0.9
+    assert all(" => " not in name for name in ppk.threads[0].functionProfiles)
+
+    ppk.populateAggData()
+    assert ppk.getAggExcSum("compute", "PAPI_TOT_CYC") == 90 + 90
+    assert ppk.getAggIncSum("compute", "PAPI_TOT_CYC") == 90 + 90
+    assert ppk.getAggExcSum("main", "PAPI_TOT_CYC") == 10 + 10
+    assert np.isclose(ppk.getAggExcSum("compute", "TIME"), 0.9 + 0.9)
+
+    # or one event per call path
+    callpath = "%s => %s" % (MAIN, COMPUTE)
+    recursion = "%s => %s => %s" % (MAIN, COMPUTE, COMPUTE)
+    ppk = HPCToolkit.read(str(tmp_path / "database"), callpath=True).build([])
+    assert ppk.getDataPoint(0, MAIN, "PAPI_TOT_CYC", PPK.INCLUSIVE) == 100
+    assert ppk.getDataPoint(0, callpath, "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 60
+    assert ppk.getDataPoint(0, recursion, "TIME", PPK.INCLUSIVE) == 0.3
+    assert COMPUTE not in ppk.threads[0].functionProfiles
+
+    # frames a thread never sampled have no profile
+    assert recursion not in ppk.threads[1].functionProfiles
+
+    ppk.populateAggData()
+    assert ppk.getAggExcSum("compute", "PAPI_TOT_CYC") == 60 + 30 + 90
+    assert ppk.getAggIncSum("compute", "PAPI_TOT_CYC") == 90 + 30 + 90
+
+    # iterations are read concurrently
+    make_database(tmp_path / "other")
+    builders = HPCToolkit.read_all([str(tmp_path / "database"), str(tmp_path / "other")],
+                                   processes=2)
+    assert [b.header for b in builders] == [builders[0].header] * 2
+    for a, b in zip(builders[0].columns().values(), builders[1].columns().values()):
+        assert np.array_equal(a, b)
+
+
+def test_summary_values(tmp_path):
+    make_database(tmp_path / "database")
+    for path in (tmp_path / "database").glob("*.metric-db"):
+        path.unlink()
+
+    ppk = HPCToolkit.read(str(tmp_path / "database")).build([], compact=True)
+    assert len(ppk.threads) == 1
+    assert ppk.getDataPoint(0, COMPUTE, "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 180
+    assert ppk.getDataPoint(0, MAIN, "PAPI_TOT_CYC", PPK.INCLUSIVE) == 200
+    assert ppk.getDataPoint(0, MAIN, "TIME", PPK.INCLUSIVE) == 0
+
+
+def test_empty_metricdb(tmp_path):
+    make_database(tmp_path / "database")
+    path = next((tmp_path / "database").glob("pi-000001-*.metric-db"))
+    path.write_bytes(path.read_bytes()[:32])
+
+    ppk = HPCToolkit.read(str(tmp_path / "database")).build([])
+    assert len(ppk.threads) == 2
+    assert ppk.threads[1].functionProfiles == {}
+
+    ppk.populateAggData()
+    assert ppk.getAggExcSum("compute", "PAPI_TOT_CYC") == 90
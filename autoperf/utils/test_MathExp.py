@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from .MathExp import MathExp, UnresolvedSymbolError
+
+# (assignments, expression)
+EXPRESSIONS = [([], "a / b + 1"),
+               (["x = a * 2"], "x ^ 2 - b % 3"),
+               ([], "max(a, b) - min(a, 2) + sqrt(abs(b)) * log(a + 2, 2)"),
+               ([], "1 - a / (b - b)")]
+
+
+def test_array_eval_matches_scalar_eval():
+    a = np.array([1.0, 2.5, 0.0, 7.0])
+    b = np.array([3.0, 0.0, 2.0, -4.0])
+
+    for assigns, exp in EXPRESSIONS:
+        assigns = [MathExp(e) for e in assigns]
+        exp = MathExp(exp)
+
+        symtab = {"a": a, "b": b}
+        for e in assigns:
+            e.eval(symtab, array=True)
+        vector = exp.eval(symtab, array=True)
+
+        for i in range(len(a)):
+            symtab = {"a": a[i].item(), "b": b[i].item()}
+            for e in assigns:
+                e.eval(symtab)
+            assert np.isclose(vector[i], exp.eval(symtab))
+
+
+def test_compiled_matches_eval():
+    a = np.array([1.0, 2.5, 0.0, 7.0])
+    b = np.array([3.0, 0.0, 2.0, -4.0])
+
+    for assigns, exp in EXPRESSIONS:
+        exps = [MathExp(e) for e in assigns + [exp]]
+
+        symtab = {"a": a, "b": b}
+        vector = [e.call(symtab, array=True) for e in exps][-1]
+        for i in range(len(a)):
+            interpreted = {"a": a[i].item(), "b": b[i].item()}
+            compiled = dict(interpreted)
+            for e in exps:
+                expected = e.eval(interpreted)
+                assert e.call(compiled) == expected
+            assert compiled == interpreted
+            assert np.isclose(vector[i], expected)
+
+
+def test_compiled_function():
+    exp = MathExp("y = b / a + c")
+    func = exp.compile()
+
+    assert func.argnames == ("a", "b", "c")
+    assert func(0.0, 1.0, 2.0) == 3.0
+    out = {}
+    assert func(2.0, 1.0, 2.0, _out=out) == 2.5 and out == {"y": 2.5}
+    assert MathExp("y = b / a + c").compile() is func
+    with pytest.raises(UnresolvedSymbolError):
+        exp.call({"a": 1.0, "b": 2.0})
+
+    # a variable assigned before it is read is not an argument
+    assert MathExp("(x = a * 2) + x").compile().argnames == ("a",)
+    assert MathExp("(x = a * 2) + x").call({"a": 1.5}) == 6.0
+
+
+def test_thread_reductions():
+    a = np.array([[1.0, 5.0], [3.0, 0.0], [8.0, 1.0]])
+
+    exp = MathExp("a / thread_mean(a) + thread_percentile(a, 50) - thread_std(a)")
+    assert exp.reduces and not MathExp("max(a, 1)").reduces
+
+    expected = a / a.mean(axis=0) + np.median(a, axis=0) - a.std(axis=0)
+    assert np.allclose(exp.eval({"a": a}, array=True), expected)
+    assert np.allclose(exp.call({"a": a}, array=True), expected)
+
+    for f, reduce in (("thread_sum", np.sum), ("thread_max", np.max), ("thread_min", np.min)):
+        assert np.array_equal(MathExp("%s(a)" % f).eval({"a": a}, array=True),
+                              reduce(a, axis=0, keepdims=True))
+
+    # a scalar is a single thread
+    assert exp.eval({"a": 4.0}) == exp.call({"a": 4.0}) == 5.0
+
+
+def test_compiled_code_runs_on_old_pythons():
+    import ast
+
+    for array in (False, True):
+        func = MathExp("(x = a / b) + (y = x / (b - b)) * x").compile(array)
+        ast.parse(func.code, feature_version=(3, 6))
+        assert func.argnames == ("a", "b")
+
+    # reads before an assignment see the argument
+    assert MathExp("x + (x = a * 2) + x").call({"a": 1.0, "x": 0.5}) == 4.5
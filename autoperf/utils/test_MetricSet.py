@@ -0,0 +1,133 @@
+import numpy as np
+import pytest
+
+from .MathExp import MathExp
+from .MetricSet import MetricSet, _DAG
+
+SPECS = {
+    "IPC": ["PAPI_TOT_INS / PAPI_TOT_CYC"],
+    "CPI": ["PAPI_TOT_CYC / PAPI_TOT_INS"],
+    "FP_RATIO": ["PAPI_FP_INS / PAPI_TOT_INS"],
+    "STALL_RATIO": ["PAPI_RES_STL / PAPI_TOT_CYC"],
+    "FP_STALL": ["FP_RATIO * STALL_RATIO * (PAPI_TOT_CYC / META_CPU_HZ)"],
+    "WORK": ["IPC * (PAPI_TOT_CYC / META_CPU_HZ) + 2 * 3"],
+}
+
+
+def make_metric_set(tmp_path):
+    for name, lines in SPECS.items():
+        (tmp_path / name).write_text("\n".join(lines) + "\n")
+
+    ms = MetricSet([str(tmp_path)])
+    for name in SPECS:
+        ms.add(name)
+
+    return ms
+
+
+def test_dag_matches_reference(tmp_path):
+    ms = make_metric_set(tmp_path)
+    assert ms.meta == {"META_CPU_HZ"}
+
+    values = {"PAPI_TOT_INS": 4.0, "PAPI_TOT_CYC": 8.0, "PAPI_FP_INS": 1.0,
+              "PAPI_RES_STL": 0.0, "META_CPU_HZ": 2, "META_CPU_MODEL": "x"}
+
+    expected = dict(values)
+    rv = ms.eval_reference(expected)
+    actual = dict(values)
+    assert ms.eval(actual) == rv
+    assert actual == expected
+
+    columns = dict((k, np.array([v, 0.0]) if k.startswith("PAPI") else v)
+                   for k, v in values.items())
+    vector = ms.eval(dict(columns), array=True)
+    reference = ms.eval_reference(dict(columns), array=True)
+    for name in SPECS:
+        assert np.array_equal(vector[name], reference[name])
+
+    # metrics already in the symtab are taken as they are
+    assert ms.eval(dict(values, IPC=42.0))["WORK"] == 42.0 * 4.0 + 6.0
+
+
+def test_dag_shares_and_folds(tmp_path):
+    ms = make_metric_set(tmp_path)
+
+    env = {}
+    dag = _DAG(False)
+    for name in ["PAPI_TOT_INS", "PAPI_TOT_CYC", "PAPI_FP_INS", "PAPI_RES_STL"]:
+        env[name] = dag.input(name)
+    env["META_CPU_HZ"] = dag.num(2.0)
+
+    writes = []
+    for metric in ms.dmetrics:
+        for rpn in ms.rpns[metric]:
+            node = dag.add(rpn.build_tree(), env, writes)
+        env[metric] = node
+
+    # PAPI_TOT_CYC / META_CPU_HZ is shared, 2 * 3 is folded
+    ops = [key for key in dag.nodes if key[0] == "op"]
+    assert len(ops) == len(set(ops)) == 9
+    assert ("num", 6.0) in dag.nodes
+
+
+def test_dag_assignments():
+    ms = MetricSet([])
+    ms.dmetrics = ["A", "B"]
+    ms.rpns = {"A": [MathExp("t = x * 2"), MathExp("t + 1")],
+               "B": [MathExp("t / 0 + x / (x - x)")]}
+
+    expected = {"x": 3.0}
+    rv = ms.eval_reference(expected)
+    actual = {"x": 3.0}
+    assert ms.eval(actual) == rv == {"A": 7.0, "B": 9.0}
+    assert actual == expected
+
+
+def test_dag_uses_mathexp_codegen():
+    # the DAG and MathExp.compile() share one code generator
+    for array in [False, True]:
+        x = np.array([3.0, 0.0]) if array else 3.0
+        exp = MathExp("x / (x - x) + max(x, 2) ^ 2")
+        dag = _DAG(array)
+        node = dag.add(exp.build_tree(), {"x": dag.input("x")}, [])
+        rv = dag.compile([], [("y", node)])({"x": x})["y"]
+        assert np.array_equal(rv, exp.call({"x": x}, array))
+
+
+def test_catalog_parse_cache(tmp_path, monkeypatch):
+    from . import MetricCatalog as module
+    from .MetricCatalog import MetricCatalog
+
+    specs = tmp_path / "specs"
+    specs.mkdir()
+    (specs / "IPC").write_text("# instructions per cycle\nPAPI_TOT_INS / PAPI_TOT_CYC\n")
+    (specs / "BROKEN").write_text("(PAPI_TOT_INS\n")
+    (specs / "__init__.py").write_text("")
+    cache = str(tmp_path / "specs.pickle")
+
+    catalog = MetricCatalog([str(specs)], cache=cache)
+    assert "IPC" in catalog and "__init__.py" not in catalog
+    assert [e.source for e in catalog.expressions("IPC")] == ["PAPI_TOT_INS / PAPI_TOT_CYC"]
+    with pytest.raises(Exception):
+        catalog.expressions("BROKEN")
+
+    # a second catalogue parses nothing
+    def parse(path):
+        raise AssertionError("parsed %s" % path)
+
+    monkeypatch.setattr(module.MetricCatalog, "_parse", staticmethod(parse))
+    again = MetricCatalog([str(specs)], cache=cache)
+    assert again.expressions("IPC")[0].rpn == catalog.expressions("IPC")[0].rpn
+
+    # unless a spec changed
+    monkeypatch.undo()
+    (specs / "IPC").write_text("PAPI_TOT_INS / (PAPI_TOT_CYC + 1)\n")
+    again = MetricCatalog([str(specs)], cache=cache)
+    assert again.expressions("IPC")[0].source == "PAPI_TOT_INS / (PAPI_TOT_CYC + 1)"
+
+
+def test_tokenizer_is_linear():
+    exp = MathExp(" + ".join("PAPI_TOT_CYC / (PAPI_TOT_INS-1)" for i in range(20000)))
+
+    assert len(exp.rpn) == 20000 * 5 + 19999
+    assert exp.eval({"PAPI_TOT_CYC": 2.0, "PAPI_TOT_INS": 3.0}) == 20000.0
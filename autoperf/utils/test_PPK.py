@@ -0,0 +1,619 @@
+import glob
+import gzip
+import os
+from struct import pack
+
+import numpy as np
+import pytest
+
+from .PPK import PPK, PPKBuilder, Event
+
+METRICS = ["TIME", "PAPI_TOT_CYC"]
+EVENTS = [".TAU application",
+          "main [{pi.c} {10,1}-{40,1}]",
+          "main [{pi.c} {10,1}-{40,1}] => compute [{pi.c} {1,1}-{8,1}]",
+          "compute [{pi.c} {1,1}-{8,1}]"]
+
+
+def _utf(s):
+    s = s.encode("utf-8")
+    return pack(">H", len(s)) + s
+
+
+def make_ppk(path, threads=3):
+    """Write a small but complete version 2 PPK file to `path`"""
+    data = pack(">BcBcBc", 0, b'P', 0, b'P', 0, b'K')
+    data += pack(">iiii", 2, 2, 0, 0)
+
+    data += pack(">i", 1) + _utf("Application") + _utf("pi")
+    data += pack(">i", threads)
+    for t in range(threads):
+        data += pack(">iiii", 0, 0, t, 1) + _utf("OMP Thread") + _utf(str(t))
+
+    data += pack(">i", len(METRICS)) + b"".join(_utf(m) for m in METRICS)
+    data += pack(">i", 1) + _utf("TAU_DEFAULT")
+    data += pack(">i", len(EVENTS))
+    for e in EVENTS:
+        data += _utf(e) + pack(">ii", 1, 0)
+    data += pack(">i", 1) + _utf("Message size")
+
+    data += pack(">i", threads)
+    for t in range(threads):
+        data += pack(">iii", 0, 0, t)
+        # thread 0 sees every event, others only a few
+        fids = list(range(len(EVENTS))) if t == 0 else [1, 3]
+        data += pack(">i", len(fids))
+        for f in fids:
+            data += pack(">idd", f, 1.0 + t, 0.5 * f)
+            for m in range(len(METRICS)):
+                data += pack(">dd", 0.1 * (f + 1) * (m + 1) + t, 1.0 / 3 * (f + 1) + t)
+        data += pack(">i", 1)
+        data += pack(">iidddd", 0, 4, 1.0, 8.0, 3.5, 70.0)
+
+    with gzip.open(path, "wb") as f:
+        f.write(data)
+
+
+def test_bulk_decoder_matches_reference(tmp_path):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    bulk = PPK(path, [])
+    ref = PPK(path, [], decoder="reference")
+
+    assert bulk.metrics == METRICS
+    assert bulk.metadata == {"Application": "pi"}
+    assert len(bulk.functionProfiles) == len(ref.functionProfiles)
+    for a, b in zip(bulk.functionProfiles, ref.functionProfiles):
+        assert a.functionId == b.functionId
+        assert (a.numCalls, a.numSubr) == (b.numCalls, b.numSubr)
+        assert a.exclusive == b.exclusive
+        assert a.inclusive == b.inclusive
+
+    event = EVENTS[3]
+    assert bulk.getDataPoint(2, event, "TIME", PPK.EXCLUSIVE) == \
+        ref.getDataPoint(2, event, "TIME", PPK.EXCLUSIVE)
+
+
+def test_stream_reader_matches_buffer_reader(tmp_path):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    whole = PPK(path, [])
+    # tiny buffer, so records and strings straddle chunk boundaries
+    streamed = PPK(path, [], stream=True, bufsize=7)
+
+    assert streamed.metadata == whole.metadata
+    assert [t.threadId for t in streamed.threads] == [t.threadId for t in whole.threads]
+    assert [p.inclusive for p in streamed.functionProfiles] == \
+        [p.inclusive for p in whole.functionProfiles]
+    assert len(streamed.userEventProfiles) == len(whole.userEventProfiles)
+
+
+def test_sidecar_cache(tmp_path):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    cold = PPK(path, [], cache=True)
+    assert os.path.isfile(path + ".cache/header.json")
+
+    warm = PPK(path, [], cache=True)
+    assert warm.metadata == cold.metadata
+    assert warm.metrics == cold.metrics
+    assert [e.fullname for e in warm.events] == [e.fullname for e in cold.events]
+    assert [(t.nodeId, t.contextId, t.threadId, t.metadata) for t in warm.threads] == \
+        [(t.nodeId, t.contextId, t.threadId, t.metadata) for t in cold.threads]
+    assert [(p.functionId, p.numCalls, p.exclusive, p.inclusive) for p in warm.functionProfiles] == \
+        [(p.functionId, p.numCalls, p.exclusive, p.inclusive) for p in cold.functionProfiles]
+    assert [p.sumSquared for p in warm.userEventProfiles] == \
+        [p.sumSquared for p in cold.userEventProfiles]
+
+    # a rewritten PPK makes the sidecar stale
+    make_ppk(path, threads=2)
+    os.utime(path, ns=(0, 0))
+    assert len(PPK(path, [], cache=True).threads) == 2
+
+
+def test_agg_data_matches_dense_reduction(tmp_path):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    for sparse in (False, True):
+        ppk = PPK(path, [])
+        ppk.populateAggData(sparse=sparse)
+
+        for array in (ppk.aggExcArray, ppk.aggIncArray):
+            cube = array[PPK.AGG]
+            dense = np.asarray(cube)
+            assert cube.shape == (1, 1, 3, len(ppk.aggEvents), len(METRICS))
+            assert np.allclose(array[PPK.SUM], dense.sum((0, 1, 2)))
+            assert np.array_equal(array[PPK.MAX], dense.max((0, 1, 2)))
+            assert np.array_equal(array[PPK.MIN], dense.min((0, 1, 2)))
+            assert np.allclose(array[PPK.STD], dense.std((0, 1, 2)))
+            assert np.allclose(array[PPK.MEAN], dense.mean((0, 1, 2)))
+            assert np.allclose(cube.std((0, 1, 2)), dense.std((0, 1, 2)))
+
+        thread = ppk.threads[1]
+        shortname = "compute"
+        assert cube[0, 0, 1, ppk.aggEvents.index(shortname), 0] == \
+            thread.aggProfiles[shortname].inclusive["TIME"]
+
+
+def test_compact_storage_matches_objects(tmp_path, monkeypatch):
+    from . import PPK as module
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "CYC_PER_SEC").write_text("PAPI_TOT_CYC / TIME\n")
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    full = PPK(path, [])
+    compact = PPK(path, [], compact=True)
+
+    assert compact.aggEvents == full.aggEvents
+    assert [(p.fullname, p.numCalls, p.exclusive) for p in compact.functionProfiles] == \
+        [(p.fullname, p.numCalls, p.exclusive) for p in full.functionProfiles]
+    for a, b in zip(compact.threads, full.threads):
+        assert dict(a.aggProfiles["compute"].inclusive) == b.aggProfiles["compute"].inclusive
+
+    for ppk in (full, compact):
+        ms = MetricSet([str(tmp_path)])
+        ms.add("CYC_PER_SEC")
+        ppk.attachMetricSet(ms)
+        ppk.populateAggData()
+
+    assert compact.getDataPoint(0, EVENTS[1], "CYC_PER_SEC", PPK.INCLUSIVE) == \
+        full.getDataPoint(0, EVENTS[1], "CYC_PER_SEC", PPK.INCLUSIVE)
+    assert np.array_equal(compact.aggExcArray[PPK.AGG], full.aggExcArray[PPK.AGG])
+    assert np.array_equal(compact.aggIncArray[PPK.MEAN], full.aggIncArray[PPK.MEAN])
+
+    # compact PPKs dump and cache like any other
+    compact.dump(str(tmp_path / "out.ppk"))
+    again = PPK(str(tmp_path / "out.ppk"), [], cache=True, compact=True)
+    again = PPK(str(tmp_path / "out.ppk"), [], cache=True, compact=True)
+    assert again.metrics == full.metrics
+    assert [p.inclusive for p in again.functionProfiles] == \
+        [p.inclusive for p in full.functionProfiles]
+
+
+def test_event_frames_are_shared_and_hotspots_favored():
+    a = Event(EVENTS[2], [r"^pi\.c$", r"^nomatch"])
+    b = Event("main [{pi.c} {10,1}-{40,1}] => MPI_Send()", [r"^pi\.c$"])
+
+    assert a.callstack[0] is b.callstack[0]
+    assert a.shortname == "compute"
+    # MPI_Send() has no source location, so the hotspot wins
+    assert b.shortname == "main"
+    assert Event("MPI_Send() => MPI_Recv()", []).shortname == "MPI_Recv()"
+
+
+def test_dump_roundtrip(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    ppk = PPK(path, [])
+    ppk.addMetadata("AP_CONFIG", "deadbeef")
+    ppk.dump(str(tmp_path / "out.ppk"))
+
+    again = PPK(str(tmp_path / "out.ppk"), [])
+    assert again.metadata["AP_CONFIG"] == "deadbeef"
+    assert [p.exclusive for p in again.functionProfiles] == \
+        [p.exclusive for p in ppk.functionProfiles]
+
+    # without changes the writer reproduces the input byte for byte
+    PPK(path, [], compact=True).dump(str(tmp_path / "same.ppk"))
+    with gzip.open(path) as a, gzip.open(str(tmp_path / "same.ppk")) as b:
+        assert a.read() == b.read()
+
+    # the object model is streamed, without building the columns
+    ppk = PPK(path, [])
+    monkeypatch.setattr(ppk, "_saveColumns", None)
+    ppk.dump(str(tmp_path / "dict.ppk"))
+    with gzip.open(path) as a, gzip.open(str(tmp_path / "dict.ppk")) as b:
+        assert a.read() == b.read()
+
+
+def test_builder(tmp_path):
+    builder = PPKBuilder(METRICS, {"Application": "pi"})
+    ids = [builder.addEvent(e) for e in EVENTS]
+    assert builder.addEvent(EVENTS[1]) == ids[1]
+    message = builder.addUserEvent("Message size")
+    for t in range(2):
+        builder.addThread(0, 0, t, ids[1:], [1, 2, 3], [0, 1, 0],
+                          np.arange(6).reshape(3, 2) + t, np.ones((3, 2)),
+                          metadata={"OMP Thread": str(t)},
+                          userEventIds=[message], numSamples=[4],
+                          userEventValues=[[1.0, 8.0, 3.5, 70.0]])
+
+    path = str(tmp_path / "built.ppk")
+    builder.write(path)
+
+    for ppk in (PPK(path, []), builder.build([]), builder.build([], compact=True)):
+        assert ppk.metadata == {"Application": "pi"}
+        assert ppk.groups == ["TAU_DEFAULT"]
+        assert ppk.threads[1].metadata == {"OMP Thread": "1"}
+        assert ppk.getDataPoint(1, EVENTS[3], "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 6.0
+        assert ppk.userEventProfiles[1].sumSquared == 70.0
+
+
+def test_lazy_loading_matches_eager(tmp_path):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    eager = PPK(path, [])
+    lazy = PPK(path, [], lazy=True)
+    assert os.path.isfile(path + ".idx")
+    assert lazy.metrics == eager.metrics
+    assert len(lazy.threads) == len(eager.threads)
+    assert lazy.threads.loaded == [None] * 3
+
+    # random access only reads the requested thread
+    assert lazy.getDataPoint(2, EVENTS[3], "TIME", PPK.INCLUSIVE) == \
+        eager.getDataPoint(2, EVENTS[3], "TIME", PPK.INCLUSIVE)
+    assert lazy.threads[2].metadata == eager.threads[2].metadata
+    assert lazy.threads.loaded[0] is None
+
+    # the second open seeks straight to the tables
+    again = PPK(path, [], lazy=True)
+    again.populateAggData()
+    eager.populateAggData()
+    assert [p.exclusive for p in again.functionProfiles] == \
+        [p.exclusive for p in eager.functionProfiles]
+    assert np.array_equal(again.aggIncArray[PPK.AGG], eager.aggIncArray[PPK.AGG])
+
+
+def test_parallel_loader(tmp_path, monkeypatch):
+    from . import PPK as module
+    from . import loader
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "CYC_PER_SEC").write_text("PAPI_TOT_CYC / TIME\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("CYC_PER_SEC")
+
+    paths = [str(tmp_path / ("%d.ppk" % i)) for i in range(3)]
+    for i, path in enumerate(paths):
+        make_ppk(path, threads=i + 1)
+
+    for processes, lazy in ((1, False), (2, False), (2, True)):
+        ppks = loader.load(paths, [], metric_set=ms, aggregate=True, processes=processes,
+                           lazy=lazy)
+        for path, ppk in zip(paths, ppks):
+            assert os.path.isfile(path + ".cache/header.json")
+
+            ref = PPK(path, [])
+            ref.attachMetricSet(ms)
+            ref.populateAggData()
+            assert ppk.metrics + list(ppk.lazyMetrics) == ref.metrics
+            assert ppk.getDataPoint(0, EVENTS[1], "CYC_PER_SEC", PPK.EXCLUSIVE) == \
+                ref.getDataPoint(0, EVENTS[1], "CYC_PER_SEC", PPK.EXCLUSIVE)
+            width = ppk.aggIncArray[PPK.AGG].shape[-1]
+            assert np.array_equal(ppk.aggIncArray[PPK.AGG], ref.aggIncArray[PPK.AGG][..., :width])
+            assert ppk.getAggExcMean("compute", "CYC_PER_SEC") == \
+                ref.getAggExcMean("compute", "CYC_PER_SEC")
+
+            # the workers hand the aggregated data over through files
+            if processes > 1:
+                assert isinstance(ppk.aggExcArray[PPK.SUM], np.memmap)
+                assert not glob.glob(str(tmp_path / ".*.agg.*"))
+
+    # a file given twice is loaded once
+    ppks = loader.load([paths[0], paths[1], "./" + os.path.relpath(paths[0])], [],
+                       aggregate=True, processes=2)
+    assert ppks[0] is ppks[2] and ppks[0] is not ppks[1]
+    assert not glob.glob(str(tmp_path / ".*.agg.*"))
+
+    # sparse cubes are written as coordinates and values
+    ppk = PPK(paths[2], [], cache=True, compact=True)
+    ppk.populateAggData(sparse=True)
+    copy = PPK(paths[2], [], cache=True, compact=True)
+    loader._loadAgg(copy, *loader._saveAgg(paths[2], ppk))
+    assert copy.sparse
+    assert np.array_equal(np.asarray(copy.aggIncArray[PPK.AGG]), np.asarray(ppk.aggIncArray[PPK.AGG]))
+    assert np.array_equal(copy.aggExcArray[PPK.STD], ppk.aggExcArray[PPK.STD])
+
+
+def test_indexes_and_vector_accessors(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    for ppk in (PPK(path, []), PPK(path, [], compact=True)):
+        ppk.populateAggData()
+
+        assert "PAPI_TOT_CYC" in ppk.metrics and "NOPE" not in ppk.metrics
+        assert ppk.metrics.index("PAPI_TOT_CYC") == 1
+        assert ppk.events[ppk.eventIndex[EVENTS[2]]].fullname == EVENTS[2]
+        assert ppk.getThread(0, 0, 2) is ppk.threads[2]
+
+        events = ["compute", "nothing", "main"]
+        vector = ppk.getAggVector("TIME", PPK.MEAN, PPK.EXCLUSIVE, events)
+        assert vector.tolist() == [ppk.getAggExcMean(e, "TIME") for e in events]
+        assert vector[1] == 0
+        assert ppk.getAggVector("TIME", PPK.SUM, PPK.INCLUSIVE).tolist() == \
+            [ppk.getAggIncSum(e, "TIME") for e in ppk.aggEvents]
+
+    # a trial without any aggregated event, as compare2 meets it
+    # when the events of the two trials are disjoint
+    from . import PPK as module
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    builder = PPKBuilder(["TIME"])
+    builder.addThread(0, 0, 0, [], [], [], np.zeros((0, 1)), np.zeros((0, 1)))
+    for empty in (builder.build([]), builder.build([], compact=True)):
+        empty.populateAggData()
+        assert empty.getAggVector("TIME", PPK.MEAN, PPK.EXCLUSIVE, events).tolist() == [0, 0, 0]
+
+    metrics = ppk.metrics
+    metrics.extend(["A", "B"])
+    metrics.remove("A")
+    assert metrics.index("B") == 2 and "A" not in metrics
+
+
+def test_lazy_derived_metrics(tmp_path, monkeypatch):
+    from . import PPK as module
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "CYC_PER_SEC").write_text("PAPI_TOT_CYC / TIME\n")
+    (tmp_path / "SEC_PER_CYC").write_text("TIME / PAPI_TOT_CYC\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("CYC_PER_SEC")
+    ms.add("SEC_PER_CYC")
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    ref = PPK(path, [])
+    ref.attachMetricSet(ms)
+    ref.populateAggData()
+
+    ppk = PPK(path, [], compact=True)
+    ppk.populateAggData()
+    ppk.attachMetricSet(ms, lazy=True)
+
+    # raw metrics never touch the metric set
+    assert ppk.getAggExcMean("compute", "TIME") == ref.getAggExcMean("compute", "TIME")
+    assert ppk.derived == {}
+
+    for type in (PPK.SUM, PPK.MEAN, PPK.STD, PPK.MIN, PPK.MAX):
+        assert np.allclose(ppk.getAggVector("CYC_PER_SEC", type, PPK.INCLUSIVE),
+                           ref.getAggVector("CYC_PER_SEC", type, PPK.INCLUSIVE))
+    assert np.allclose(ppk._derivedStat("CYC_PER_SEC", PPK.AGG, PPK.INCLUSIVE),
+                       ref.aggIncArray[PPK.AGG][..., ref.metrics.index("CYC_PER_SEC")])
+    assert ppk.getDataPoint(1, EVENTS[3], "CYC_PER_SEC", PPK.EXCLUSIVE) == \
+        ref.getDataPoint(1, EVENTS[3], "CYC_PER_SEC", PPK.EXCLUSIVE)
+    assert all(key[1] == "CYC_PER_SEC" for key in ppk.derived)
+    assert ppk.metrics == METRICS
+
+    # with writeback, what is read ends up in the data set
+    ppk = PPK(path, [], compact=True)
+    ppk.attachMetricSet(ms, lazy=True, writeback=True)
+    ppk.populateAggData()
+
+    assert ppk.getAggExcMax("main", "SEC_PER_CYC") == ref.getAggExcMax("main", "SEC_PER_CYC")
+    assert ppk.metrics == METRICS + ["SEC_PER_CYC"]
+    assert list(ppk.lazyMetrics) == ["CYC_PER_SEC"]
+
+    ppk.dump(str(tmp_path / "out.ppk"))
+    out = PPK(str(tmp_path / "out.ppk"), [])
+    assert out.metrics == METRICS + ["SEC_PER_CYC"]
+    assert out.getDataPoint(0, EVENTS[2], "SEC_PER_CYC", PPK.INCLUSIVE) == \
+        ref.getDataPoint(0, EVENTS[2], "SEC_PER_CYC", PPK.INCLUSIVE)
+
+
+def test_thread_reduced_metrics(tmp_path, monkeypatch):
+    from . import PPK as module
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "CYC_SHARE").write_text("PAPI_TOT_CYC / thread_sum(PAPI_TOT_CYC)\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("TIME_IMBALANCE")
+    ms.add("CYC_SHARE")
+    assert ms.reduced == {"TIME_IMBALANCE", "CYC_SHARE"}
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    full = PPK(path, [])
+    compact = PPK(path, [], compact=True)
+    lazy = PPK(path, [], compact=True)
+    for ppk in (full, compact):
+        ppk.attachMetricSet(ms)
+        ppk.populateAggData()
+    lazy.populateAggData()
+    lazy.attachMetricSet(ms, lazy=True)
+
+    time = full.metrics.index("TIME")
+    for flavor, array in ((PPK.EXCLUSIVE, full.aggExcArray), (PPK.INCLUSIVE, full.aggIncArray)):
+        imbalance = array[PPK.MAX][:, time] / array[PPK.MEAN][:, time]
+        for ppk in (full, compact, lazy):
+            assert np.allclose(ppk.getAggVector("TIME_IMBALANCE", PPK.MEAN, flavor), imbalance)
+            assert np.allclose(ppk.getAggVector("TIME_IMBALANCE", PPK.STD, flavor), 0)
+            assert np.allclose(ppk.getAggVector("CYC_SHARE", PPK.SUM, flavor), 1)
+
+        # raw profiles reduce over the threads of the same call path
+        cycles = [full.getDataPoint(t, EVENTS[3], "PAPI_TOT_CYC", flavor) for t in range(3)]
+        share = cycles[1] / sum(cycles)
+        for ppk in (full, compact, lazy):
+            assert np.isclose(ppk.getDataPoint(1, EVENTS[3], "CYC_SHARE", flavor), share)
+
+
+def test_recorded_metadata_takes_precedence(tmp_path, monkeypatch):
+    from . import PPK as module
+    from .MetricSet import MetricSet
+
+    probed = []
+
+    def get_sys_info(symbols=None):
+        probed.append(set(symbols))
+        return dict((s, 1.0) for s in symbols)
+
+    monkeypatch.setattr(module, "get_sys_info", get_sys_info)
+    (tmp_path / "SECONDS").write_text("PAPI_TOT_CYC / META_CPU_HZ\n")
+    (tmp_path / "PER_CORE").write_text("TIME / META_CORE_NUM\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("SECONDS")
+    ms.add("PER_CORE")
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    ppk = PPK(path, [], compact=True)
+    ppk.addMetadata("CPU MHz", "2000")
+    ppk.attachMetricSet(ms, lazy=True)
+
+    cycles = ppk.getDataPoint(0, EVENTS[1], "PAPI_TOT_CYC", PPK.EXCLUSIVE)
+    assert ppk.getDataPoint(0, EVENTS[1], "SECONDS", PPK.EXCLUSIVE) == cycles / 2e9
+    assert probed == []
+
+    ppk.getDataPoint(0, EVENTS[1], "PER_CORE", PPK.EXCLUSIVE)
+    assert probed == [{"META_CORE_NUM"}]
+
+
+def test_single_precision(tmp_path):
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    double = PPK(path, [], compact=True)
+    double.populateAggData()
+
+    for ppk in (PPK(path, [], compact=True, precision="single"),
+                PPK(path, [], cache=True, compact=True, precision="single"),
+                PPK(path, [], cache=True, compact=True, precision="single")):
+        ppk.populateAggData()
+
+        assert ppk.table.exclusive.dtype == np.float32
+        assert ppk.table.calls.dtype == np.int64
+        assert ppk.aggIncArray[PPK.AGG].dtype == np.float32
+        assert ppk.aggIncArray[PPK.MEAN].dtype == np.float64
+
+        assert [p.numCalls for p in ppk.functionProfiles] == \
+            [p.numCalls for p in double.functionProfiles]
+        for type in (PPK.SUM, PPK.MAX, PPK.MIN, PPK.STD, PPK.MEAN):
+            assert np.allclose(ppk.aggExcArray[type], double.aggExcArray[type], rtol=1e-6)
+
+    ppk.dump(str(tmp_path / "out.ppk"))
+    out = PPK(str(tmp_path / "out.ppk"), [], compact=True)
+    assert np.allclose(out.table.inclusive, double.table.inclusive, rtol=1e-6)
+
+
+def test_sparse_cube_is_chosen_when_density_is_low():
+    from .SparseCube import SparseCube
+
+    builder = PPKBuilder(METRICS)
+    ids = [builder.addEvent("f%d [{a.c} {%d,1}-{%d,1}]" % (i, i, i)) for i in range(50)]
+    for t in range(8):
+        builder.addThread(0, 0, t, [ids[t]], [1], [0], [[t + 1.0, 2.0]], [[t + 1.0, 2.0]])
+
+    ppk = builder.build([], compact=True)
+    ppk.populateAggData()
+
+    cube = ppk.aggExcArray[PPK.AGG]
+    assert isinstance(cube, SparseCube) and cube.nnz == 8
+    assert cube[0, 0, 3, 3].tolist() == [4.0, 2.0] and cube[0, 0, 0, 1].tolist() == [0, 0]
+    assert ppk.getAggExcMax("f3", "TIME") == 4.0 and ppk.getAggExcMean("f3", "TIME") == 0.5
+    assert cube.nbytes < np.asarray(cube).nbytes
+
+    ppk.populateAggData(sparse=False)
+    assert np.array_equal(np.asarray(cube), ppk.aggExcArray[PPK.AGG])
+
+
+def test_online_statistics_match_agg_data(tmp_path, monkeypatch):
+    from . import PPK as module
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "CYC_PER_SEC").write_text("PAPI_TOT_CYC / TIME\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("CYC_PER_SEC")
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path, threads=5)
+
+    ref = PPK(path, [])
+    ref.attachMetricSet(ms)
+    ref.populateAggData()
+
+    for decoder in ("bulk", "reference"):
+        ppk = PPK(path, [], decoder=decoder, online=True, metricSet=ms)
+        ppk.populateAggData()
+
+        assert ppk.functionProfiles == [] and PPK.AGG not in ppk.aggExcArray
+        assert ppk.metrics == ref.metrics
+        assert sorted(ppk.aggEvents) == sorted(ref.aggEvents)
+        # derived events are only looked at on the first thread
+        assert ppk.online["position"][ppk.eventIndex[EVENTS[0]]] == -2
+        assert ppk.userEventProfiles == [] and len(ppk.threads) == 5
+
+        for event in ref.aggEvents:
+            for metric in ref.metrics:
+                for type in (PPK.SUM, PPK.MAX, PPK.MIN, PPK.STD, PPK.MEAN):
+                    assert np.isclose(ppk._getAggData(event, metric, type, PPK.EXCLUSIVE),
+                                      ref._getAggData(event, metric, type, PPK.EXCLUSIVE))
+                    assert np.isclose(ppk._getAggData(event, metric, type, PPK.INCLUSIVE),
+                                      ref._getAggData(event, metric, type, PPK.INCLUSIVE))
+
+
+def test_online_metric_set_needs_ppk_metrics(tmp_path, monkeypatch):
+    from . import PPK as module
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "MISS_RATE").write_text("PAPI_L1_DCM / TIME\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("MISS_RATE")
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    with pytest.raises(Exception, match="MetricSet is bigger than PPK metrics"):
+        PPK(path, [], online=True, metricSet=ms)
+
+
+def test_loader_without_sidecar(tmp_path, monkeypatch):
+    from . import PPK as module
+    from . import PPKCache
+    from . import loader
+    from .MetricSet import MetricSet
+
+    monkeypatch.setattr(module, "get_sys_info", lambda symbols=None: {})
+    (tmp_path / "CYC_PER_SEC").write_text("PAPI_TOT_CYC / TIME\n")
+    ms = MetricSet([str(tmp_path)])
+    ms.add("CYC_PER_SEC")
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+
+    ref = PPK(path, [])
+    ref.attachMetricSet(ms)
+    ref.populateAggData()
+
+    # the worker hands the parsed columns over, the parent parses nothing
+    monkeypatch.setattr(PPKCache, "save", lambda filename, header, columns: None)
+    result = loader._prepare(path, [], ms, True, "double")
+    assert "columns" in result
+    monkeypatch.setattr(PPK, "_parse", None)
+    ppk = loader._finish(path, [], ms, result, False, "double")
+
+    assert ppk.metrics == ref.metrics
+    assert ppk.getDataPoint(1, EVENTS[1], "CYC_PER_SEC", PPK.EXCLUSIVE) == \
+        ref.getDataPoint(1, EVENTS[1], "CYC_PER_SEC", PPK.EXCLUSIVE)
+    assert np.array_equal(ppk.aggExcArray[PPK.SUM], ref.aggExcArray[PPK.SUM])
+
+
+def test_sidecar_replace(tmp_path):
+    from . import PPKCache
+
+    path = str(tmp_path / "data.ppk")
+    make_ppk(path)
+    ppk = PPK(path, [], cache=True, compact=True)
+
+    # a sidecar that is already there is swapped out as a whole
+    (tmp_path / "data.ppk.cache" / "junk").write_text("")
+    PPKCache.save(path, *ppk._saveColumns())
+    assert not (tmp_path / "data.ppk.cache" / "junk").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["data.ppk", "data.ppk.cache"]
+    assert PPKCache.load(path) is not None
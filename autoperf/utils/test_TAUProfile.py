@@ -0,0 +1,82 @@
+import numpy as np
+
+from . import TAUProfile
+from .PPK import PPK
+
+MAIN = "main [{pi.c} {10,1}-{40,1}]"
+COMPUTE = "compute [{pi.c} {1,1}-{8,1}]"
+
+
+def write_profile(path, metric, thread, scale):
+    functions = [(MAIN, 1, 2 + thread, 10.0 * scale, 30.0 * scale, "TAU_DEFAULT"),
+                 ('%s => "quoted" %s' % (MAIN, COMPUTE), 2, 0, 5.0 * scale, 5.0 * scale,
+                  "TAU_CALLPATH | TAU_DEFAULT")]
+    if thread == 0:
+        functions.append((COMPUTE, 2, 0, 20.0 * scale, 20.0 * scale, "TAU_DEFAULT"))
+
+    lines = ["%d templated_functions_MULTI_%s" % (len(functions), metric),
+             "# Name Calls Subrs Excl Incl ProfileCalls # <metadata><attribute>"
+             "<name>CPU MHz</name><value>2400.000</value></attribute><attribute>"
+             "<name>OMP Thread</name><value>%d</value></attribute></metadata>" % thread]
+    lines += ['"%s" %d %d %r %r 0 GROUP="%s"' % f for f in functions]
+    lines += ["0 aggregates",
+              "1 userevents",
+              "# eventname numevents max min mean sumsqr",
+              '"Message size" 4 8 1 3.5 70']
+
+    path.mkdir(parents=True, exist_ok=True)
+    (path / ("profile.0.0.%d" % thread)).write_text("\n".join(lines) + "\n")
+
+
+def test_multi_metric_profiles(tmp_path, monkeypatch):
+    for thread in range(3):
+        write_profile(tmp_path / "MULTI__TIME", "TIME", thread, 1.0)
+        write_profile(tmp_path / "MULTI__PAPI_TOT_CYC", "PAPI_TOT_CYC", thread, 2400.0)
+    # not a profile
+    (tmp_path / "MULTI__TIME" / "events.0.edf").write_text("")
+
+    metrics, threads = TAUProfile.find(str(tmp_path))
+    assert metrics == ["PAPI_TOT_CYC", "TIME"]
+    assert sorted(threads) == [(0, 0, 0), (0, 0, 1), (0, 0, 2)]
+
+    builder = TAUProfile.read(str(tmp_path), {"Application": "pi"}, processes=1)
+    ppk = builder.build([])
+
+    assert ppk.metrics == ["PAPI_TOT_CYC", "TIME"]
+    assert ppk.metadata["Application"] == "pi"
+    assert ppk.threads[1].metadata["OMP Thread"] == "1"
+
+    callpath = '%s => "quoted" %s' % (MAIN, COMPUTE)
+    assert ppk.getDataPoint(0, COMPUTE, "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 48000.0
+    assert ppk.getDataPoint(2, MAIN, "TIME", PPK.INCLUSIVE) == 30.0
+    assert ppk.getDataPoint(1, callpath, "TIME", PPK.EXCLUSIVE) == 5.0
+    assert ppk.threads[2].functionProfiles[MAIN].numSubr == 4
+
+    groups = ppk.events[ppk.eventIndex[callpath]].groups
+    assert list(groups) == ["TAU_CALLPATH", "TAU_DEFAULT"]
+
+    event = ppk.userEventProfiles[0]
+    assert (event.numSamples, event.minValue, event.maxValue, event.meanValue,
+            event.sumSquared) == (4, 1.0, 8.0, 3.5, 70.0)
+
+    # worker processes, and the PPK written to disk, see the same profiles
+    monkeypatch.setattr(TAUProfile, "CHUNKSIZE", 1)
+    parallel = TAUProfile.read(str(tmp_path), {"Application": "pi"}, processes=2)
+    assert parallel.header == builder.header
+    for a, b in zip(parallel.columns().values(), builder.columns().values()):
+        assert np.array_equal(a, b)
+
+    builder.write(str(tmp_path / "data.ppk"))
+    out = PPK(str(tmp_path / "data.ppk"), [])
+    assert out.getDataPoint(0, COMPUTE, "PAPI_TOT_CYC", PPK.EXCLUSIVE) == 48000.0
+    assert out.threads[1].metadata["OMP Thread"] == "1"
+
+
+def test_single_metric_profiles(tmp_path):
+    write_profile(tmp_path, "TIME", 0, 1.0)
+
+    ppk = TAUProfile.read(str(tmp_path), processes=1).build([], compact=True)
+    assert ppk.metrics == ["TIME"]
+    assert ppk.getDataPoint(0, MAIN, "TIME", PPK.EXCLUSIVE) == 10.0
+
+    assert TAUProfile.find(str(tmp_path / "missing")) == ([], {})
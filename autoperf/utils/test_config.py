@@ -11,3 +11,20 @@ def test_config_default():
     cfg = load_default_config()
     assert cfg != None
     assert cfg.get('Experiments.rootdir', 'default') == "performance-results"
+
+
+def test_config_typed():
+    cfg = Config()
+    cfg.cfg_parser.read_string("""
+[Experiments]
+persist_derived_metrics = yes
+
+[Experiments.lazy]
+persist_derived_metrics = false  ; computed on demand
+threads = 4  # per rank
+""")
+
+    assert cfg.getboolean("Experiments.eager.persist_derived_metrics", False) is True
+    assert cfg.getboolean("Experiments.lazy.persist_derived_metrics", True) is False
+    assert cfg.getboolean("Experiments.lazy.mpi", True) is True
+    assert cfg.getint("Experiments.lazy.threads", 1) == 4
@@ -0,0 +1,53 @@
+import numpy as np
+
+from .MathExp import MathExp
+from .PPK import PPK, PPKBuilder
+from .merge import merge
+
+
+def make_part(metric, scale, events, threads):
+    builder = PPKBuilder(["TIME", metric], {"Iteration": metric})
+    ue = builder.addUserEvent("Message size")
+    for t in threads:
+        ids = [builder.addEvent(e) for e in events]
+        values = [[scale * (i + 1) + t, 10.0 * (i + 1) + t] for i in range(len(ids))]
+        builder.addThread(0, 0, t, ids, [1.0 + t] * len(ids), [0.0] * len(ids),
+                          values, values, metadata={"OMP Thread": metric},
+                          userEventIds=[ue], numSamples=[4], userEventValues=[[1, 8, 3.5, 70]])
+
+    return builder.header, builder.columns()
+
+
+def test_merge():
+    parts = [make_part("PAPI_TOT_CYC", 1.0, ["main", "compute"], [0, 1]),
+             make_part("PAPI_L1_DCM", 3.0, ["compute", "init"], [1, 2])]
+
+    ppk = merge(parts, ["iter-00", "iter-01"]).build([])
+    assert ppk.metrics == ["TIME", "PAPI_TOT_CYC", "PAPI_L1_DCM"]
+    assert [(t.nodeId, t.contextId, t.threadId) for t in ppk.threads] == \
+        [(0, 0, 0), (0, 0, 1), (0, 0, 2)]
+    assert ppk.metadata == {"Iteration": "PAPI_TOT_CYC"}
+    assert ppk.threads[2].metadata == {"OMP Thread": "PAPI_L1_DCM"}
+
+    # TIME is averaged over the iterations which measured the thread,
+    # missing profiles count as zeros
+    assert ppk.getDataPoint(1, "compute", "TIME", PPK.EXCLUSIVE) == ((2.0 + 1) + (3.0 + 1)) / 2
+    assert ppk.getDataPoint(1, "main", "TIME", PPK.EXCLUSIVE) == (1.0 + 1) / 2
+    assert ppk.getDataPoint(0, "main", "TIME", PPK.EXCLUSIVE) == 1.0
+    assert ppk.getDataPoint(2, "init", "PAPI_L1_DCM", PPK.INCLUSIVE) == 22.0
+    assert ppk.getDataPoint(1, "init", "PAPI_TOT_CYC", PPK.INCLUSIVE) == 0.0
+
+    assert ppk.threads[1].functionProfiles["compute"].numCalls == 2.0
+    assert len(ppk.userEventProfiles) == 3
+
+    # or every iteration keeps its own copy
+    ppk = merge(parts, ["iter-00", "iter-01"], shared="keep").build([], compact=True)
+    assert ppk.metrics == ["TIME", "PAPI_TOT_CYC", "TIME_iter01", "PAPI_L1_DCM"]
+    assert ppk.getDataPoint(1, "compute", "TIME", PPK.EXCLUSIVE) == 3.0
+    assert ppk.getDataPoint(1, "compute", "TIME_iter01", PPK.EXCLUSIVE) == 4.0
+
+    ppk.populateAggData()
+    assert np.isclose(ppk.getAggExcSum("compute", "TIME_iter01"), 4.0 + 5.0)
+
+    # the copy is a plain variable of derived metric expressions
+    assert MathExp("TIME - TIME_iter01").eval({"TIME": 3.0, "TIME_iter01": 4.0}) == -1.0
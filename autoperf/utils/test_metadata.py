@@ -0,0 +1,52 @@
+from . import metadata
+
+
+def test_sys_info_is_cached_per_boot(tmp_path, monkeypatch):
+    calls = []
+
+    def probe(name, values):
+        def run():
+            calls.append(name)
+            return values
+        return run
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(metadata, "_cache", {})
+    monkeypatch.setattr(metadata, "_boot_id", lambda: "boot-1")
+    monkeypatch.setattr(metadata, "_PROBES", {
+        "cpu": probe("cpu", {"META_CPU_HZ": 2e9, "META_CORE_NUM": 8}),
+        "memory": probe("memory", {"META_MEM_SIZE": 1024}),
+    })
+
+    # only what is asked for gets probed
+    assert metadata.get_sys_info(["META_MEM_SIZE"]) == {"META_MEM_SIZE": 1024}
+    assert metadata.get_sys_info([]) == {}
+    assert calls == ["memory"]
+
+    assert metadata.get_sys_info()["META_CPU_HZ"] == 2e9
+    assert calls == ["memory", "cpu"]
+
+    # a new process of the same boot reads the disk cache
+    monkeypatch.setattr(metadata, "_cache", {})
+    assert metadata.get_sys_info(["META_CORE_NUM"]) == {"META_CORE_NUM": 8}
+    assert calls == ["memory", "cpu"]
+
+    # a reboot invalidates it
+    monkeypatch.setattr(metadata, "_cache", {})
+    monkeypatch.setattr(metadata, "_boot_id", lambda: "boot-2")
+    metadata.get_sys_info(["META_CORE_NUM"])
+    assert calls == ["memory", "cpu", "cpu"]
+
+
+def test_recorded_info():
+    info = metadata.get_recorded_info({"CPU MHz": "2601.000",
+                                       "Memory Size": "65780844 kB",
+                                       "CPU Type": " Intel(R) Xeon(R) ",
+                                       "Cache Size": "35840 KB",
+                                       "META_CPU_HZ": "2.4e9",
+                                       "META_NOTE": "login"})
+
+    assert info == {"META_CPU_HZ": 2.4e9,
+                    "META_MEM_SIZE": 65780844,
+                    "META_CPU_MODEL": "Intel(R) Xeon(R)",
+                    "META_NOTE": "login"}